@@ -15,8 +15,8 @@ import scipy.sparse
 import scipy.linalg
 import scipy.sparse.linalg
 
+import desispec.interpolation
 import desispec.resolution
-from desispec import util
 
 from desispec.log import get_logger
 
@@ -32,8 +32,11 @@ class Spectrum(object):
         flux(numpy.ndarray): Array of shape (n,) flux densities in 1e-17 erg/s/cm**2 at each wavelength.
         ivar(numpy.ndarray): Array of shape (n,) inverse variances of flux at each wavelength.
         resolution(desimodel.resolution.Resolution): Sparse matrix of wavelength resolutions.
+        banded(bool): Accumulate the inverse covariance as a sparse banded matrix instead of a
+            dense (n,n) array, and decorrelate it in overlapping wavelength blocks when finalizing.
+            This is the only practical option for large wavelength grids.
     """
-    def __init__(self,wave,flux=None,ivar=None,mask=None,resolution=None):
+    def __init__(self,wave,flux=None,ivar=None,mask=None,resolution=None,banded=False):
         assert wave.ndim == 1, "Input wavelength should be 1D"
         assert (flux is None) or (flux.shape == wave.shape), "wave and flux should have same shape"
         assert (ivar is None) or (ivar.shape == wave.shape), "wave and ivar should have same shape"
@@ -51,20 +54,26 @@ class Spectrum(object):
         #     self.mask = util.mask32(mask)
         self.resolution = resolution
         self.R = resolution #- shorthand
+        self.banded = banded
         self.log = get_logger()
         # Initialize the quantities we will accumulate during co-addition. Note that our
-        # internal Cinv is a dense matrix.
+        # internal Cinv is a dense matrix, unless banded is True.
         if ivar is None:
             n = len(wave)
-            self.Cinv = np.zeros((n,n))
+            if banded:
+                self.Cinv = scipy.sparse.csr_matrix((n,n))
+            else:
+                self.Cinv = np.zeros((n,n))
             self.Cinv_f = np.zeros((n,))
         else:
             assert flux is not None and resolution is not None,'Missing flux and/or resolution.'
             diag_ivar = scipy.sparse.dia_matrix((ivar[np.newaxis,:],[0]),resolution.shape)
             self.Cinv = self.resolution.T.dot(diag_ivar.dot(self.resolution))
+            if banded:
+                self.Cinv = scipy.sparse.csr_matrix(self.Cinv)
             self.Cinv_f = self.resolution.T.dot(self.ivar*self.flux)
 
-    def finalize(self):
+    def finalize(self,block_size=500,halo=50):
         """Calculates the flux, inverse variance and resolution for this spectrum.
 
         Uses the accumulated data from all += operations so far but does not prevent
@@ -75,7 +84,16 @@ class Spectrum(object):
         If the coadded resolution matrix is not invertible, a warning message is
         printed and the returned flux vector is zero (but ivar and resolution are
         still valid).
+
+        Args:
+            block_size(int): Number of wavelength bins decorrelated at once, only used
+                for a banded spectrum (see :func:`decorrelate_blocks`).
+            halo(int): Number of extra bins on each side of a block, only used for
+                a banded spectrum.
         """
+        if self.banded:
+            self._finalize_banded(block_size,halo)
+            return
         # Convert to a dense matrix if necessary.
         if scipy.sparse.issparse(self.Cinv):
             self.Cinv = self.Cinv.todense()
@@ -97,6 +115,39 @@ class Spectrum(object):
         # Convert R from a dense matrix to a sparse one.
         self.resolution = desispec.resolution.Resolution(R)
 
+    def _finalize_banded(self,block_size,halo):
+        """Banded version of finalize() that never allocates an (n,n) matrix.
+        """
+        Cinv = scipy.sparse.csr_matrix(self.Cinv)
+        n = len(self.Cinv_f)
+        # What pixels are we using?
+        mask = (Cinv.diagonal() > 0)
+        keep = np.arange(n)[mask]
+        Cinv = Cinv[keep][:,keep]
+        # Initialize the results to zero.
+        self.flux = np.zeros_like(self.Cinv_f)
+        self.ivar = np.zeros_like(self.Cinv_f)
+        # Calculate the deconvolved flux,ivar and resolution for ivar > 0 pixels.
+        self.ivar[mask],R = decorrelate_blocks(Cinv,block_size,halo)
+        # The coadded flux is the deconvolved flux Cinv^-1.Cinv_f convolved with R,
+        # which is equivalent to R^T^-1.Cinv_f/ivar for the dense decorrelation.
+        try:
+            deconvolved = scipy.sparse.linalg.spsolve(Cinv.tocsc(),self.Cinv_f[mask])
+            if not np.all(np.isfinite(deconvolved)):
+                raise np.linalg.linalg.LinAlgError('singular matrix')
+            self.flux[mask] = R.dot(deconvolved)
+        except np.linalg.linalg.LinAlgError:
+            self.log.warning('resolution matrix is singular so no coadded fluxes available.')
+        # Map R back to the full wavelength grid, keeping the standard diagonals.
+        R = R.tocoo()
+        row,col = keep[R.row],keep[R.col]
+        offset = col - row
+        ndiag = desispec.resolution.default_ndiag
+        inband = np.abs(offset) <= ndiag//2
+        rdata = np.zeros((ndiag,n))
+        rdata[ndiag//2 - offset[inband],col[inband]] = R.data[inband]
+        self.resolution = desispec.resolution.Resolution(rdata)
+
     def __iadd__(self,other):
         """Coadd this spectrum with another spectrum.
 
@@ -111,18 +162,24 @@ class Spectrum(object):
             self.mask = np.zeros(len(self.wave), dtype=np.uint32)
         
         # Accumulate weighted deconvolved fluxes.
+        other_Cinv = other.Cinv
+        if self.banded:
+            other_Cinv = scipy.sparse.csr_matrix(other_Cinv)
         if np.array_equal(self.wave,other.wave):
-            self.Cinv = self.Cinv + other.Cinv
+            self.Cinv = self.Cinv + other_Cinv
             self.Cinv_f += other.Cinv_f
             if (self.mask is not None) and (other.mask is not None):
                 self.mask |= other.mask
         else:
             resampler = get_resampling_matrix(self.wave,other.wave)
-            self.Cinv = self.Cinv + resampler.T.dot(other.Cinv.dot(resampler))
+            # Cinv is symmetric so R.T Cinv R = R.T (R.T Cinv).T, which keeps the sparse
+            # resampler on the left of each product.
+            self.Cinv = self.Cinv + resampler.T.dot(resampler.T.dot(other_Cinv).T)
             self.Cinv_f += resampler.T.dot(other.Cinv_f)
             if (self.mask is not None) and (other.mask is not None):
-                mask_resampler = (resampler != 0).T
-                self.mask |= mask_resampler.T.dot(other.mask)
+                # OR the mask of each local bin into the global bins it contributes to.
+                local_index,global_index = resampler.nonzero()
+                np.bitwise_or.at(self.mask,global_index,other.mask[local_index])
                 
         # Make sure we don't forget to call finalize.
         self.flux = None
@@ -141,18 +198,31 @@ co-added spectra have a roughly constant FWHM/BINSIZE.
 """
 global_wavelength_grid = np.arange(3579.0,9826.0,1.0)
 
-def get_resampling_matrix(global_grid,local_grid):
+def get_resampling_matrix(global_grid,local_grid,sparse=True):
     """Build the rectangular matrix that linearly resamples from the global grid to a local grid.
 
-    The local grid range must be contained within the global grid range.
+    The local grid range must be contained within the global grid range. Each row of the matrix
+    has two non-zero elements, so it is built as a scipy.sparse CSR matrix. Matrices are cached
+    with :func:`desispec.interpolation.cached_grid_operator`, so coadding many spectra with the
+    same grids only builds each matrix once.
 
     Args:
         global_grid(numpy.ndarray): Sorted array of n global grid wavelengths.
         local_grid(numpy.ndarray): Sorted array of m local grid wavelengths.
+        sparse(bool): Return the cached scipy.sparse CSR matrix, which must not be modified,
+            instead of a new dense array.
 
     Returns:
-        numpy.ndarray: Array of (m,n) matrix elements that perform the linear resampling.
+        scipy.sparse.csr_matrix: Matrix of (m,n) elements that perform the linear resampling,
+            or a numpy.ndarray if sparse is False.
     """
+    matrix = desispec.interpolation.cached_grid_operator(_build_resampling_matrix,global_grid,local_grid)
+    if sparse:
+        return matrix
+    return matrix.toarray()
+
+def _build_resampling_matrix(global_grid,local_grid):
+    """Build the sparse resampling matrix returned by :func:`get_resampling_matrix`."""
     assert np.all(np.diff(global_grid) > 0),'Global grid is not strictly increasing.'
     assert np.all(np.diff(local_grid) > 0),'Local grid is not strictly increasing.'
     # Locate each local wavelength in the global grid.
@@ -164,13 +234,19 @@ def get_resampling_matrix(global_grid,local_grid):
     # but this is fine since the coefficient of xlo will be zero.
     global_xhi = global_grid[global_index]
     global_xlo = global_grid[global_index-1]
-    # Create the rectangular interpolation matrix to return.
+    # Create the rectangular interpolation matrix, with the two non-zero elements of
+    # each row stored next to each other: alpha at xhi then 1-alpha at xlo.
     alpha = (local_grid - global_xlo)/(global_xhi - global_xlo)
-    local_index = np.arange(len(local_grid),dtype=int)
-    matrix = np.zeros((len(local_grid),len(global_grid)))
-    matrix[local_index,global_index] = alpha
-    matrix[local_index,global_index-1] = 1 - alpha
-    return matrix
+    nlocal = len(local_grid)
+    data = np.empty((nlocal,2))
+    data[:,0] = alpha
+    data[:,1] = 1 - alpha
+    indices = np.empty((nlocal,2),dtype=int)
+    indices[:,0] = global_index
+    indices[:,1] = (global_index-1) % len(global_grid)
+    indptr = np.arange(0,2*nlocal+1,2)
+    return scipy.sparse.csr_matrix((data.ravel(),indices.ravel(),indptr),
+        shape=(nlocal,len(global_grid)))
 
 def decorrelate(Cinv):
     """Decorrelate an inverse covariance using the matrix square root.
@@ -215,3 +291,59 @@ def decorrelate(Cinv):
     R = Q/s[:,np.newaxis]
     ivar = s**2
     return ivar,R
+
+def decorrelate_blocks(Cinv,block_size=500,halo=50):
+    """Decorrelate a banded inverse covariance in overlapping wavelength blocks.
+
+    This is a memory-efficient approximation of :func:`decorrelate` for a sparse banded Cinv.
+    The matrix square root is computed for each block of block_size consecutive bins extended
+    by halo bins on each side, and only the rows of the block itself are kept. Since the
+    square root of a banded matrix is concentrated near its diagonal, this converges to the
+    dense result when halo is a few times the bandwidth of Cinv. The cost is linear with the
+    number of bins and no (n,n) matrix is allocated.
+
+    Args:
+        Cinv(scipy.sparse matrix): Square sparse banded inverse covariance matrix.
+        block_size(int): Number of bins decorrelated at once.
+        halo(int): Number of extra bins on each side of a block. Elements of the resolution
+            matrix further than halo from the diagonal are dropped.
+
+    Returns:
+        tuple: Tuple ivar,R of uncorrelated flux inverse variances and the corresponding
+            resolution matrix, with shapes (nflux,) and (nflux,nflux) respectively.
+            R is returned as a scipy.sparse CSR matrix.
+    """
+    log = get_logger()
+    assert block_size > 0,'block_size must be positive'
+    assert halo >= 0,'halo cannot be negative'
+    Cinv = scipy.sparse.csr_matrix(Cinv)
+    # Clean up any roundoff errors by forcing Cinv to be symmetric.
+    Cinv = 0.5*(Cinv + Cinv.T)
+    n = Cinv.shape[0]
+    ivar = np.zeros(n)
+    rows,cols,values = [],[],[]
+    nbad = 0
+    for begin in range(0,n,block_size):
+        end = min(n,begin + block_size)
+        wbegin = max(0,begin - halo)
+        wend = min(n,end + halo)
+        block = Cinv[wbegin:wend,wbegin:wend].toarray()
+        L,X = scipy.linalg.eigh(block)
+        nbad += np.count_nonzero(L < 0)
+        L[L < 0] = 0.
+        # Rows of the matrix square root of the window for the bins of this block.
+        Q = (X[begin - wbegin:end - wbegin]*np.sqrt(L)).dot(X.T)
+        s = np.sum(Q,axis=1)
+        ivar[begin:end] = s**2
+        # Keep the elements within halo of the diagonal.
+        i,j = np.nonzero(Q)
+        i_global,j_global = begin + i,wbegin + j
+        near = np.abs(j_global - i_global) <= halo
+        rows.append(i_global[near])
+        cols.append(j_global[near])
+        values.append((Q/s[:,np.newaxis])[i[near],j[near]])
+    if nbad > 0:
+        log.warning('zeroing {0:d} negative eigenvalue(s).'.format(nbad))
+    R = scipy.sparse.csr_matrix(
+        (np.concatenate(values),(np.concatenate(rows),np.concatenate(cols))),shape=(n,n))
+    return ivar,R
@@ -9,82 +9,70 @@ Utility functions to find cosmic rays
 from desispec.log import get_logger
 import numpy as np
 import math
-import copy
+import multiprocessing.pool
 from desispec.maskbits import ccdmask
 
-def reject_cosmic_rays_ala_sdss_single(img,selection,nsig,cfudge,c2fudge) :
-    """Cosmic ray rejection following the implementation in SDSS/BOSS.
-    (see idlutils/src/image/reject_cr_psf.c and idlutils/pro/image/reject_cr.pro)
-
-    This routine is a single call, similar to IDL routine reject_cr_single
-    Called by reject_cosmic_rays_ala_sdss with an iteration
-
-    Input is a pre-processed image : desispec.Image
-    Ouput is a rejection mask of the same size as the image
-
-    Args:
-       img: input desispec.Image
-       selection: selection of pixels to be tested (boolean array of same shape as img.pix[1:-1,1:-1])
-       nsig: number of sigma above background required
-       cfudge: number of sigma inconsistent with PSF required
-       c2fudge:  fudge factor applied to PSF
-    """
-    log=get_logger()
-    log.debug("starting with nsig=%2.1f cfudge=%2.1f c2fudge=%2.1f"%(nsig,cfudge,c2fudge))
-
+def _psf_for_cosmics(camera) :
+    """Returns the PSF values of the four axis used by the cosmic ray rejection for this camera"""
     # psf is precomputed for each camera
     # using psf_for_cosmics.py --psffile psf-{b,r,z}0-00000000.fits
     # today based on data challenge 2 results , psf files from
     # /project/projectdirs/desi/spectro/redux/alpha-3/calib2d/psf/20150107
     #
-    naxis=4
-    if img.camera[0].lower() == 'b':
-        psf=np.array([0.366247,0.391422,0.172965,0.184552])
-    elif img.camera[0].lower() == 'r':
-        psf=np.array([0.39508155,0.2951822,0.13044542,0.14904523])
-    elif img.camera[0].lower() == 'z':
-        psf=np.array([0.513852,0.537679,0.297071,0.276298])
+    if camera[0].lower() == 'b':
+        return np.array([0.366247,0.391422,0.172965,0.184552])
+    elif camera[0].lower() == 'r':
+        return np.array([0.39508155,0.2951822,0.13044542,0.14904523])
+    elif camera[0].lower() == 'z':
+        return np.array([0.513852,0.537679,0.297071,0.276298])
     else :
-        log.error("do not have psf for camera '%s'"%img.camera)
-        raise KeyError('No PSF for camera {}'.format(img.camera))
+        log=get_logger()
+        log.error("do not have psf for camera '%s'"%camera)
+        raise KeyError('No PSF for camera {}'.format(camera))
 
-    # selection is now an argument (for neighbors)
-    # selection=((img.pix*np.sqrt(img.ivar)*(img.mask==0))[1:-1,1:-1]>nsig).astype(bool)
+def _reject_pixels(pix,ivar,mask,rows,cols,psf,nsig,cfudge,c2fudge,rejected=None) :
+    """Applies the SDSS cosmic ray criteria to a list of pixels
 
-    if np.sum(selection) ==0 :
-        log.warning("no valid pixel above %2.1f sigma"%nsig)
-        return np.zeros(img.pix.shape).astype(bool)
+    Only the 3x3 pixels around each tested pixel are read, so the result of
+    a pixel does not depend on which other pixels are tested.
 
-    # pixel values and inverse variance in selection (accounting for pre-existing mask)
-    # it is flatted to ease the data manipulation
-    # we only consider data 1 pixel off from CCD edge because neighboring
-    # pixels are used
-    pix=img.pix[1:-1,1:-1][selection].ravel()
-    pixivar=(img.ivar[1:-1,1:-1][selection]*(img.mask[1:-1,1:-1][selection]==0)).ravel()
+    Args:
+       pix, ivar, mask: 2D image arrays
+       rows, cols: indices of the pixels to test, none on the CCD edges
+       psf: PSF values of the 4 axis, from _psf_for_cosmics
+       nsig, cfudge, c2fudge: see reject_cosmic_rays_ala_sdss_single
+       rejected: optional boolean image of pixels already rejected, whose
+          inverse variance is considered to be 0
+
+    Returns:
+       boolean array, True for the rejected pixels in (rows,cols)
+    """
+    log=get_logger()
+
+    def masked_ivar(r,c) :
+        # inverse variance accounting for pre-existing mask and rejected pixels
+        tmp=ivar[r,c]*(mask[r,c]==0)
+        if rejected is not None :
+            tmp[rejected[r,c]]=0.
+        return tmp
+
+    # pixel values and inverse variance of the tested pixels
+    pix_values=pix[rows,cols]
+    pixivar=masked_ivar(rows,cols)
 
     # there are 4 axis (horizontal,vertical,and 2 diagonals)
     # for each axis, there is a pair of two pixels on each side of the pixel of interest
     # pairpix is the pixel values
     # pairivar their inverse variance (accounting for pre-existing mask)
     naxis=4
-    pairpix=np.zeros((naxis,2,pix.size))
-    pairpix[0,0]=img.pix[1:-1,2:][selection].ravel()
-    pairpix[0,1]=img.pix[1:-1,:-2][selection].ravel()
-    pairpix[1,0]=img.pix[2:,1:-1][selection].ravel()
-    pairpix[1,1]=img.pix[:-2,1:-1][selection].ravel()
-    pairpix[2,0]=img.pix[2:,2:][selection].ravel()
-    pairpix[2,1]=img.pix[:-2,:-2][selection].ravel()
-    pairpix[3,0]=img.pix[2:,:-2][selection].ravel()
-    pairpix[3,1]=img.pix[:-2,2:][selection].ravel()
-    pairivar=np.zeros((naxis,2,pix.size))
-    pairivar[0,0]=(img.ivar[1:-1,2:][selection]*(img.mask[1:-1,2:][selection]==0)).ravel()
-    pairivar[0,1]=(img.ivar[1:-1,:-2][selection]*(img.mask[1:-1,:-2][selection]==0)).ravel()
-    pairivar[1,0]=(img.ivar[2:,1:-1][selection]*(img.mask[2:,1:-1][selection]==0)).ravel()
-    pairivar[1,1]=(img.ivar[:-2,1:-1][selection]*(img.mask[:-2,1:-1][selection]==0)).ravel()
-    pairivar[2,0]=(img.ivar[2:,2:][selection]*(img.mask[2:,2:][selection]==0)).ravel()
-    pairivar[2,1]=(img.ivar[:-2,:-2][selection]*(img.mask[:-2,:-2][selection]==0)).ravel()
-    pairivar[3,0]=(img.ivar[2:,:-2][selection]*(img.mask[2:,:-2][selection]==0)).ravel()
-    pairivar[3,1]=(img.ivar[:-2,2:][selection]*(img.mask[:-2,2:][selection]==0)).ravel()
+    offsets=[((0,1),(0,-1)),((1,0),(-1,0)),((1,1),(-1,-1)),((1,-1),(-1,1))]
+    pairpix=np.zeros((naxis,2,pix_values.size))
+    pairivar=np.zeros((naxis,2,pix_values.size))
+    for a in range(naxis) :
+        for side in range(2) :
+            drow,dcol=offsets[a][side]
+            pairpix[a,side]=pix[rows+drow,cols+dcol]
+            pairivar[a,side]=masked_ivar(rows+drow,cols+dcol)
 
     # set to 0 pixel values with null ivar
     pairpix *= (pairivar>0)
@@ -96,7 +84,7 @@ def reject_cosmic_rays_ala_sdss_single(img,selection,nsig,cfudge,c2fudge) :
     back=np.sum(pairpix*(pairivar>0),axis=1)*tmp
     sigmaback=np.sqrt(np.sum((pairivar>0)/(pairivar+(pairivar==0)),axis=1))*tmp
 
-    log.debug("mean pix = %f"%np.mean(pix))
+    log.debug("mean pix = %f"%np.mean(pix_values))
     log.debug("mean back = %f"%np.mean(back))
     log.debug("mean sigmaback = %f"%np.mean(sigmaback))
 
@@ -105,8 +93,8 @@ def reject_cosmic_rays_ala_sdss_single(img,selection,nsig,cfudge,c2fudge) :
     # JG comment : this does not look great for muon tracks that are perfectly aligned
     # with one the axis.
     # I change the algorithm to accept 3 out of 4 valid tests
-    first_criterion=np.ones(pix.shape)
-    tmp=pix-nsig/np.sqrt(pixivar)
+    first_criterion=np.ones(pix_values.shape)
+    tmp=pix_values-nsig/np.sqrt(pixivar)
     for a in range(naxis) :
         first_criterion += (tmp>back[a])
     first_criterion=(first_criterion>=3).astype(bool)
@@ -116,27 +104,61 @@ def reject_cosmic_rays_ala_sdss_single(img,selection,nsig,cfudge,c2fudge) :
     # pixel value
     # here the number of sigmas is the parameter cfudge
     # c2fudge alters the PSF
-    second_criterion=np.zeros(pix.shape).astype(bool)
-    tmp=pix-cfudge/np.sqrt(pixivar)
+    second_criterion=np.zeros(pix_values.shape).astype(bool)
+    tmp=pix_values-cfudge/np.sqrt(pixivar)
     for a in range(naxis) :
         second_criterion |= ( tmp*c2fudge*psf[a] > ( back[a]+cfudge*sigmaback[a] ) )
 
-
-    log.debug("npix selected                       = %d"%pix.size)
+    log.debug("npix selected                       = %d"%pix_values.size)
     log.debug("npix rejected 1st criterion         = %d"%np.sum(first_criterion))
     log.debug("npix rejected 1st and 2nd criterion = %d"%np.sum(first_criterion&second_criterion))
 
-    # remap to original shape
-    rejection=np.zeros(img.pix.shape).astype(bool)
-    rejection[1:-1,1:-1][selection] = (first_criterion&second_criterion).reshape(img.pix[1:-1,1:-1][selection].shape)
+    return first_criterion&second_criterion
+
+def reject_cosmic_rays_ala_sdss_single(img,selection,nsig,cfudge,c2fudge) :
+    """Cosmic ray rejection following the implementation in SDSS/BOSS.
+    (see idlutils/src/image/reject_cr_psf.c and idlutils/pro/image/reject_cr.pro)
+
+    This routine is a single call, similar to IDL routine reject_cr_single
+
+    Input is a pre-processed image : desispec.Image
+    Ouput is a rejection mask of the same size as the image
+
+    Args:
+       img: input desispec.Image
+       selection: selection of pixels to be tested (boolean array of same shape as img.pix[1:-1,1:-1])
+       nsig: number of sigma above background required
+       cfudge: number of sigma inconsistent with PSF required
+       c2fudge:  fudge factor applied to PSF
+    """
+    log=get_logger()
+    log.debug("starting with nsig=%2.1f cfudge=%2.1f c2fudge=%2.1f"%(nsig,cfudge,c2fudge))
+
+    psf=_psf_for_cosmics(img.camera)
+
+    if np.sum(selection) ==0 :
+        log.warning("no valid pixel above %2.1f sigma"%nsig)
+        return np.zeros(img.pix.shape).astype(bool)
+
+    # we only consider data 1 pixel off from CCD edge because neighboring
+    # pixels are used
+    rows,cols=np.nonzero(selection)
+    rows+=1
+    cols+=1
+    rejection=np.zeros(img.pix.shape,dtype=bool)
+    rejection[rows,cols]=_reject_pixels(img.pix,img.ivar,img.mask,rows,cols,psf,nsig,cfudge,c2fudge)
     return rejection
 
-def reject_cosmic_rays_ala_sdss(img,nsig=6.,cfudge=3.,c2fudge=0.8,niter=6,dilate=True) :
+def reject_cosmic_rays_ala_sdss(img,nsig=6.,cfudge=3.,c2fudge=0.8,niter=6,dilate=True,nthreads=1,block_rows=256) :
     """Cosmic ray rejection following the implementation in SDSS/BOSS.
     (see idlutils/src/image/reject_cr_psf.c and idlutils/pro/image/reject_cr.pro)
 
-    This routine is calling several times reject_cosmic_rays_ala_sdss_single,
-    similar to IDL routine reject_cr.
+    This routine applies the criteria of reject_cosmic_rays_ala_sdss_single
+    several times, similar to IDL routine reject_cr.
+    The first pass tests the pixels above nsig in blocks of block_rows rows
+    (reading a one-pixel halo around each block), processed by nthreads threads.
+    The following passes only test the pixels around those newly rejected,
+    because the result of the other neighbors of rejected pixels cannot change.
     There is an optionnal dilatation of the mask by one pixel, as done in sdssproc.pro for SDSS
 
     Input is a pre-processed image : desispec.Image
@@ -149,42 +171,76 @@ def reject_cosmic_rays_ala_sdss(img,nsig=6.,cfudge=3.,c2fudge=0.8,niter=6,dilate
        c2fudge:  fudge factor applied to PSF
        niter: number of iterations on neighboring pixels of rejected pixels
        dilate: force +1 pixel dilation of rejection mask
+       nthreads: number of threads for the first pass
+       block_rows: number of image rows per block of the first pass
     """
     log=get_logger()
     log.info("starting with nsig=%2.1f cfudge=%2.1f c2fudge=%2.1f"%(nsig,cfudge,c2fudge))
 
+    psf=_psf_for_cosmics(img.camera)
+    ny,nx=img.pix.shape
+
+    def first_pass(first_row,last_row) :
+        # pixels above nsig in rows [first_row,last_row), 1 pixel off from CCD edge
+        selection=(img.pix[first_row:last_row,1:-1]*np.sqrt(img.ivar[first_row:last_row,1:-1])*(img.mask[first_row:last_row,1:-1]==0))>nsig
+        rows,cols=np.nonzero(selection)
+        rows+=first_row
+        cols+=1
+        if rows.size == 0 :
+            return rows,cols,0
+        keep=_reject_pixels(img.pix,img.ivar,img.mask,rows,cols,psf,nsig,cfudge,c2fudge)
+        return rows[keep],cols[keep],rows.size
+
+    blocks=[(first_row,min(first_row+block_rows,ny-1)) for first_row in range(1,ny-1,block_rows)]
+    if nthreads > 1 and len(blocks) > 1 :
+        pool=multiprocessing.pool.ThreadPool(nthreads)
+        results=pool.map(lambda block : first_pass(*block),blocks)
+        pool.close()
+        pool.join()
+    else :
+        results=[first_pass(*block) for block in blocks]
 
-    selection=((img.pix*np.sqrt(img.ivar)*(img.mask==0))[1:-1,1:-1]>nsig).astype(bool)
-    rejected=reject_cosmic_rays_ala_sdss_single(img,selection,nsig=nsig,cfudge=cfudge,c2fudge=c2fudge)
-    log.info("first pass: %d pixels rejected"%(np.sum(rejected)))
+    rejected=np.zeros(img.pix.shape,dtype=bool)
+    new_rows=np.concatenate([np.zeros(0,dtype=int)]+[result[0] for result in results])
+    new_cols=np.concatenate([np.zeros(0,dtype=int)]+[result[1] for result in results])
+    if sum([result[2] for result in results]) == 0 :
+        log.warning("no valid pixel above %2.1f sigma"%nsig)
+    rejected[new_rows,new_cols]=True
+    log.info("first pass: %d pixels rejected"%(new_rows.size))
 
-    tmpimg=copy.deepcopy(img)
-    neighbors = np.zeros(rejected.shape).astype(bool)
+    nrejected=new_rows.size
     for iteration in range(niter) :
 
-        if np.sum(rejected)==0 :
+        if nrejected==0 :
             break
-        neighbors *= False
-        # left and right neighbors
-        neighbors[1:,:]  |= rejected[:-1,:]
-        neighbors[:-1,:] |= rejected[1:,:]
-        neighbors[:,1:]  |= rejected[:,:-1]
-        neighbors[:,:-1] |= rejected[:,1:]
-        # adding diagonals (not in original SDSS version)
-        neighbors[1:,1:]  |= rejected[:-1,:-1]
-        neighbors[:-1,:-1]  |= rejected[1:,1:]
-        neighbors[1:,:-1]  |= rejected[:-1,1:]
-        neighbors[:-1,1:]  |= rejected[1:,:-1]
-
-        neighbors &= (rejected==False) # excluded already rejected pixel
-        tmpimg.ivar[rejected] = 0. # mask already rejected pixels for the calculation of the background of the neighbors
-
-        # rerun with much more strict cuts
-        newrejected=reject_cosmic_rays_ala_sdss_single(tmpimg,neighbors[1:-1,1:-1],nsig=3.,cfudge=0.,c2fudge=1.)
-        log.info("at iter %d: %d new pixels rejected"%(iteration,np.sum(newrejected)))
-        if np.sum(newrejected)<2 :
+
+        # neighbors of the pixels rejected at the previous pass, 1 pixel off from CCD edge,
+        # (including diagonals, not in original SDSS version)
+        # the other neighbors of rejected pixels were already tested and their 3x3
+        # pixels have not changed since
+        rows=(new_rows[:,None]+np.array([-1,-1,-1,0,0,1,1,1])).ravel()
+        cols=(new_cols[:,None]+np.array([-1,0,1,-1,1,-1,0,1])).ravel()
+        inside=(rows>0)&(rows<ny-1)&(cols>0)&(cols<nx-1)
+        index=np.unique(rows[inside]*nx+cols[inside])
+        rows=index//nx
+        cols=index%nx
+        # excluded already rejected pixel
+        notrejected=(rejected[rows,cols]==False)
+        rows=rows[notrejected]
+        cols=cols[notrejected]
+
+        # rerun with much more strict cuts, masking already rejected pixels
+        # for the calculation of the background of the neighbors
+        keep=np.zeros(0).astype(bool)
+        if rows.size > 0 :
+            keep=_reject_pixels(img.pix,img.ivar,img.mask,rows,cols,psf,nsig=3.,cfudge=0.,c2fudge=1.,rejected=rejected)
+        new_rows=rows[keep]
+        new_cols=cols[keep]
+        log.info("at iter %d: %d new pixels rejected"%(iteration,new_rows.size))
+        if new_rows.size<2 :
             break
-        rejected = rejected|newrejected
+        rejected[new_rows,new_cols]=True
+        nrejected+=new_rows.size
 
 
 
@@ -205,14 +261,15 @@ def reject_cosmic_rays_ala_sdss(img,nsig=6.,cfudge=3.,c2fudge=0.8,niter=6,dilate
     log.info("end : %s pixels rejected"%(np.sum(rejected)))
     return rejected
 
-def reject_cosmic_rays(img) :
+def reject_cosmic_rays(img,nthreads=1) :
     """Cosmic ray rejection
     Input is a pre-processed image : desispec.Image
     The image mask is modified
 
     Args:
        img: input desispec.Image
+       nthreads: number of threads
 
     """
-    rejected=reject_cosmic_rays_ala_sdss(img,nsig=6.,cfudge=3.,c2fudge=0.8,niter=20,dilate=False)
+    rejected=reject_cosmic_rays_ala_sdss(img,nsig=6.,cfudge=3.,c2fudge=0.8,niter=20,dilate=False,nthreads=nthreads)
     img.mask[rejected] |= ccdmask.COSMIC
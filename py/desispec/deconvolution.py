@@ -0,0 +1,265 @@
+"""
+desispec.deconvolution
+======================
+
+Banded solver for the deconvolved mean spectrum of several fibers.
+
+The sky model, the fiber flat and the flux calibration all fit one spectrum
+M on the wavelength grid of the frame that, once convolved with the resolution
+of each fiber, describes the data of all fibers:
+
+    chi2 = sum_f sum_i ivar_fi ( flux_fi - scale_fi (R_f C_f M)_i )^2
+
+where R_f is the resolution matrix of fiber f, scale_f an optional
+multiplicative term applied after the resolution (e.g. a smooth fiber flat)
+and C_f an optional diagonal term applied before the resolution
+(e.g. a stellar model for the flux calibration).
+
+The normal equations A M = B of this system are banded, with 2*(ndiag-1)+1
+non-zero diagonals.  They are filled here directly in LAPACK upper banded
+storage, A[i,j] = Ab[u+i-j,j] for i<=j with u=ndiag-1, and solved with a
+banded Cholesky decomposition, so that no (nwave,nwave) matrix is allocated.
+"""
+from __future__ import absolute_import, division
+
+import numpy as np
+import scipy.linalg
+
+from desispec.linalg import cholesky_invert_banded_factor, banded_sandwich_diagonal
+
+
+def resolution_rows(resolution_data):
+    """Reorder resolution diagonals so that each wavelength holds a matrix row
+
+    Args:
+        resolution_data : 3D[nspec, ndiag, nwave] diagonals of the resolution
+            matrices, in the format of :class:`desispec.resolution.Resolution`
+
+    Returns:
+        3D[nspec, nwave, ndiag] array rows with
+        rows[f,i,m] = R_f[i,i+m-ndiag//2], set to 0 outside of the matrix
+    """
+    nspec, ndiag, nwave = resolution_data.shape
+    hw = ndiag//2
+    rows = np.zeros((nspec, nwave, ndiag))
+    for m in range(ndiag):
+        # offset o=m-hw is stored in diagonal hw-o of resolution_data,
+        # with R[i,i+o] = resolution_data[hw-o,i+o]
+        o = m-hw
+        i0 = max(0, -o)
+        i1 = min(nwave, nwave-o)
+        rows[:, i0:i1, m] = resolution_data[:, hw-o, i0+o:i1+o]
+    return rows
+
+
+def _windows(x, ndiag):
+    """Returns xw[...,i,m] = x[...,i+m-ndiag//2], 0 outside of x"""
+    nwave = x.shape[-1]
+    hw = ndiag//2
+    xpad = np.zeros(x.shape[:-1]+(nwave+2*hw,))
+    xpad[..., hw:hw+nwave] = x
+    return xpad[..., np.arange(nwave)[:,None]+np.arange(ndiag)[None,:]]
+
+
+def apply_resolution_rows(rows, x):
+    """Convolve x by all the resolution matrices of rows
+
+    Args:
+        rows : 3D[nspec, nwave, ndiag] resolution rows (see resolution_rows)
+        x : 1D[nwave] vector shared by all fibers,
+            or 2D[nspec, nwave] with one vector per fiber
+
+    Returns:
+        2D[nspec, nwave] array with R_f.x (or R_f.x_f) in each row
+    """
+    xw = _windows(np.asarray(x, dtype=float), rows.shape[2])
+    if xw.ndim == 2:
+        return np.einsum('fim,im->fi', rows, xw)
+    else:
+        return np.einsum('fim,fim->fi', rows, xw)
+
+
+def banded_normal_equation(rows, weights, wflux):
+    """Fill the normal equations of sum_f |flux_f - R_f x|^2 with weights w_f
+
+    Args:
+        rows : 3D[nspec, nwave, ndiag] resolution rows (see resolution_rows)
+        weights : 2D[nspec, nwave] weights w_fi
+        wflux : 2D[nspec, nwave] weighted data w_fi*flux_fi
+
+    Returns:
+        Ab : 2D[ndiag, nwave] A = sum_f R_f^T W_f R_f in upper banded form
+        B : 1D[nwave] B = sum_f R_f^T W_f flux_f
+    """
+    nspec, nwave, ndiag = rows.shape
+    hw = ndiag//2
+    u = 2*hw
+    wrows = rows*weights[:,:,None]
+    # M[i,m1,m2] = sum_f w_fi R_f[i,i+m1-hw] R_f[i,i+m2-hw]
+    M = np.matmul(wrows.transpose(1,2,0), rows.transpose(1,0,2))
+    Ab = np.zeros((u+1, nwave))
+    for m1 in range(ndiag):
+        for m2 in range(m1, ndiag):
+            # contributes to A[i+m1-hw,i+m2-hw]
+            i0 = max(0, hw-m1)
+            i1 = min(nwave, nwave+hw-m2)
+            Ab[u+m1-m2, i0+m2-hw:i1+m2-hw] += M[i0:i1, m1, m2]
+    Y = np.einsum('fim,fi->im', rows, wflux)
+    B = np.zeros(nwave)
+    for m in range(ndiag):
+        i0 = max(0, hw-m)
+        i1 = min(nwave, nwave+hw-m)
+        B[i0+m-hw:i1+m-hw] += Y[i0:i1, m]
+    return Ab, B
+
+
+def _add_pixels(Ab, B, rows, dweights, dwflux, index):
+    """Add the contribution of a few pixels to banded normal equations
+
+    Args:
+        Ab, B : normal equations, modified in place (see banded_normal_equation)
+        rows : 2D[npix, ndiag] resolution rows of the pixels
+        dweights : 1D[npix] weights to add (negative to remove pixels)
+        dwflux : 1D[npix] weighted flux to add
+        index : 1D[npix] wavelength index of the pixels
+    """
+    nwave = B.size
+    ndiag = rows.shape[1]
+    hw = ndiag//2
+    u = 2*hw
+    wrows = rows*dweights[:,None]
+    for m1 in range(ndiag):
+        ok1 = (index+m1-hw >= 0)
+        for m2 in range(m1, ndiag):
+            col = index+m2-hw
+            ok = ok1 & (col < nwave)
+            np.add.at(Ab[u+m1-m2], col[ok], wrows[ok,m1]*rows[ok,m2])
+    for m in range(ndiag):
+        col = index+m-hw
+        ok = (col >= 0) & (col < nwave)
+        np.add.at(B, col[ok], rows[ok,m]*dwflux[ok])
+
+
+class MeanSpectrumSolver(object):
+    def __init__(self, resolution_data, column_scale=None):
+        """Solver for the deconvolved mean spectrum M of several fibers
+
+        chi2 = sum_f sum_i ivar_fi ( flux_fi - scale_fi (R_f C_f M)_i )^2
+
+        Args:
+            resolution_data : 3D[nspec, ndiag, nwave] resolution data
+
+        Options:
+            column_scale : 2D[nspec, nwave] diagonal terms C_f applied
+                before the resolution
+
+        The normal equations are (re)filled with fill(), updated with
+        update() when only a few pixel weights have changed (e.g. after
+        outlier rejection), and solved with solve().
+        """
+        self.rows = resolution_rows(resolution_data)
+        self.nspec, self.nwave, self.ndiag = self.rows.shape
+        if column_scale is not None:
+            self.rows *= _windows(column_scale, self.ndiag)
+        self.weights = None
+        self.wflux = None
+        self.Ab = None
+        self.B = None
+        self.prior_ivar = None
+        self.prior_mean = None
+        self._factor = None
+
+    def _weighted(self, ivar, flux, scale):
+        if scale is None:
+            return ivar.copy(), ivar*flux
+        else:
+            return ivar*scale**2, ivar*scale*flux
+
+    def fill(self, ivar, flux, scale=None):
+        """Fill the normal equations
+
+        Args:
+            ivar : 2D[nspec, nwave] inverse variance of flux
+            flux : 2D[nspec, nwave] data
+
+        Options:
+            scale : 2D[nspec, nwave] terms applied after the resolution
+        """
+        self.weights, self.wflux = self._weighted(ivar, flux, scale)
+        self.Ab, self.B = banded_normal_equation(self.rows, self.weights, self.wflux)
+        self._factor = None
+
+    def update(self, ivar, flux, scale=None, max_fraction=0.1):
+        """Update the normal equations for new pixel weights
+
+        Only the pixels whose weighted values differ from the previous call
+        are added/removed. If more than max_fraction of the pixels have
+        changed, the normal equations are refilled from scratch instead.
+
+        Args: same as fill()
+        """
+        if self.Ab is None:
+            return self.fill(ivar, flux, scale)
+        weights, wflux = self._weighted(ivar, flux, scale)
+        fibers, waves = np.where((weights != self.weights) | (wflux != self.wflux))
+        if fibers.size > max_fraction*weights.size:
+            return self.fill(ivar, flux, scale)
+        if fibers.size == 0:
+            return
+        _add_pixels(self.Ab, self.B, self.rows[fibers, waves],
+                    weights[fibers, waves]-self.weights[fibers, waves],
+                    wflux[fibers, waves]-self.wflux[fibers, waves], waves)
+        self.weights = weights
+        self.wflux = wflux
+        self._factor = None
+
+    def set_prior(self, ivar, mean):
+        """Add a gaussian prior on the solution (to keep A well conditioned)
+
+        Args:
+            ivar : scalar or 1D[nwave] inverse variance of the prior
+            mean : scalar or 1D[nwave] mean of the prior
+        """
+        self.prior_ivar = ivar*np.ones(self.nwave)
+        self.prior_mean = mean*np.ones(self.nwave)
+        self._factor = None
+
+    def factor(self):
+        """Returns the banded Cholesky decomposition of A (computed once)"""
+        if self._factor is None:
+            Ab = self.Ab.copy()
+            if self.prior_ivar is not None:
+                Ab[-1] += self.prior_ivar
+            self._factor = scipy.linalg.cholesky_banded(Ab, overwrite_ab=True)
+        return self._factor
+
+    def solve(self):
+        """Returns the solution M of the normal equations"""
+        B = self.B
+        if self.prior_ivar is not None:
+            B = B + self.prior_ivar*self.prior_mean
+        return scipy.linalg.cho_solve_banded((self.factor(), False), B)
+
+    def covariance(self, diagonal=False):
+        """Returns the band of the covariance of the solution
+
+        The covariance entries within the band of A are computed by selected
+        inversion of the Cholesky decomposition, without the dense inverse.
+
+        Options:
+            diagonal : only return the 1D[nwave] variance
+
+        Returns:
+            2D[ndiag, nwave] band of the covariance in the same (upper) storage
+            as Ab, or 1D[nwave] variance if diagonal=True
+        """
+        return cholesky_invert_banded_factor(self.factor(), diagonal=diagonal)
+
+    def convolved_variance(self, R):
+        """Returns the 1D variance of R.M, i.e. diag(R.C.R^T), for a
+        resolution matrix R no wider than the band of A"""
+        return banded_sandwich_diagonal(R, self.covariance())
+
+    def model(self, x):
+        """Returns 2D[nspec, nwave] R_f C_f x for all fibers (without scale)"""
+        return apply_resolution_rows(self.rows, x)
@@ -9,17 +9,84 @@ from __future__ import absolute_import, division
 
 import numpy as np
 from desispec.resolution import Resolution
-from desispec.linalg import cholesky_solve
 from desispec.linalg import cholesky_solve_and_invert
-from desispec.linalg import spline_fit
+from desispec.linalg import spline_fit, SplineFitter
+from desispec.deconvolution import MeanSpectrumSolver
 from desispec.maskbits import specmask
 from desispec import util
-import scipy,scipy.sparse
+import scipy
 import sys
 from desispec.log import get_logger
 import math
 
 
+def _masked_column_median(values, good, default=0.) :
+    """Returns the median of each column of values over the rows where good
+    is True, or default for columns without any good row (same as calling
+    np.median(values[good[:,i],i]) for each column i)."""
+    count = np.sum(good,axis=0)
+    # bad entries are sorted after the good ones
+    sorted_values = np.sort(np.where(good,values,np.inf),axis=0)
+    columns = np.arange(values.shape[1])
+    low = sorted_values[np.maximum(count-1,0)//2,columns]
+    high = sorted_values[np.minimum(count//2,values.shape[0]-1),columns]
+    median = np.where(count%2==1,low,(low+high)/2.)
+    return np.where(count>0,median,default)
+
+def _worst_pixels(chi2, threshold, nmax=5) :
+    """Returns a boolean array of the same shape as the 2D chi2 that selects,
+    in each row, the (at most nmax) pixels with the largest chi2>threshold."""
+    selected = np.zeros(chi2.shape,dtype=bool)
+    above = (chi2>threshold)
+    rows = np.where(np.sum(above,axis=1)>0)[0]
+    if rows.size == 0 :
+        return selected
+    values = np.where(above[rows],chi2[rows],-np.inf)
+    # a stable sort keeps the last pixels of equal chi2 first, as the per-fiber argsort did
+    worst = np.argsort(values,axis=1,kind='stable')[:,-nmax:]
+    selected[rows[:,None],worst] = above[rows[:,None],worst]
+    return selected
+
+def _max_run_length(indices) :
+    """Returns the length of the longest run of consecutive values in the
+    sorted 1D array of integers indices (0 if empty)."""
+    if indices.size == 0 :
+        return 0
+    breaks = np.where(np.diff(indices)!=1)[0]
+    starts = np.concatenate([[0],breaks+1])
+    ends = np.concatenate([breaks+1,[indices.size]])
+    return int(np.max(ends-starts))
+
+def _clip_smooth_fiberflat(spline_fitter, fibers, fiberflat, fiberflat_ivar, nsig, max_iterations=500) :
+    """Iteratively fits a smooth fiberflat of each fiber and rejects the pixels
+    with fiberflat_ivar*(fiberflat-smooth)**2>nsig**2, at most 5 per fiber and
+    per iteration, until no pixel is rejected.
+
+    fiberflat_ivar of the rejected pixels of fibers is set to 0 in place.
+    Returns the 2D[len(fibers),nwave] boolean array of the rejected pixels and
+    the number of iterations with rejected pixels of each fiber.
+    """
+    nwave = fiberflat.shape[1]
+    rejected = np.zeros((fibers.size,nwave),dtype=bool)
+    niter = np.zeros(fibers.size,dtype=int)
+    all_pixels = np.ones(nwave,dtype=bool)
+    active = np.arange(fibers.size)
+    for iteration in range(max_iterations) :
+        if active.size == 0 :
+            break
+        smooth = np.array([spline_fitter.refit(fibers[i],fiberflat[fibers[i]],fiberflat_ivar[fibers[i]],valid=all_pixels) for i in active])
+        chi2 = fiberflat_ivar[fibers[active]]*(fiberflat[fibers[active]]-smooth)**2
+        bad = _worst_pixels(chi2,nsig**2)
+        keep = np.any(bad,axis=1)
+        active = active[keep]
+        bad = bad[keep]
+        rows = fibers[active]
+        fiberflat_ivar[rows] = np.where(bad,0.,fiberflat_ivar[rows])
+        rejected[active] |= bad
+        niter[active] += 1
+    return rejected, niter
+
+
 def compute_fiberflat(frame, nsig_clipping=4., accuracy=5.e-4, minval=0.1, maxval=10.) :
     """Compute fiber flat by deriving an average spectrum and dividing all fiber data by this average.
     Input data are expected to be on the same wavelength grid, with uncorrelated noise.
@@ -74,7 +141,7 @@ def compute_fiberflat(frame, nsig_clipping=4., accuracy=5.e-4, minval=0.1, maxva
     #
     # A = sum_(fiber f) R'_f R'_f^T
     # B = sum_(fiber f) R'_f D'_f
-    # (it's faster that way, and we try to use sparse matrices as much as possible)
+    # (A is banded, it is filled and solved by desispec.deconvolution.MeanSpectrumSolver)
     #
 
     #- Shortcuts
@@ -111,20 +178,21 @@ def compute_fiberflat(frame, nsig_clipping=4., accuracy=5.e-4, minval=0.1, maxva
     # 1st pass is median for spectrum, flat field without resolution
     # outlier rejection
     
+    # the smooth fiberflat of all fibers are fitted at once, and refitted
+    # cheaply when a few pixels are rejected
+    spline_fitter=SplineFitter(wave,100.)
+
     for iteration in range(max_iterations) :
         
         # use median for spectrum
-        mean_spectrum=np.zeros((flux.shape[1]))
-        for i in range(flux.shape[1]) :
-            ok=np.where(ivar[:,i]>0)[0]
-            if ok.size > 0 :
-                mean_spectrum[i]=np.median(flux[ok,i])
+        mean_spectrum=_masked_column_median(flux,ivar>0)
                 
         # max pixels far from mean spectrum.
         #log.info("mask pixels with difference smaller than %f or larger than %f of mean")
+        # (note that only the last fiber is tested here)
         nout_iter=0
-        for fiber in range(nfibers) :
-            bad=np.where((ivar[fiber]>0)&((flux[fiber]>maxval*mean_spectrum)|(flux[fiber]<minval*mean_spectrum)))[0]
+        fiber=nfibers-1
+        bad=np.where((ivar[fiber]>0)&((flux[fiber]>maxval*mean_spectrum)|(flux[fiber]<minval*mean_spectrum)))[0]
         if bad.size>100 :
             log.warning("masking fiber %d because of bad flat field with %d bad pixels"%(fiber,bad.size))
             ivar[fiber]=0.                
@@ -136,22 +204,19 @@ def compute_fiberflat(frame, nsig_clipping=4., accuracy=5.e-4, minval=0.1, maxva
         # fit smooth fiberflat and compute chi2
         smoothing_res=100. #A
         
-        for fiber in range(nfibers) :
-            
-            if np.sum(ivar[fiber]>0)==0 :
-                continue
-
-            F = np.ones((flux.shape[1]))
-            ok=np.where((mean_spectrum!=0)&(ivar[fiber]>0))[0]
-            F[ok] = flux[fiber,ok]/mean_spectrum[ok]
-            smooth_fiberflat[fiber]=spline_fit(wave,wave[ok],F[ok],smoothing_res,ivar[fiber,ok])
-            
+        F = np.ones((flux.shape))
+        F_ivar = ivar*(mean_spectrum!=0)
+        ok = (F_ivar>0)
+        F[ok] = (flux/(mean_spectrum+(mean_spectrum==0)))[ok]
+        smooth_fit = spline_fitter.fit(F,F_ivar)
+        fitted = np.any(ok,axis=1)
+        smooth_fiberflat[fitted] = smooth_fit[fitted]
+        
         
         # normalize to get a mean fiberflat=1
         mean=np.mean(smooth_fiberflat,axis=0)
         ok=np.where(mean!=0)[0]
-        for fiber in range(nfibers) :
-            smooth_fiberflat[fiber,ok] = smooth_fiberflat[fiber,ok]/mean[ok]
+        smooth_fiberflat[:,ok] /= mean[ok]
         mean_spectrum *= mean
                 
         
@@ -171,22 +236,22 @@ def compute_fiberflat(frame, nsig_clipping=4., accuracy=5.e-4, minval=0.1, maxva
         if True :  
             nsig_clipping_for_this_pass = nsig_clipping
             
-            # not more than 5 pixels per fiber at a time
-            for fiber in range(nfibers) :
-                for loop in range(max_iterations) :
-                    bad=np.where(chi2[fiber]>nsig_clipping_for_this_pass**2)[0]
-                    if bad.size>0 :                
-                        if bad.size>5 : # not more than 5 pixels at a time
-                            ii=np.argsort(chi2[fiber,bad])
-                            bad=bad[ii[-5:]]
-                        ivar[fiber,bad] = 0
-                        nout_iter += bad.size
-                        ok=np.where((mean_spectrum!=0)&(ivar[fiber]>0))[0]
-                        F[ok] = flux[fiber,ok]/mean_spectrum[ok]
-                        smooth_fiberflat[fiber]=spline_fit(wave,wave[ok],F[ok],smoothing_res,ivar[fiber,ok])
-                        chi2[fiber]=ivar[fiber]*(flux[fiber]-smooth_fiberflat[fiber]*mean_spectrum)**2
-                    else :
-                        break
+            # not more than 5 pixels per fiber at a time, all fibers at once
+            ok = (mean_spectrum!=0)&(ivar>0)
+            F[ok] = (flux/(mean_spectrum+(mean_spectrum==0)))[ok]
+            fibers=np.arange(nfibers)
+            for loop in range(max_iterations) :
+                bad=_worst_pixels(chi2[fibers],nsig_clipping_for_this_pass**2)
+                keep=np.any(bad,axis=1)
+                fibers=fibers[keep]
+                if fibers.size==0 :
+                    break
+                bad=bad[keep]
+                ivar[fibers] = np.where(bad,0.,ivar[fibers])
+                nout_iter += np.sum(bad)
+                for fiber in fibers :
+                    smooth_fiberflat[fiber]=spline_fitter.refit(fiber,F[fiber],ivar[fiber]*(mean_spectrum!=0))
+                chi2[fibers]=ivar[fibers]*(flux[fibers]-smooth_fiberflat[fibers]*mean_spectrum)**2
         
             nout_tot += nout_iter
 
@@ -208,51 +273,27 @@ def compute_fiberflat(frame, nsig_clipping=4., accuracy=5.e-4, minval=0.1, maxva
     log.info("after 1st pass : nout = %d/%d"%(np.sum(ivar==0),np.size(ivar.flatten())))
     
     # 2nd pass is full solution including deconvolved spectrum, no outlier rejection
+    solver=MeanSpectrumSolver(frame.resolution_data)
     for iteration in range(max_iterations) : 
         
         log.info("2nd pass, iter %d : mean deconvolved spectrum"%iteration)
         
         # fit mean spectrum
-        A=scipy.sparse.lil_matrix((nwave,nwave)).tocsr()
-        B=np.zeros((nwave))
-
-        # diagonal sparse matrix with content = sqrt(ivar)*flat of a given fiber
-        SD=scipy.sparse.lil_matrix((nwave,nwave))
+        # (the normal equations are filled in banded form for all fibers at once)
+        solver.fill(ivar,flux,scale=smooth_fiberflat)
+        mean_spectrum=solver.solve()
 
-        # this is to go a bit faster
-        sqrtwflat=np.sqrt(ivar)*smooth_fiberflat
-        
-        # loop on fiber to handle resolution (this is long)
-        for fiber in range(nfibers) :
-            if fiber%10==0 :
-                log.info("2nd pass, filling matrix, iter %d fiber %d"%(iteration,fiber))
-                
-            ### R = Resolution(resolution_data[fiber])
-            R = frame.R[fiber]                
-            SD.setdiag(sqrtwflat[fiber])
+        # mean spectrum convolved with the resolution of each fiber
+        convolved_mean_spectrum=solver.model(mean_spectrum)
 
-            sqrtwflatR = SD*R # each row r of R is multiplied by sqrtwflat[r]
-                
-            A = A+(sqrtwflatR.T*sqrtwflatR).tocsr()
-            B += sqrtwflatR.T.dot(np.sqrt(ivar[fiber])*flux[fiber])
-            
-        mean_spectrum=cholesky_solve(A.todense(),B)
-            
-            
         # fit smooth fiberflat
         smoothing_res=100. #A
 
-        for fiber in range(nfibers) :
-
-            if np.sum(ivar[fiber]>0)==0 :
-                continue
-            
-            ### R = Resolution(resolution_data[fiber])
-            R = frame.R[fiber]
-            
-            M = R.dot(mean_spectrum)            
-            ok=np.where(M!=0)[0]
-            smooth_fiberflat[fiber]=spline_fit(wave,wave[ok],flux[fiber,ok]/M[ok],smoothing_res,ivar[fiber,ok])
+        M = convolved_mean_spectrum
+        ok = (M!=0)
+        smooth_fit = spline_fitter.fit(flux/(M+(M==0)),ivar,valid=ok)
+        fitted = np.any(ok&(ivar>0),axis=1)
+        smooth_fiberflat[fitted] = smooth_fit[fitted]
         
         # normalize to get a mean fiberflat=1
         mean=np.mean(smooth_fiberflat,axis=0)
@@ -294,37 +335,42 @@ def compute_fiberflat(frame, nsig_clipping=4., accuracy=5.e-4, minval=0.1, maxva
     ivar=frame.ivar
     
     fiberflat_mask=12 # place holder for actual mask bit when defined
+
+    convolved_mean_spectrum=solver.model(mean_spectrum)
     
     nsig_for_mask=nsig_clipping # only mask out N sigma outliers
 
-    for fiber in range(nfibers) :
-        
-        if np.sum(ivar[fiber]>0)==0 :
-            continue
+    fibers=np.where(np.sum(ivar>0,axis=1)>0)[0]
+    M = convolved_mean_spectrum[fibers]
+    fiberflat[fibers] = (M!=0)*flux[fibers]/(M+(M==0)) + (M==0)
+    fiberflat_ivar[fibers] = ivar[fibers]*M**2
+
+    # iterative clipping of all fibers at once, with the current smoothing
+    # resolution. The resolution is changed below by the fibers with long
+    # segments of bad pixels, in which case the clipping of the following
+    # fibers is redone individually with the new resolution.
+    clipping_res=smoothing_res
+    if spline_fitter.required_resolution != clipping_res :
+        spline_fitter=SplineFitter(wave,clipping_res)
+    clipped_ivar=fiberflat_ivar.copy()
+    clipped,clipping_iterations=_clip_smooth_fiberflat(spline_fitter,fibers,fiberflat,clipped_ivar,nsig_for_mask)
+    spline_fitters={clipping_res:spline_fitter}
+
+    for index,fiber in enumerate(fibers) :
+
+        if smoothing_res == clipping_res :
+            bad=clipped[index]
+            iteration=clipping_iterations[index]
+            fiberflat_ivar[fiber]=clipped_ivar[fiber]
+        else :
+            if smoothing_res not in spline_fitters :
+                spline_fitters[smoothing_res]=SplineFitter(wave,smoothing_res)
+            bad,iteration=_clip_smooth_fiberflat(spline_fitters[smoothing_res],fibers[index:index+1],fiberflat,fiberflat_ivar,nsig_for_mask)
+            bad=bad[0]
+            iteration=iteration[0]
+        mask[fiber,bad] += fiberflat_mask
+        nbad_tot=np.sum(bad)
 
-        ### R = Resolution(resolution_data[fiber])
-        R = frame.R[fiber]
-        M = np.array(np.dot(R.todense(),mean_spectrum)).flatten()
-        fiberflat[fiber] = (M!=0)*flux[fiber]/(M+(M==0)) + (M==0)
-        fiberflat_ivar[fiber] = ivar[fiber]*M**2
-        nbad_tot=0
-        iteration=0
-        while iteration<500 :
-            smooth_fiberflat=spline_fit(wave,wave,fiberflat[fiber],smoothing_res,fiberflat_ivar[fiber])
-            chi2=fiberflat_ivar[fiber]*(fiberflat[fiber]-smooth_fiberflat)**2
-            bad=np.where(chi2>nsig_for_mask**2)[0]
-            if bad.size>0 :
-                
-                if bad.size>5 : # not more than 5 pixels at a time
-                    ii=np.argsort(chi2[bad])
-                    bad=bad[ii[-5:]]
-                
-                mask[fiber,bad] += fiberflat_mask
-                fiberflat_ivar[fiber,bad] = 0.
-                nbad_tot += bad.size
-            else :
-                break
-            iteration += 1
         # replace bad by smooth fiber flat
         bad=np.where((mask[fiber]>0)|(fiberflat_ivar[fiber]==0)|(fiberflat[fiber]<minval)|(fiberflat[fiber]>maxval))[0]
         if bad.size>0 :
@@ -332,18 +378,7 @@ def compute_fiberflat(frame, nsig_clipping=4., accuracy=5.e-4, minval=0.1, maxva
             fiberflat_ivar[fiber,bad] = 0
 
             # find max length of segment with bad pix
-            length=0
-            for i in range(bad.size) :
-                ib=bad[i]
-                ilength=1
-                tmp=ib
-                for jb in bad[i+1:] :
-                    if jb==tmp+1 :
-                        ilength +=1
-                        tmp=jb
-                    else :
-                        break
-                length=max(length,ilength)
+            length=_max_run_length(bad)
             if length>10 :
                 log.info("3rd pass : fiber #%d has a max length of bad pixels=%d"%(fiber,length))
             smoothing_res=float(max(100,2*length))
@@ -359,14 +394,9 @@ def compute_fiberflat(frame, nsig_clipping=4., accuracy=5.e-4, minval=0.1, maxva
     # set median flat to 1
     log.info("set median fiberflat to 1")
     
-    mean=np.ones((flux.shape[1]))
-    for i in range(flux.shape[1]) :
-        ok=np.where((mask[:,i]==0)&(ivar[:,i]>0))[0]
-        if ok.size > 0 :
-            mean[i] = np.median(fiberflat[ok,i])
+    mean=_masked_column_median(fiberflat,(mask==0)&(ivar>0),default=1.)
     ok=np.where(mean!=0)[0]
-    for fiber in range(nfibers) :
-        fiberflat[fiber,ok] /= mean[ok]
+    fiberflat[:,ok] /= mean[ok]
 
     log.info("done fiberflat")
 
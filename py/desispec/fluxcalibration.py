@@ -6,9 +6,10 @@ Flux calibration routines.
 """
 from __future__ import absolute_import
 import numpy as np
-from .resolution import Resolution
-from .linalg import cholesky_solve, cholesky_solve_and_invert, spline_fit
+from .resolution import Resolution, ResolutionStack
+from .linalg import banded_sandwich_diagonal
 from .interpolation import resample_flux
+from .deconvolution import MeanSpectrumSolver
 from .log import get_logger
 from .io.filters import load_filter
 from desispec import util
@@ -27,7 +28,8 @@ def rebinSpectra(spectra,oldWaveBins,newWaveBins):
     return specnew
 
 def applySmoothingFilter(flux):
-    return scipy.ndimage.filters.median_filter(flux,200)
+    # (along the wavelength axis only for 2D[nspec,nwave] flux)
+    return scipy.ndimage.filters.median_filter(flux,size=(1,)*(np.ndim(flux)-1)+(200,))
 #
 # Import some global constants.
 #
@@ -50,23 +52,43 @@ except TypeError:
     hc = 1.9864458241717586e-08
 
 def compute_chi2(wave,normalized_flux,normalized_ivar,resolution_data,shifted_stdwave,star_stdflux) :
+    """Returns the chi2 of normalized star spectra for one or several templates
+
+    All templates are resampled to the grid of each camera with one sparse
+    operator (see desispec.interpolation.get_resample_matrix), convolved by
+    the resolution with one sparse product, normalized, and compared to the
+    data at once.
+
+    Args:
+        wave, normalized_flux, normalized_ivar, resolution_data : dictionaries
+            of the 1D data of each camera, as in match_templates
+        shifted_stdwave : 1D[nstdwave] template wavelengths
+        star_stdflux : 1D[nstdwave] template flux, or 2D[ntemplates,nstdwave]
+
+    Returns:
+        chi2 (float), or 1D[ntemplates] array for 2D star_stdflux
+        (1e20 if the computation failed)
+    """
+    templates=np.atleast_2d(star_stdflux)
     chi2 = None
     try :
-        chi2=0.
+        chi2=np.zeros(templates.shape[0])
         for cam in normalized_flux:
-            tmp=resample_flux(wave[cam],shifted_stdwave,star_stdflux) # this is slow
-            model=Resolution(resolution_data[cam]).dot(tmp) # this is slow
-            tmp=applySmoothingFilter(model) # this is fast
+            tmp=resample_flux(wave[cam],shifted_stdwave,templates)
+            model=Resolution(resolution_data[cam]).dot(tmp.T).T
+            tmp=applySmoothingFilter(model)
             normalized_model = model/(tmp+(tmp==0))
-            chi2 += np.sum(normalized_ivar[cam]*(normalized_flux[cam]-normalized_model)**2)
+            chi2 += np.sum(normalized_ivar[cam]*(normalized_flux[cam]-normalized_model)**2,axis=1)
     except :
-        chi2 = 1e20
+        chi2 = 1e20*np.ones(templates.shape[0])
+    if np.ndim(star_stdflux) == 1 :
+        return chi2[0]
     return chi2
 
 def _func(arg) :
     return compute_chi2(**arg)
 
-def match_templates(wave, flux, ivar, resolution_data, stdwave, stdflux, teff, logg, feh, ncpu=1, z_max=0.005, z_res=0.00005):
+def match_templates(wave, flux, ivar, resolution_data, stdwave, stdflux, teff, logg, feh, ncpu=1, z_max=0.005, z_res=0.00005, pool=None):
     """For each input spectrum, identify which standard star template is the closest
     match, factoring out broadband throughput/calibration differences.
 
@@ -81,6 +103,8 @@ def match_templates(wave, flux, ivar, resolution_data, stdwave, stdflux, teff, l
         logg : 1D[nstd] model surface gravity
         feh : 1D[nstd] model metallicity
         ncpu : number of cpu for multiprocessing
+        pool : optional multiprocessing pool (with ncpu processes) used
+            instead of creating one for this call
 
     Returns:
         index : index of standard star
@@ -195,30 +219,32 @@ def match_templates(wave, flux, ivar, resolution_data, stdwave, stdflux, teff, l
     nstars=stdflux.shape[0]
     shifted_stdwave=stdwave/(1+z)
 
+    # all the templates are evaluated at once, split in one chunk per process
     func_args = []
-    # need to parallelize this
-    for star in range(nstars) :
+    for chunk in np.array_split(np.arange(nstars),max(1,min(ncpu,nstars))) :
         arguments={"wave":wave,
                    "normalized_flux":normalized_flux,
                    "normalized_ivar":normalized_ivar,
                    "resolution_data":resolution_data,
                    "shifted_stdwave":shifted_stdwave,
-                   "star_stdflux":stdflux[star]}
+                   "star_stdflux":stdflux[chunk]}
         func_args.append( arguments )
 
-    if ncpu > 1:
-        log.debug("creating multiprocessing pool with %d cpus"%ncpu); sys.stdout.flush()
-        pool = multiprocessing.Pool(ncpu)
-        log.debug("Running pool.map() for {} items".format(len(func_args))); sys.stdout.flush()
-        model_chi2 =  pool.map(_func, func_args)
+    if len(func_args) > 1:
+        own_pool = pool is None
+        if own_pool :
+            log.debug("creating multiprocessing pool with %d cpus"%ncpu); sys.stdout.flush()
+            pool = multiprocessing.Pool(ncpu)
+        log.debug("Running pool.map() for {} chunks".format(len(func_args))); sys.stdout.flush()
+        model_chi2 =  np.concatenate(pool.map(_func, func_args))
         log.debug("Finished pool.map()"); sys.stdout.flush()
-        pool.close()
-        pool.join()
-        log.debug("Finished pool.join()"); sys.stdout.flush()
+        if own_pool :
+            pool.close()
+            pool.join()
+            log.debug("Finished pool.join()"); sys.stdout.flush()
     else:
-        log.debug("Not using multiprocessing for {} cpus".format(ncpu))
-        model_chi2 = [_func(x) for x in func_args]
-        log.debug("Finished serial loop over compute_chi2")
+        model_chi2 = _func(func_args[0])
+        log.debug("Finished compute_chi2 of {} templates".format(nstars))
         
     best_model_id=np.argmin(np.array(model_chi2))
     best_chi2=model_chi2[best_model_id]
@@ -318,11 +344,8 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,nsig_clipp
     nstds=stdstars.flux.shape[0]
 
     # resample model to data grid and convolve by resolution
-    model_flux=np.zeros((nstds, nwave))
-    convolved_model_flux=np.zeros((nstds, nwave))
-    for fiber in range(model_flux.shape[0]) :
-        model_flux[fiber]=resample_flux(stdstars.wave,input_model_wave,input_model_flux[fiber])
-        convolved_model_flux[fiber]=stdstars.R[fiber].dot(model_flux[fiber])
+    model_flux=resample_flux(stdstars.wave,input_model_wave,input_model_flux[:nstds])
+    convolved_model_flux=stdstars.R.dot(model_flux)
 
     # iterative fitting and clipping to get precise mean spectrum
     current_ivar=stdstars.ivar.copy()
@@ -336,16 +359,10 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,nsig_clipp
     smooth_fiber_correction=np.ones((stdstars.flux.shape))
     chi2=np.zeros((stdstars.flux.shape))
 
-    # chi2 = sum w ( data_flux - R*(calib*model_flux))**2
-    # chi2 = sum (sqrtw*data_flux -diag(sqrtw)*R*diag(model_flux)*calib)
-
-    sqrtw=np.sqrt(current_ivar)
-    #sqrtwmodel=np.sqrt(current_ivar)*convolved_model_flux # used only for QA
-    sqrtwflux=np.sqrt(current_ivar)*stdstars.flux
-
-    # diagonal sparse matrices
-    D1=scipy.sparse.lil_matrix((nwave,nwave))
-    D2=scipy.sparse.lil_matrix((nwave,nwave))
+    # chi2 = sum w ( data_flux - smooth_fiber_correction*R*(calib*model_flux))**2
+    # the normal equations of calib are banded, the model flux enters
+    # as a diagonal matrix applied before the resolution
+    solver = MeanSpectrumSolver(stdstars.resolution_data, column_scale=model_flux)
 
     # test
     # nstds=20
@@ -353,35 +370,21 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,nsig_clipp
     for iteration in range(20) :
 
         # fit mean calibration
-        A=scipy.sparse.lil_matrix((nwave,nwave)).tocsr()
-        B=np.zeros((nwave))
-
-        # loop on fiber to handle resolution
-        for fiber in range(nstds) :
-            if fiber%10==0 :
-                log.info("iter %d fiber %d"%(iteration,fiber))
-
-            R = stdstars.R[fiber]
-
-            # diagonal sparse matrix with content = sqrt(ivar)*flat
-            D1.setdiag(sqrtw[fiber]*smooth_fiber_correction[fiber])
-            D2.setdiag(model_flux[fiber])
-            sqrtwmodelR = D1.dot(R.dot(D2)) # chi2 = sum (sqrtw*data_flux -diag(sqrtw)*smooth_fiber_correction*R*diag(model_flux)*calib )
-
-            A = A+(sqrtwmodelR.T*sqrtwmodelR).tocsr()
-            B += sqrtwmodelR.T*sqrtwflux[fiber]
+        log.info("iter %d filling banded matrix"%iteration)
+        solver.fill(current_ivar,stdstars.flux,scale=smooth_fiber_correction)
 
         #- Add a weak prior that calibration = median_calib
         #- to keep A well conditioned
         minivar = np.min(current_ivar[current_ivar>0])
         log.debug('min(ivar[ivar>0]) = {}'.format(minivar))
         epsilon = minivar/10000
-        A = epsilon*np.eye(nwave) + A   #- converts sparse A -> dense A
-        B += median_calib*epsilon
+        solver.set_prior(epsilon, median_calib)
 
         log.info("iter %d solving"%iteration)
-        ### log.debug('cond(A) {:g}'.format(np.linalg.cond(A)))
-        calibration=cholesky_solve(A, B)
+        calibration=solver.solve()
+
+        # R*(calibration*model_flux) for all fibers
+        convolved_calib_model=solver.model(calibration)
 
         log.info("iter %d fit smooth correction per fiber"%iteration)
         # fit smooth fiberflat and compute chi2
@@ -389,7 +392,7 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,nsig_clipp
             if fiber%10==0 :
                 log.info("iter %d fiber %d(smooth)"%(iteration,fiber))
 
-            M = stdstars.R[fiber].dot(calibration*model_flux[fiber])
+            M = convolved_calib_model[fiber]
 
             pol=np.poly1d(np.polyfit(stdstars.wave,stdstars.flux[fiber]/(M+(M==0)),deg=1,w=current_ivar[fiber]*M**2))
             smooth_fiber_correction[fiber]=pol(stdstars.wave)
@@ -407,18 +410,12 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,nsig_clipp
             for i in selection :
                 worst_entry=np.argmax(chi2[:,i])
                 current_ivar[worst_entry,i]=0
-                sqrtw[worst_entry,i]=0
-                #sqrtwmodel[worst_entry,i]=0
-                sqrtwflux[worst_entry,i]=0
                 nout_iter += 1
 
         else :
             # remove all of them at once
             bad=(chi2>nsig_clipping**2)
             current_ivar *= (bad==0)
-            sqrtw *= (bad==0)
-            #sqrtwmodel *= (bad==0)
-            sqrtwflux *= (bad==0)
             nout_iter += np.sum(bad)
 
         nout_tot += nout_iter
@@ -445,42 +442,35 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,nsig_clipp
     log.info("nout tot=%d"%nout_tot)
 
     # solve once again to get deconvolved variance
-    #calibration,calibcovar=cholesky_solve_and_invert(A.todense(),B)
-    calibcovar=np.linalg.inv(A)
-    calibvar=np.diagonal(calibcovar)
+    calibcovar=solver.covariance()
+    calibvar=np.array(calibcovar[-1])
     log.info("mean(var)={0:f}".format(np.mean(calibvar)))
 
-    calibvar=np.array(np.diagonal(calibcovar))
-    # apply the mean (as in the iterative loop)
-    calibvar *= mean**2
-    calibivar=(calibvar>0)/(calibvar+(calibvar==0))
-
     # we also want to save the convolved calibration and a calibration variance
     # first compute average resolution
     mean_res_data=np.mean(frame.resolution_data,axis=0)
     R = Resolution(mean_res_data)
-    # compute convolved calib
-    ccalibration = np.zeros(frame.flux.shape)
-    for i in range(frame.nspec):
-        ccalibration[i]=frame.R[i].dot(calibration)/frame.R[i].dot(np.ones(calibration.shape))
 
     # Use diagonal of mean calibration covariance for output.
-    ccalibcovar=R.dot(calibcovar).dot(R.T.todense())
-    ccalibvar=np.array(np.diagonal(ccalibcovar))
+    ccalibvar=banded_sandwich_diagonal(R,calibcovar)
 
     # apply the mean (as in the iterative loop)
     ccalibvar *= mean**2
     ccalibivar=(ccalibvar>0)/(ccalibvar+(ccalibvar==0))
 
-    # convert to 2D
-    # For now this is the same for all fibers; in the future it may not be
-    ccalibivar = np.tile(ccalibivar, frame.nspec).reshape(frame.nspec, frame.nwave)
+    # scale the band of the covariance like its diagonal, C_ij*mean_i*mean_j
+    u=calibcovar.shape[0]-1
+    for k in range(u+1):
+        d=u-k
+        calibcovar[k,d:] *= mean[d:]*mean[:nwave-d]
 
     # need to do better here
     mask = (ccalibivar==0).astype(np.int32)
 
-    # return calibration, calibivar, mask, ccalibration, ccalibivar
-    return FluxCalib(stdstars.wave, ccalibration, ccalibivar, mask, R.dot(calibration))
+    # ccalibivar is the same for all fibers; the convolved calibration of each
+    # fiber, frame.R.dot(calibration)/frame.R.dot(ones), is only computed when accessed
+    return CompactFluxCalib(stdstars.wave, calibration, calibcovar, ccalibivar, mask,
+                            resolution_data=frame.resolution_data, meancalib=R.dot(calibration))
 
 
 
@@ -514,6 +504,73 @@ class FluxCalib(object):
         self.mask = util.mask32(mask)
         self.meancalib = meancalib
 
+class CompactFluxCalib(FluxCalib):
+    def __init__(self, wave, deconvolved, covariance, mean_ivar, mean_mask,
+                 resolution_data=None, nspec=None, meancalib=None):
+        """Flux calibration stored as the deconvolved calibration shared by
+        all fibers
+
+        Args:
+            wave : 1D[nwave] input wavelength (Angstroms)
+            deconvolved : 1D[nwave] deconvolved calibration
+            covariance : 2D[ncov, nwave] band of the covariance of the
+                deconvolved calibration, in upper banded storage
+                (see :meth:`desispec.deconvolution.MeanSpectrumSolver.covariance`)
+            mean_ivar : 1D[nwave] inverse variance of the calibration
+                convolved with the mean resolution of the frame
+            mean_mask : 1D[nwave] mask of calib (0=good)
+            resolution_data : 3D[nspec, ndiag, nwave] resolution of the
+                fibers of the frame (optional)
+            nspec : number of fibers, if resolution_data is None (optional)
+            meancalib : 1D[nwave] mean convolved calibration (optional)
+
+        All arguments become attributes.  The 2D[nspec, nwave] calib, ivar
+        and mask of FluxCalib are computed when first accessed; calib
+        requires resolution_data, which can be set from the frame after
+        reading a compact calibration file.  ivar and mask are read-only
+        views of mean_ivar and mean_mask.
+        """
+        assert wave.ndim == 1
+        assert deconvolved.shape == wave.shape
+        assert mean_ivar.shape == wave.shape
+        assert mean_mask.shape == wave.shape
+        assert np.all(mean_ivar >= 0)
+        if resolution_data is not None:
+            nspec = resolution_data.shape[0]
+
+        self.nspec = nspec
+        self.nwave = wave.size
+        self.wave = wave
+        self.deconvolved = deconvolved
+        self.covariance = covariance
+        self.mean_ivar = mean_ivar
+        self.mean_mask = util.mask32(mean_mask)
+        self.resolution_data = resolution_data
+        self.meancalib = meancalib
+        self._calib = None
+
+    def convolved(self, R):
+        """Returns 2D[nspec, nwave] calibration of the fibers of
+        ResolutionStack R, R_f.deconvolved/R_f.1"""
+        return R.dot(self.deconvolved)/R.dot(np.ones(self.nwave))
+
+    @property
+    def calib(self):
+        if self._calib is None:
+            if self.resolution_data is None:
+                raise AttributeError("CompactFluxCalib has no resolution_data")
+            self._calib = self.convolved(ResolutionStack(self.resolution_data))
+        return self._calib
+
+    @property
+    def ivar(self):
+        return np.broadcast_to(self.mean_ivar, (self.nspec, self.nwave))
+
+    @property
+    def mask(self):
+        return np.broadcast_to(self.mean_mask, (self.nspec, self.nwave))
+
+
 def apply_flux_calibration(frame, fluxcalib):
     """
     Applies flux calibration to input flux and ivar
@@ -523,6 +580,9 @@ def apply_flux_calibration(frame, fluxcalib):
         fluxcalib : FluxCalib object with wave, calib, ...
 
     Modifies frame.flux and frame.ivar
+
+    A CompactFluxCalib is convolved with the resolution of the frame without
+    expanding its per-fiber arrays.
     """
     log=get_logger()
     log.info("starting")
@@ -533,9 +593,6 @@ def apply_flux_calibration(frame, fluxcalib):
         log.error("not same wavelength (should raise an error instead)")
         sys.exit(12)
 
-    nwave=frame.nwave
-    nfibers=frame.nspec
-
     """
     F'=F/C
     Var(F') = Var(F)/C**2 + F**2*(  d(1/C)/dC )**2*Var(C)
@@ -548,9 +605,14 @@ def apply_flux_calibration(frame, fluxcalib):
     #     flux[fiber]=frame.flux[fiber]*(C>0)/(C+(C==0))
     #     ivar[fiber]=(ivar[fiber]>0)*(civar[fiber]>0)*(C>0)/(   1./((ivar[fiber]+(ivar[fiber]==0))*(C**2+(C==0))) + flux[fiber]**2/(civar[fiber]*C**4+(civar[fiber]*(C==0)))   )
 
-    C = fluxcalib.calib
+    if isinstance(fluxcalib, CompactFluxCalib):
+        C = fluxcalib.convolved(frame.R)
+        civar = fluxcalib.mean_ivar
+    else:
+        C = fluxcalib.calib
+        civar = fluxcalib.ivar
     frame.flux = frame.flux * (C>0) / (C+(C==0))
-    frame.ivar = (frame.ivar>0) * (fluxcalib.ivar>0) * (C>0) / (1./((frame.ivar+(frame.ivar==0))*(C**2+(C==0))) + frame.flux**2/(fluxcalib.ivar*C**4+(fluxcalib.ivar*(C==0)))   )
+    frame.ivar = (frame.ivar>0) * (civar>0) * (C>0) / (1./((frame.ivar+(frame.ivar==0))*(C**2+(C==0))) + frame.flux**2/(civar*C**4+(civar*(C==0)))   )
 
 
 def ZP_from_calib(wave, calib):
@@ -595,6 +657,8 @@ def qa_fluxcalib(param, frame, fluxcalib):
     stdfibers = np.where((frame.fibermap['OBJTYPE'] == 'STD'))[0]
     stdstars = frame[stdfibers]
     nstds = len(stdfibers)
+    if isinstance(fluxcalib, CompactFluxCalib) and fluxcalib.resolution_data is None:
+        fluxcalib.resolution_data = frame.resolution_data
     #try:
     #    assert np.array_equal(frame.fibers[stdfibers], input_model_fibers)
     #except AssertionError:
@@ -8,7 +8,7 @@ import numbers
 import numpy as np
 
 from desispec import util
-from desispec.resolution import Resolution
+from desispec.resolution import ResolutionStack
 from desispec.coaddition import Spectrum
 from desispec.log import get_logger
 from desispec import util
@@ -73,8 +73,8 @@ class Frame(object):
             nspec : number of spectra, flux.shape[0]
             nwave : number of wavelengths, flux.shape[1]
             specmin : minimum fiber number
-            R: array of sparse Resolution matrix objects converted
-               from resolution_data
+            R: ResolutionStack of resolution_data, created when first
+               accessed; R[i] is the sparse Resolution matrix of spectrum i
             fibermap: fibermap table if provided
         """
         assert wave.ndim == 1
@@ -108,8 +108,6 @@ class Frame(object):
 
         #- Maybe setup non-None identity matrix resolution matrix instead?
         self.resolution_data = resolution_data
-        if resolution_data is not None:
-            self.R = np.array( [Resolution(r) for r in resolution_data] )
 
         self.spectrograph = spectrograph
 
@@ -139,6 +137,13 @@ class Frame(object):
         if self.meta is not None:
             self.meta['FIBERMIN'] = np.min(self.fibers)
          
+    @property
+    def R(self):
+        """ResolutionStack of resolution_data (not available if resolution_data is None)"""
+        if self.resolution_data is None:
+            raise AttributeError("Frame has no resolution_data")
+        return ResolutionStack(self.resolution_data)
+
     def __getitem__(self, index):
         """
         Return a subset of the spectra on this frame
@@ -5,8 +5,11 @@ desispec.interpolation
 Utility functions for interpolation of spectra over different wavelength grids.
 """
 
+import collections
+import hashlib
 import numpy as np
-import sys
+import scipy.sparse
+import threading
 from desispec.log import get_logger
 
 #import time # for debugging
@@ -102,6 +105,10 @@ def resample_flux(xout, x, flux, ivar=None):
         if ivar is None, returns outflux
         if ivar is not None, returns outflux, outivar
 
+    flux (and ivar) can also be 2D[nspec, nwave] arrays of spectra sharing the
+    same input grid x, in which case they are all resampled at once with the
+    cached sparse operator of :func:`get_resample_matrix`.
+
     This interpolation conserves flux such that, on average,
     output_flux_density = input_flux_density
 
@@ -126,6 +133,9 @@ def resample_flux(xout, x, flux, ivar=None):
 
     """
 
+    if np.ndim(flux) == 2:
+        return _resample_flux_2d(xout, x, flux, ivar)
+
     if ivar is None:
         return _unweighted_resample(xout, x, flux)
     else:
@@ -230,3 +240,126 @@ def _unweighted_resample(output_x,input_x,input_flux_density) :
     of = np.histogram(tx, edges, weights=trapeze_integrals)[0] / binsize
 
     return of
+
+
+#: Maximum number of operators kept by :func:`cached_grid_operator`, for
+#: :func:`get_resample_matrix` and :func:`desispec.coaddition.get_resampling_matrix`.
+grid_operator_cache_size = 8
+
+_grid_operator_cache = collections.OrderedDict()
+_grid_operator_lock = threading.Lock()
+
+def _grid_key(grid):
+    """Return a hashable key identifying the values of a grid."""
+    grid = np.ascontiguousarray(grid,dtype=float)
+    return (len(grid),hashlib.sha1(grid.tobytes()).hexdigest())
+
+def cached_grid_operator(build,output_x,input_x) :
+    """Returns build(output_x,input_x), reusing the operator built for the same grids.
+
+    The most recently used operators are cached, keyed on the build function and
+    a hash of the two grids, so that an operator applied to many spectra with the
+    same grids is only built once. The cache can be used from several threads.
+
+    Args:
+        build: function of (output_x,input_x) returning an operator
+        output_x: vector of the output grid
+        input_x: vector of the input grid
+
+    Returns:
+        the cached operator, which must not be modified
+    """
+    key = (build.__module__,build.__name__,_grid_key(output_x),_grid_key(input_x))
+    with _grid_operator_lock :
+        operator = _grid_operator_cache.pop(key,None)
+    if operator is None :
+        operator = build(output_x,input_x)
+    with _grid_operator_lock :
+        _grid_operator_cache.pop(key,None)
+        while len(_grid_operator_cache) >= grid_operator_cache_size :
+            _grid_operator_cache.popitem(last=False)
+        # Insert (or move) the operator at the most recently used end of the cache.
+        _grid_operator_cache[key] = operator
+    return operator
+
+def get_resample_matrix(output_x,input_x) :
+    """Returns the sparse operator of the flux conserving resampling.
+
+    _unweighted_resample is linear in the input flux density, so that for
+    given grids it is a (nout,nin) matrix W with output_flux = W.dot(input_flux).
+    W only has a few non-zero entries per row. It is cached with
+    :func:`cached_grid_operator`, so resampling many spectra with the same
+    grids only builds W once.
+
+    Args:
+        output_x: SORTED vector, not necessarily linearly spaced
+        input_x: SORTED vector, not necessarily linearly spaced
+
+    Returns:
+        scipy.sparse.csr_matrix (nout,nin), which must not be modified
+    """
+    return cached_grid_operator(_build_resample_matrix,output_x,input_x)
+
+def _build_resample_matrix(output_x,input_x) :
+    """Build the operator returned by :func:`get_resample_matrix`, following
+    the same steps as _unweighted_resample"""
+    ix=np.asarray(input_x,dtype=float)
+    ox=np.asarray(output_x,dtype=float)
+    nin=ix.size
+
+    # temporary nodes, as in _unweighted_resample
+    oxm,oxp=bin_bounds(ox)
+    tx=np.append(oxm,oxp[-1])
+    ixmin=1.5*ix[0]-0.5*ix[1]
+    ixmax=1.5*ix[-1]-0.5*ix[-2]
+    tx=np.append(tx,ixmin)
+    tx=np.append(tx,ixmax)
+
+    # np.interp(tx,ix,.) as a sparse (ntx,nin) matrix, constant beyond the ends
+    j=np.clip(np.searchsorted(ix,tx,side='right')-1,0,nin-2)
+    w=np.clip((tx-ix[j])/(ix[j+1]-ix[j]),0.,1.)
+    rows=np.arange(tx.size)
+    prow=np.concatenate([rows,rows])
+    pcol=np.concatenate([j,j+1])
+    pval=np.concatenate([1-w,w])
+
+    # then the input nodes themselves
+    k=np.where((ix>=tx[0])&(ix<=tx[-1]))[0]
+    if k.size :
+        prow=np.concatenate([prow,tx.size+np.arange(nin)])
+        pcol=np.concatenate([pcol,np.arange(nin)])
+        pval=np.concatenate([pval,np.ones(nin)])
+        tx=np.append(tx,ix)
+    ntx=tx.size
+    p=tx.argsort()
+    tx=tx[p]
+    # row of each node after sorting
+    rank=np.empty(ntx,dtype=int)
+    rank[p]=np.arange(ntx)
+    P=scipy.sparse.csr_matrix((pval,(rank[prow],pcol)),shape=(ntx,nin))
+
+    # trapeze integrals between consecutive nodes
+    T=scipy.sparse.diags((tx[1:]-tx[:-1])/2.).dot(P[1:]+P[:-1])
+
+    # sum the trapezes in each output bin, as np.histogram does in _unweighted_resample
+    binsize = oxp - oxm
+    edges = np.concatenate([oxm, oxp[-1:]]).clip(ixmin, ixmax-1e-12*binsize[-1])
+    b=np.searchsorted(edges[:-1],tx[:-1],side='right')-1
+    ok=(b>=0)&(tx[:-1]>=edges[0])&(tx[:-1]<=edges[-1])
+    S=scipy.sparse.csr_matrix((1./binsize[b[ok]],(b[ok],np.where(ok)[0])),shape=(ox.size,ntx-1))
+    return S.dot(T).tocsr()
+
+def _resample_flux_2d(xout, x, flux, ivar=None):
+    """resample_flux for 2D[nspec, nwave] flux and ivar sharing the grid x"""
+    W = get_resample_matrix(xout, x)
+    if ivar is None:
+        return W.dot(np.asarray(flux,dtype=float).T).T
+    a = W.dot((flux*ivar).T).T
+    b = W.dot(np.asarray(ivar,dtype=float).T).T
+    mask = (b>0)
+    outflux = np.zeros(a.shape)
+    outflux[mask] = a[mask] / b[mask]
+    dx = np.gradient(x)
+    dxout = np.gradient(xout)
+    outivar = W.dot((ivar/dx).T).T*dxout
+    return outflux, outivar
@@ -14,6 +14,7 @@ from __future__ import absolute_import, division, print_function
 
 from .meta import (findfile, get_exposures, get_files, get_raw_files,
     rawdata_root, specprod_root, validate_night)
+from .fileindex import FileIndex, open_index
 from .frame import read_frame, write_frame
 from .sky import read_sky, write_sky
 from .fiberflat import read_fiberflat, write_fiberflat
@@ -23,12 +24,13 @@ from .qa import read_qa_frame, read_qa_data, write_qa_frame, write_qa_brick, loa
 from .zfind import read_zbest, write_zbest
 from .image import read_image, write_image
 from .util import (header2wave, fitsheader, native_endian, makepath,
-    write_bintable, iterfiles)
+    write_bintable, iterfiles, write_behind, flush_writes)
 from .fluxcalibration import (
-    read_stdstar_templates, write_stdstar_models, read_stdstar_models,
+    read_stdstar_templates, read_stdstar_templates_cached,
+    write_stdstar_models, read_stdstar_models,
     read_flux_calibration, write_flux_calibration)
 from .filters import load_filter
 from .download import download, filepath2url
 from .database import RawDataCursor
 from desispec.preproc import read_bias, read_pixflat, read_mask
-from desispec.io.raw import read_raw, write_raw
+from desispec.io.raw import read_raw, write_raw, iter_raw
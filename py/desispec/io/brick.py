@@ -23,6 +23,7 @@ from astropy import table
 from desiutil.depend import add_dependencies
 import desispec.io.util
 import desiutil.io
+from desispec.io.storage import get_backend, read_rows
 
 #- For backwards compatibility, derive brickname from filename
 def _parse_brick_filename(filepath):
@@ -44,24 +45,69 @@ class BrickBase(object):
     or new data to be recorded. Successful completion of the constructor does not
     guarantee that :meth:`close` will succeed.
 
+    Objects added with :meth:`add_objects` are kept as separate chunks until the
+    data of the file is accessed through :attr:`hdu_list` or the file is closed,
+    so that adding objects only costs the size of the new data.  Subclasses with
+    ``append_only = True`` write the objects added to an existing file as a new
+    group of FLUX, IVAR, RESOLUTION and FIBERMAP HDUs appended to the end of the
+    file (with EXTVER = 2, 3, ...) instead of rewriting it.  These groups are
+    concatenated with the first five HDUs when the file is read, so
+    ``hdu_list[0..4]`` always hold all the objects of the brick.  Use
+    ``close(compact=True)`` to rewrite the file with only five HDUs.
+
+    RESOLUTION HDUs written by :func:`desispec.io.util.encode_resolution` are
+    decoded when the data is first accessed.
+
+    With the ``npydir`` storage backend (see :mod:`desispec.io.storage`), the
+    brick is a directory of chunked arrays and the objects added to an existing
+    brick are appended as new chunks of its FLUX, IVAR, RESOLUTION and FIBERMAP
+    arrays, so there are no groups of HDUs to merge.  Its arrays are only read
+    when their data is accessed, and are loaded in memory when objects added
+    with :meth:`add_objects` are merged with them.
+
     Args:
         path(str): Path to the brick file to open.
         mode(str): File access mode to use. Should normally be 'readonly' or 'update'. Use 'update' to create a new file and its parent directory if necessary.
         header: header used to create a new file. See :func:`desispec.io.util.fitsheader` for details on allowed types.
             required for new files and must have BRICKNAM keyword; ignored when opening existing files
+        resolution_max_error(float): if set, the resolution data written by :meth:`close`
+            are encoded with this maximum absolute error instead of being stored as floats.
+        backend: storage backend object or name ('fits' or 'npydir') of a new file;
+            the backend of an existing file is detected from its path.
 
     Raises:
         RuntimeError: Invalid mode requested.
+        ValueError: resolution_max_error with a backend appending rows.
         IOError: Unable to open existing file in 'readonly' mode.
         OSError: Unable to create a new parent directory in 'update' mode.
     """
-    def __init__(self,path,mode = 'readonly',header = None):
+    #: Append the objects added to an existing file as new HDUs instead of rewriting it.
+    append_only = False
+
+    def __init__(self,path,mode = 'readonly',header = None,resolution_max_error = None,backend = None):
         if mode not in ('readonly','update'):
             raise RuntimeError('Invalid mode %r' % mode)
         self.path = path
         self.mode = mode
+        self.resolution_max_error = resolution_max_error
+        if os.path.exists(path):
+            self._backend = get_backend(path = path)
+        else:
+            self._backend = get_backend(backend)
+        if self._backend.appends_rows and resolution_max_error is not None:
+            raise ValueError('resolution_max_error is not supported by the {} backend'.format(self._backend.name))
+        # Chunks of (flux,ivar,resolution) added since the file was opened, and the
+        # number of them that were already merged into self._hdu_list.
+        self._chunks = [ ]
+        self._num_merged = 0
+        # Number of groups of HDUs appended to the file that are not yet merged.
+        self._num_groups = 0
+        # Index of the rows of each target, built when first needed.
+        self._target_index = None
+        self._target_lookup = None
         # Create a new file if necessary.
-        if self.mode == 'update' and not os.path.exists(self.path):
+        self._new_file = (self.mode == 'update' and not os.path.exists(self.path))
+        if self._new_file:
             # BRICKNAM must be in header if creating the file for the first time
             if header is None or 'BRICKNAM' not in header:
                 raise ValueError('header must have BRICKNAM when creating new brick file')
@@ -111,14 +157,136 @@ class BrickBase(object):
             hdu4.header['TTYPE%d' % (1+num_fibermap_columns)] = ('NIGHT','Night of exposure YYYYMMDD')
             hdu4.header['TTYPE%d' % (2+num_fibermap_columns)] = ('EXPID','Exposure ID')
             hdu4.header['TTYPE%d' % (3+num_fibermap_columns)] = ('INDEX','Index of this object in other HDUs')
-            self.hdu_list = astropy.io.fits.HDUList([hdu0,hdu1,hdu2,hdu3,hdu4])
+            self._hdu_list = astropy.io.fits.HDUList([hdu0,hdu1,hdu2,hdu3,hdu4])
         else:
-            self.hdu_list = astropy.io.fits.open(path,mode = self.mode)
+            # The file is never modified in place: updates are either appended
+            # or written to a new file by close().
+            self._hdu_list = self._backend.open_hdulist(path)
+            self._num_groups = (len(self._hdu_list) - 5)//4
             try:
-                self.brickname = self.hdu_list[0].header['BRICKNAM']
-                self.channel = self.hdu_list[0].header['CHANNEL']
+                self.brickname = self._hdu_list[0].header['BRICKNAM']
+                self.channel = self._hdu_list[0].header['CHANNEL']
             except KeyError:
                 self.channel, self.brickname = _parse_brick_filename(path)
+        # Number of groups of HDUs in the file, including the first five HDUs.
+        self._num_groups_in_file = 1 + self._num_groups
+        self._resolution_decoded = self._new_file
+
+    @property
+    def hdu_list(self):
+        """HDUList with the FLUX, IVAR, WAVELENGTH, RESOLUTION and FIBERMAP HDUs of all objects.
+        """
+        if not self._resolution_decoded:
+            self._decode_resolution()
+        if self._num_groups > 0:
+            self._merge_groups()
+        if self._num_merged < len(self._chunks):
+            self._merge_chunks()
+        return self._hdu_list
+
+    def _decode_resolution(self):
+        """Replace the encoded RESOLUTION HDUs of the file with decoded image HDUs.
+        """
+        hdus = self._hdu_list
+        for index in [3] + [5 + 4*group + 2 for group in range(self._num_groups)]:
+            hdu = hdus[index]
+            if 'RESENC' in hdu.header:
+                hdus[index] = astropy.io.fits.ImageHDU(desispec.io.util.decode_resolution(hdu),
+                    name = 'RESOLUTION',ver = hdu.ver)
+        self._resolution_decoded = True
+
+    def _resolution_hdu(self,data,header = None,ver = None):
+        """Return an HDU with resolution data, encoded if resolution_max_error is set.
+        """
+        if self.resolution_max_error is None or data is None:
+            return astropy.io.fits.ImageHDU(data,header = header,name = 'RESOLUTION',ver = ver)
+        hdu = desispec.io.util.encode_resolution(data,self.resolution_max_error)
+        if ver is not None:
+            hdu.ver = ver
+        return hdu
+
+    def _load_hdus(self):
+        """Replace the lazily read arrays of an npydir brick by in-memory HDUs before
+        they are modified.
+        """
+        if not isinstance(self._hdu_list,astropy.io.fits.HDUList):
+            self._hdu_list = self._hdu_list.to_hdulist()
+
+    def _merge_groups(self):
+        """Concatenate the groups of HDUs appended to the file with its first five HDUs.
+        """
+        self._load_hdus()
+        hdus = self._hdu_list
+        flux,ivar,resolution,tables = [ ],[ ],[ ],[ ]
+        for group in range(self._num_groups_in_file):
+            first = 5 + 4*(group - 1)
+            if group == 0:
+                images = (hdus[0],hdus[1],hdus[3])
+                table_hdu = hdus[4]
+            else:
+                images = hdus[first:first + 3]
+                table_hdu = hdus[first + 3]
+            if images[0].data is None:
+                continue
+            flux.append(images[0].data)
+            ivar.append(images[1].data)
+            resolution.append(images[2].data)
+            tables.append(table_hdu.data)
+        merged = astropy.io.fits.HDUList([hdus[i] for i in range(5)])
+        if len(flux) > 0:
+            merged[0].data = np.concatenate(flux)
+            merged[1].data = np.concatenate(ivar)
+            merged[3].data = np.concatenate(resolution)
+            merged[4] = self._table_hdu(table.vstack([table.Table(data) for data in tables]),hdus[4].header)
+        self._hdu_list = merged
+        self._num_groups = 0
+
+    def _merge_chunks(self):
+        """Concatenate the chunks added by :meth:`add_objects` with the HDU data.
+        """
+        self._load_hdus()
+        chunks = self._chunks[self._num_merged:]
+        flux = [chunk[0] for chunk in chunks]
+        ivar = [chunk[1] for chunk in chunks]
+        resolution = [chunk[2] for chunk in chunks]
+        # HDU2 contains the wavelength grid shared by all objects so we only add it once.
+        if self._hdu_list[0].data is not None:
+            flux.insert(0,self._hdu_list[0].data)
+            ivar.insert(0,self._hdu_list[1].data)
+            resolution.insert(0,self._hdu_list[3].data)
+        else:
+            self._hdu_list[2].data = self._wave
+        self._hdu_list[0].data = np.concatenate(flux)
+        self._hdu_list[1].data = np.concatenate(ivar)
+        self._hdu_list[3].data = np.concatenate(resolution)
+        new_info = self._merge_info(chunks)
+        if new_info is not None:
+            fibermap_hdu = self._hdu_list['FIBERMAP']
+            if len(fibermap_hdu.data) > 0:
+                new_info = table.vstack([table.Table(fibermap_hdu.data),new_info])
+            self._hdu_list['FIBERMAP'] = self._table_hdu(new_info,fibermap_hdu.header)
+        self._num_merged = len(self._chunks)
+
+    def _merge_info(self,chunks):
+        """Return the table of object info for new chunks, or None if they have no info.
+        """
+        return None
+
+    def _table_hdu(self,data,header):
+        """Convert a table of object info to an HDU with the given header.
+        """
+        #- unicode -> ascii columns
+        data = desiutil.io.encode_table(data)
+        updated_hdu = astropy.io.fits.convenience.table_to_hdu(data)
+        updated_hdu.header = header
+        return updated_hdu
+
+    def _wavelength_grid(self):
+        """Return the wavelength grid without merging any data.
+        """
+        if self._hdu_list[2].data is not None:
+            return self._hdu_list[2].data
+        return getattr(self,'_wave',None)
 
     def add_objects(self,flux,ivar,wave,resolution):
         """Add a list of objects to this brick file from the same night and exposure.
@@ -134,27 +302,65 @@ class BrickBase(object):
         """
         if self.mode != 'update':
             raise RuntimeError('Can only add objects in update mode.')
-        # Concatenate the new per-object image HDU data or use it to initialize the HDU.
-        # HDU2 contains the wavelength grid shared by all objects so we only add it once.
-        if self.hdu_list[0].data is not None:
-            self.hdu_list[0].data = np.concatenate((self.hdu_list[0].data,flux,))
-            self.hdu_list[1].data = np.concatenate((self.hdu_list[1].data,ivar,))
-            assert np.array_equal(self.hdu_list[2].data,wave),'Wavelength arrays do not match.'
-            self.hdu_list[3].data = np.concatenate((self.hdu_list[3].data,resolution,))
+        grid = self._wavelength_grid()
+        if grid is not None:
+            assert np.array_equal(grid,wave),'Wavelength arrays do not match.'
         else:
-            self.hdu_list[0].data = flux
-            self.hdu_list[1].data = ivar
-            self.hdu_list[2].data = wave
-            self.hdu_list[3].data = resolution
+            self._wave = wave
+        self._chunks.append((flux,ivar,resolution))
+        self._target_index = None
+        self._target_lookup = None
+
+    def _num_rows(self):
+        """Return the number of objects in the file and added chunks, without reading
+        or merging their data.
+        """
+        count = 0
+        for index in [0] + [5 + 4*group for group in range(self._num_groups)]:
+            shape = self._hdu_list[index].shape
+            count += shape[0] if shape else 0
+        for chunk in self._chunks[self._num_merged:]:
+            count += len(chunk[0])
+        return count
 
     def get_wavelength_grid(self):
         """Return the wavelength grid used in this brick file.
         """
         return self.hdu_list[2].data
 
+    def _get_target_index(self):
+        """Return the (target_ids,order,starts,counts) index of the rows of each target.
+
+        order sorts the rows by target ID, keeping rows of the same target in file order,
+        and target_ids[i] has rows order[starts[i]:starts[i]+counts[i]]. target_ids are
+        sorted in the order that they first appear in the file.
+        """
+        if self._target_index is None:
+            all_ids = self.hdu_list[4].data['TARGETID']
+            order = np.argsort(all_ids,kind = 'mergesort')
+            target_ids,starts,counts = np.unique(all_ids[order],return_index = True,return_counts = True)
+            first = np.argsort(order[starts])
+            self._target_index = (target_ids[first],order,starts[first],counts[first])
+        return self._target_index
+
+    def _get_target_rows(self,target_id):
+        """Return the rows of one target in file order, empty if it is not in the brick.
+        """
+        target_ids,order,starts,counts = self._get_target_index()
+        if self._target_lookup is None:
+            self._target_lookup = dict(zip(target_ids,range(len(target_ids))))
+        if target_id not in self._target_lookup:
+            return np.zeros(0,dtype = int)
+        i = self._target_lookup[target_id]
+        return order[starts[i]:starts[i] + counts[i]]
+
     def get_target(self,target_id):
         """Get the spectra and info for one target ID.
 
+        The rows of each target are found with an index built once per brick,
+        so looking up all targets only costs one sort of the target IDs. Only
+        these rows are read from memory-mapped FITS HDUs and npydir chunks.
+
         Args:
             target_id(int): Target ID number to lookup.
 
@@ -162,20 +368,38 @@ class BrickBase(object):
             tuple: Tuple of numpy arrays (flux,ivar,resolution,info) of data associated
                 with this target ID. The flux,ivar,resolution arrays will have one entry
                 for each spectrum and the info array will have one entry per exposure.
-                The returned arrays are slices into the FITS file HDU data arrays, so this
-                call is relatively cheap (and any changes will be saved to the file if it
-                was opened in update mode.)
+                The returned arrays are copies of the rows of this target in the FITS
+                file HDU data arrays.
         """
-        exposures = (self.hdu_list[4].data['TARGETID'] == target_id)
-        return (self.hdu_list[0].data[exposures],self.hdu_list[1].data[exposures],
-            self.hdu_list[3].data[exposures],self.hdu_list[4].data[exposures])
+        rows = self._get_target_rows(target_id)
+        hdus = self.hdu_list
+        return tuple([read_rows(hdus[index],rows) for index in (0,1,3,4)])
+
+    def iter_targets(self):
+        """Iterate over the spectra and info of all targets.
+
+        The rows of the brick are sorted by target ID in a single pass, and the
+        arrays yielded for each target are views into these sorted copies.
+
+        Yields:
+            tuple: Tuple (target_id,flux,ivar,resolution,info) for each target, in
+                the order that targets first appear in the file, with the arrays
+                returned by :meth:`get_target`.
+        """
+        target_ids,order,starts,counts = self._get_target_index()
+        flux = self.hdu_list[0].data[order]
+        ivar = self.hdu_list[1].data[order]
+        resolution = self.hdu_list[3].data[order]
+        info = self.hdu_list[4].data[order]
+        for target_id,start,count in zip(target_ids,starts,counts):
+            rows = slice(start,start + count)
+            yield (target_id,flux[rows],ivar[rows],resolution[rows],info[rows])
 
     def get_target_ids(self):
         """Return list of unique target IDs in this brick
         in the order that they first appear in the file input file.
         """
-        uniq, indices = np.unique(self.hdu_list[4].data['TARGETID'], return_index=True)
-        return uniq[indices.argsort()]
+        return self._get_target_index()[0]
 
     def get_num_spectra(self):
         """Get the number of spectra contained in this brick file.
@@ -183,7 +407,9 @@ class BrickBase(object):
         Returns:
             int: Number of objects contained in this brick file.
         """
-        return len(self.hdu_list[0].data)
+        # The shape is known without reading the data.
+        shape = self.hdu_list[0].shape
+        return shape[0] if shape else 0
 
     def get_num_targets(self):
         """Get the number of distinct targets with at least one spectrum in this brick file.
@@ -191,26 +417,72 @@ class BrickBase(object):
         Returns:
             int: Number of unique targets represented with spectra in this brick file.
         """
-        return len(np.unique(self.hdu_list[4].data['TARGETID']))
+        return len(self._get_target_index()[0])
 
-    def close(self):
+    def close(self,compact=False):
         """Write any updates and close the brick file.
+
+        Args:
+            compact(bool): Rewrite the whole file with only five HDUs, even if
+                objects could be appended to it.
         """
         if self.mode == 'update':
-            self.hdu_list.writeto(self.path,clobber = True)
-        self.hdu_list.close()
+            if self.append_only and not self._new_file and not compact:
+                self._append_chunks()
+            else:
+                self._rewrite()
+        self._hdu_list.close()
+
+    def _rewrite(self):
+        """Write all HDUs to a new file that then replaces the brick file.
+        """
+        # Copy the HDUs so that none of them refers to the file being replaced.
+        hdus = self.hdu_list
+        copies = [astropy.io.fits.PrimaryHDU(hdus[0].data,header = hdus[0].header.copy())]
+        for hdu in hdus[1:3]:
+            copies.append(astropy.io.fits.ImageHDU(hdu.data,header = hdu.header.copy()))
+        copies.append(self._resolution_hdu(hdus[3].data,header = hdus[3].header.copy()))
+        copies.append(astropy.io.fits.BinTableHDU(hdus[4].data,header = hdus[4].header.copy()))
+        self._backend.write(astropy.io.fits.HDUList(copies),self.path)
+
+    def _append_chunks(self):
+        """Append the objects added since the file was opened as a new group of HDUs,
+        or as new rows of the arrays of a backend appending rows.
+        """
+        chunks = self._chunks
+        if len(chunks) == 0:
+            return
+        version = self._num_groups_in_file + 1
+        hdus = [
+            astropy.io.fits.ImageHDU(np.concatenate([chunk[0] for chunk in chunks]),name = 'FLUX',ver = version),
+            astropy.io.fits.ImageHDU(np.concatenate([chunk[1] for chunk in chunks]),name = 'IVAR',ver = version),
+            self._resolution_hdu(np.concatenate([chunk[2] for chunk in chunks]),ver = version),
+            ]
+        info = self._merge_info(chunks)
+        if info is None:
+            raise RuntimeError('Can only append objects with info to an existing file.')
+        table_hdu = self._table_hdu(info,self._hdu_list['FIBERMAP'].header.copy())
+        table_hdu.ver = version
+        hdus.append(table_hdu)
+        self._backend.append(hdus,self.path)
 
 class Brick(BrickBase):
     """Represents the combined cframe exposures in a single brick and band.
 
-    See :class:`BrickBase` for constructor info.
+    Exposures added to an existing brick file are appended to it, see :class:`BrickBase`
+    for details and constructor info.
     """
-    def __init__(self,path,mode = 'readonly',header = None):
-        BrickBase.__init__(self,path,mode,header)
+    append_only = True
+
+    def __init__(self,path,mode = 'readonly',header = None,resolution_max_error = None,backend = None):
+        BrickBase.__init__(self,path,mode,header,resolution_max_error,backend)
 
     def add_objects(self,flux,ivar,wave,resolution,object_data,night,expid):
         """Add a list of objects to this brick file from the same night and exposure.
 
+        The NIGHT, EXPID and INDEX columns of the objects' info are set, with INDEX
+        the row of each object in the FLUX, IVAR and RESOLUTION HDUs of the brick.
+
         Args:
             flux(numpy.ndarray): Array of (nobj,nwave) flux values for nobj objects tabulated at nwave wavelengths.
             ivar(numpy.ndarray): Array of (nobj,nwave) inverse-variance values.
@@ -223,28 +495,22 @@ class Brick(BrickBase):
         Raises:
             RuntimeError: Can only add objects in update mode.
         """
+        first_row = self._num_rows()
         BrickBase.add_objects(self,flux,ivar,wave,resolution)
 
         augmented_data = table.Table(object_data)
         augmented_data['NIGHT'] = int(night)
         augmented_data['EXPID'] = expid
+        augmented_data['INDEX'] = np.arange(first_row,first_row + len(flux),dtype = 'i4')
+        self._chunks[-1] += (augmented_data,)
 
-        fibermap_hdu = self.hdu_list['FIBERMAP']
-        if len(fibermap_hdu.data) > 0:
-            orig_data = table.Table(fibermap_hdu.data)
-            augmented_data = table.vstack([orig_data, augmented_data])
-
-        #- unicode -> ascii columns
-        augmented_data = desiutil.io.encode_table(augmented_data)
-
-        updated_hdu = astropy.io.fits.convenience.table_to_hdu(augmented_data)
-        updated_hdu.header = fibermap_hdu.header
-        self.hdu_list['FIBERMAP'] = updated_hdu
+    def _merge_info(self,chunks):
+        return table.vstack([chunk[3] for chunk in chunks])
 
 class CoAddedBrick(BrickBase):
     """Represents the co-added exposures in a single brick and, possibly, a single band.
 
     See :class:`BrickBase` for constructor info.
     """
-    def __init__(self,path,mode = 'readonly',header = None):
-        BrickBase.__init__(self,path,mode,header)
+    def __init__(self,path,mode = 'readonly',header = None,resolution_max_error = None,backend = None):
+        BrickBase.__init__(self,path,mode,header,resolution_max_error,backend)
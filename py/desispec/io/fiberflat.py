@@ -4,14 +4,13 @@ desispec.io.fiberflat
 
 IO routines for fiberflat.
 """
-import os
 from astropy.io import fits
 
 from desiutil.depend import add_dependencies
 
 from desispec.fiberflat import FiberFlat
 from desispec.io import findfile
-from desispec.io.util import fitsheader, native_endian, makepath
+from desispec.io.util import fitsheader, native_endian, makepath, write_hdulist
 
 def write_fiberflat(outfile,fiberflat,header=None):
     """Write fiberflat object to outfile
@@ -49,8 +48,7 @@ def write_fiberflat(outfile,fiberflat,header=None):
     hdus.append(fits.ImageHDU(ff.wave.astype('f4'),     name='WAVELENGTH'))
     hdus[-1].header['BUNIT'] = 'Angstrom'
     
-    hdus.writeto(outfile+'.tmp', clobber=True, checksum=True)
-    os.rename(outfile+'.tmp', outfile)
+    write_hdulist(hdus, outfile)
     return outfile
 
 
@@ -0,0 +1,336 @@
+"""
+desispec.io.fileindex
+=====================
+
+Index of the files of a raw data or production directory, kept in a sqlite
+file at the top of this directory, so that finding the files of a night,
+exposure or camera does not require listing and globbing directories.
+
+The index is updated by the functions writing files, by
+:meth:`FileIndex.check_dir` for the directory about to be queried and by an
+incremental rescan (:meth:`FileIndex.update`, ``desi_index_files``) which
+only lists the directories modified since the previous scan.
+"""
+from __future__ import absolute_import, division, print_function
+import os
+import re
+import stat
+import string
+import sqlite3
+
+from ..log import get_logger
+
+#- Name of the index file at the top of an indexed directory
+index_filename = 'fileindex.sqlite'
+
+#- Regular expressions of the fields of the findfile() templates
+_field_regex = dict(night=r'\d{8}', expid=r'\d{8}', camera=r'[brz]\d',
+    spectrograph=r'\d+', brickname=r'[^/]+', band=r'[brz]', specprod=r'[^/]+')
+
+#- Columns of the files table filled from the fields of the file names
+_field_columns = ('night', 'expid', 'camera', 'spectrograph', 'brickname', 'band')
+
+_schema = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, dir TEXT, filetype TEXT, night TEXT,
+    expid INTEGER, camera TEXT, spectrograph INTEGER, brickname TEXT,
+    band TEXT, mtime REAL, size INTEGER, link INTEGER);
+CREATE INDEX IF NOT EXISTS files_filetype ON files (filetype, night, expid);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE TABLE IF NOT EXISTS dirs (dir TEXT PRIMARY KEY, parent TEXT, mtime REAL);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+"""
+
+_file_patterns = None
+
+def _get_file_patterns():
+    """Returns a list of (filetype, regex) matching the paths of the findfile()
+    templates relative to their raw data or production directory"""
+    global _file_patterns
+    if _file_patterns is None:
+        from .meta import _file_locations
+        _file_patterns = list()
+        for filetype, location in sorted(_file_locations.items()):
+            if filetype == 'desi':
+                #- same as raw
+                continue
+            template = location.split('/', 1)[1]
+            regex = ''
+            seen = set()
+            for literal, field, spec, conversion in string.Formatter().parse(template):
+                regex += re.escape(literal)
+                if field is None:
+                    continue
+                if field in seen:
+                    regex += '(?P={})'.format(field)
+                else:
+                    regex += '(?P<{}>{})'.format(field, _field_regex[field])
+                    seen.add(field)
+            _file_patterns.append((filetype, re.compile(regex+'$')))
+    return _file_patterns
+
+def parse_filename(path):
+    """Identifies the type and fields of a file from its path.
+
+    Args:
+        path(str): path relative to the raw data or production directory,
+            e.g. 'exposures/20160607/00000001/frame-b0-00000001.fits'
+
+    Returns:
+        tuple (filetype, fields) where fields is a dict with the night, expid,
+        camera, spectrograph, brickname and band (None if not in the file
+        name), or (None, None) if the path doesn't match any findfile() type.
+    """
+    for filetype, pattern in _get_file_patterns():
+        found = pattern.match(path)
+        if found is not None:
+            fields = found.groupdict()
+            result = dict()
+            for key in _field_columns:
+                value = fields.get(key)
+                if value is not None and key in ('expid', 'spectrograph'):
+                    value = int(value)
+                result[key] = value
+            return filetype, result
+    return None, None
+
+
+class FileIndex(object):
+    """Index of the files under a root directory.
+
+    Args:
+        root(str): raw data ($DESI_SPECTRO_DATA) or production
+            ($DESI_SPECTRO_REDUX/$SPECPROD) directory
+
+    Options:
+        create(bool): create the index file if it doesn't exist
+        timeout(float): seconds to wait for other processes updating the index
+    """
+    def __init__(self, root, create=False, timeout=60.):
+        self.root = root
+        self.filename = os.path.join(root, index_filename)
+        if not create and not os.path.exists(self.filename):
+            raise IOError('no file index {}'.format(self.filename))
+        self.db = sqlite3.connect(self.filename, timeout=timeout)
+        self.db.row_factory = sqlite3.Row
+        #- keep the journal file instead of deleting it after each
+        #- transaction, which would change the mtime of the root directory
+        self.db.execute('PRAGMA journal_mode=TRUNCATE')
+        if create:
+            self.db.executescript(_schema)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _file_row(self, relpath, st, link):
+        filetype, fields = parse_filename(relpath)
+        if fields is None:
+            fields = dict.fromkeys(_field_columns)
+        return (relpath, os.path.dirname(relpath), filetype) + \
+            tuple([fields[key] for key in _field_columns]) + \
+            (st.st_mtime, st.st_size, int(link))
+
+    def _insert_files(self, rows):
+        self.db.executemany('INSERT OR REPLACE INTO files VALUES ({})'.format(
+            ','.join(['?']*12)), rows)
+
+    def _remove_dir(self, reldir):
+        prefix = reldir+'/'
+        n = len(prefix)
+        self.db.execute('DELETE FROM files WHERE dir=? OR substr(dir,1,?)=?', (reldir, n, prefix))
+        self.db.execute('DELETE FROM dirs WHERE dir=? OR substr(dir,1,?)=?', (reldir, n, prefix))
+
+    def _scan_dir(self, reldir, st=None, full=False):
+        """List a directory, update its files and scan its new subdirectories
+        (all of them if full)"""
+        absdir = os.path.join(self.root, reldir)
+        if st is None:
+            st = os.stat(absdir)
+        #- st is taken before listing, so that files added while listing
+        #- trigger another scan of this directory
+        names = os.listdir(absdir)
+        known_files = set([row[0] for row in self.db.execute(
+            'SELECT path FROM files WHERE dir=?', (reldir,))])
+        known_dirs = set([row[0] for row in self.db.execute(
+            'SELECT dir FROM dirs WHERE parent=?', (reldir,))])
+        rows = list()
+        subdirs = list()
+        for name in names:
+            relpath = os.path.join(reldir, name)
+            if reldir == '' and name.startswith(index_filename):
+                continue
+            try:
+                lst = os.lstat(os.path.join(absdir, name))
+                link = stat.S_ISLNK(lst.st_mode)
+                fst = os.stat(os.path.join(absdir, name)) if link else lst
+            except OSError:
+                #- removed while listing, or broken link
+                continue
+            if stat.S_ISDIR(fst.st_mode):
+                if not link:
+                    subdirs.append((relpath, fst))
+            elif stat.S_ISREG(fst.st_mode):
+                rows.append(self._file_row(relpath, fst, link))
+        present = set([row[0] for row in rows])
+        self.db.executemany('DELETE FROM files WHERE path=?',
+            [(path,) for path in known_files - present])
+        self._insert_files(rows)
+        present = set([relpath for relpath, fst in subdirs])
+        for relpath in known_dirs - present:
+            self._remove_dir(relpath)
+        nscan = 1
+        for relpath, fst in subdirs:
+            if full or relpath not in known_dirs:
+                nscan += self._scan_dir(relpath, fst, full)
+        parent = os.path.dirname(reldir) if reldir != '' else None
+        self.db.execute('INSERT OR REPLACE INTO dirs VALUES (?,?,?)',
+            (reldir, parent, st.st_mtime))
+        return nscan
+
+    def update(self, full=False):
+        """Rescan the directories modified since the previous scan.
+
+        Options:
+            full(bool): rescan all directories and stat all files, e.g. to
+                catch files modified in place
+
+        Returns:
+            number of directories listed
+        """
+        nscan = 0
+        with self.db:
+            if full:
+                return self._scan_dir('', full=True)
+            known = self.db.execute('SELECT dir, mtime FROM dirs').fetchall()
+            if len(known) == 0:
+                return self._scan_dir('')
+            for reldir, mtime in known:
+                try:
+                    st = os.stat(os.path.join(self.root, reldir))
+                except OSError:
+                    self._remove_dir(reldir)
+                    continue
+                if st.st_mtime != mtime:
+                    nscan += self._scan_dir(reldir, st)
+        return nscan
+
+    def check_dir(self, reldir):
+        """Rescan a directory if it was modified since it was indexed.
+
+        This costs a single stat() if it wasn't, and is used before querying
+        the files of a directory.
+
+        Args:
+            reldir(str): directory relative to the root directory
+
+        Returns:
+            False if the directory doesn't exist, True otherwise
+        """
+        reldir = os.path.normpath(reldir)
+        if reldir == '.':
+            reldir = ''
+        try:
+            st = os.stat(os.path.join(self.root, reldir))
+        except OSError:
+            with self.db:
+                self._remove_dir(reldir)
+            return False
+        row = self.db.execute('SELECT mtime FROM dirs WHERE dir=?', (reldir,)).fetchone()
+        if row is None or row[0] != st.st_mtime:
+            with self.db:
+                self._scan_dir(reldir, st)
+        return True
+
+    def add(self, relpath):
+        """Add or update a single file, e.g. after writing it.
+
+        Args:
+            relpath(str): file path relative to the root directory
+        """
+        path = os.path.join(self.root, relpath)
+        lst = os.lstat(path)
+        link = stat.S_ISLNK(lst.st_mode)
+        st = os.stat(path) if link else lst
+        with self.db:
+            self._insert_files([self._file_row(relpath, st, link)])
+
+    def query(self, filetype=None, **fields):
+        """Returns the indexed files matching a file type and fields.
+
+        Options:
+            filetype(str): findfile() file type, e.g. 'frame' or 'fibermap'
+            night, expid, camera, spectrograph, brickname, band: fields of the
+                file names, as in findfile()
+
+        Returns:
+            list of sqlite3.Row with the path relative to the root directory,
+            filetype, fields, mtime, size and link (True for symbolic links)
+            of each file, sorted by path
+        """
+        where = list()
+        values = list()
+        if filetype is not None:
+            where.append('filetype=?')
+            values.append(filetype)
+        for key, value in sorted(fields.items()):
+            if key not in _field_columns:
+                raise ValueError('unknown field {}'.format(key))
+            if value is not None:
+                where.append('{}=?'.format(key))
+                values.append(value)
+        sql = 'SELECT * FROM files'
+        if len(where) > 0:
+            sql += ' WHERE '+' AND '.join(where)
+        return self.db.execute(sql+' ORDER BY path', values).fetchall()
+
+    def subdirs(self, reldir):
+        """Returns the sorted names of the indexed subdirectories of a directory"""
+        rows = self.db.execute('SELECT dir FROM dirs WHERE parent=?', (reldir,))
+        return sorted([os.path.basename(row[0]) for row in rows])
+
+    def file_states(self):
+        """Returns a dict mapping the path of all indexed files, joined to the
+        root directory, to (mtime, link)"""
+        return dict([(os.path.normpath(os.path.join(self.root, row[0])), (row[1], bool(row[2])))
+            for row in self.db.execute('SELECT path, mtime, link FROM files')])
+
+
+def open_index(root):
+    """Returns the FileIndex of a directory, or None if it has none"""
+    if root is None or not os.path.exists(os.path.join(root, index_filename)):
+        return None
+    return FileIndex(root)
+
+def find_index_root(path, max_depth=4):
+    """Returns the closest directory above path (at most max_depth levels up)
+    which has a file index, or None"""
+    dirname = os.path.dirname(os.path.abspath(path))
+    for i in range(max_depth+1):
+        if os.path.exists(os.path.join(dirname, index_filename)):
+            return dirname
+        parent = os.path.dirname(dirname)
+        if parent == dirname:
+            break
+        dirname = parent
+    return None
+
+def record_file(path):
+    """Add a newly written file to the index of its directory tree, if any.
+
+    Errors are logged, since the file will be indexed by the next scan anyway.
+    """
+    root = find_index_root(path)
+    if root is None:
+        return
+    try:
+        with FileIndex(root) as index:
+            index.add(os.path.relpath(os.path.abspath(path), root))
+    except (sqlite3.Error, OSError) as err:
+        log = get_logger()
+        log.warning('could not add {} to the file index: {}'.format(path, err))
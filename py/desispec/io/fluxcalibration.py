@@ -6,12 +6,15 @@ IO routines for flux calibration.
 """
 from __future__ import absolute_import, print_function
 import os
+import hashlib
 from astropy.io import fits
+from astropy import units
 import numpy,scipy
 
 from desiutil.depend import add_dependencies
 
-from .util import fitsheader, native_endian, makepath
+from .util import fitsheader, native_endian, makepath, write_hdulist
+from .filters import load_filter
 
 def write_stdstar_models(norm_modelfile,normalizedFlux,wave,fibers,data,header=None):
     """Writes the normalized flux for the best models.
@@ -68,7 +71,7 @@ def read_stdstar_models(filename):
     return flux, wave, fibers
 
 
-def write_flux_calibration(outfile, fluxcalib, header=None):
+def write_flux_calibration(outfile, fluxcalib, header=None, compact=False):
     """Writes  flux calibration.
     
     Args:
@@ -77,6 +80,9 @@ def write_flux_calibration(outfile, fluxcalib, header=None):
         
     Options:
         header : dict-like object of key/value pairs to include in header
+        compact : write the 1D deconvolved calibration, the band of its
+            covariance and the 1D ivar and mask of a CompactFluxCalib instead
+            of the 2D arrays (CALIBFMT='DECONV' in the header)
     """
     hx = fits.HDUList()
     
@@ -85,29 +91,48 @@ def write_flux_calibration(outfile, fluxcalib, header=None):
     
     hdr['EXTNAME'] = 'FLUXCALIB'
     hdr['BUNIT'] = ('1e+17 cm2 electron s / erg', 'i.e. (electron/Angstrom) / (1e-17 erg/s/cm2/Angstrom)')
-    hx.append( fits.PrimaryHDU(fluxcalib.calib.astype('f4'), header=hdr) )
-    hx.append( fits.ImageHDU(fluxcalib.ivar.astype('f4'), name='IVAR') )
-    hx.append( fits.CompImageHDU(fluxcalib.mask, name='MASK') )
+    if compact:
+        from ..fluxcalibration import CompactFluxCalib
+        if not isinstance(fluxcalib, CompactFluxCalib):
+            raise ValueError('compact flux calibration files require a CompactFluxCalib')
+        hdr['CALIBFMT'] = ('DECONV', 'deconvolved calib, convolve with frame resolution')
+        hdr['NSPEC'] = (fluxcalib.nspec, 'number of spectra')
+        hx.append( fits.PrimaryHDU(fluxcalib.deconvolved.astype('f4'), header=hdr) )
+        hx.append( fits.ImageHDU(fluxcalib.mean_ivar.astype('f4'), name='IVAR') )
+        hx.append( fits.ImageHDU(fluxcalib.mean_mask, name='MASK') )
+        hx.append( fits.ImageHDU(fluxcalib.covariance.astype('f4'), name='COVARIANCE') )
+    else:
+        hx.append( fits.PrimaryHDU(fluxcalib.calib.astype('f4'), header=hdr) )
+        hx.append( fits.ImageHDU(fluxcalib.ivar.astype('f4'), name='IVAR') )
+        hx.append( fits.CompImageHDU(fluxcalib.mask, name='MASK') )
     hx.append( fits.ImageHDU(fluxcalib.wave.astype('f4'), name='WAVELENGTH') )
     hx[-1].header['BUNIT'] = 'Angstrom'
     
-    hx.writeto(outfile+'.tmp', clobber=True, checksum=True)
-    os.rename(outfile+'.tmp', outfile)
+    write_hdulist(hx, outfile)
 
     return outfile
 
 def read_flux_calibration(filename):
     """Read flux calibration file; returns a FluxCalib object
+
+    Compact files (see write_flux_calibration) are returned as a
+    CompactFluxCalib without resolution_data, which must be set from the
+    frame before accessing calib.
     """
     # Avoid a circular import conflict at package install/build_sphinx time.
-    from ..fluxcalibration import FluxCalib
+    from ..fluxcalibration import FluxCalib, CompactFluxCalib
     fx = fits.open(filename, memmap=False, uint=True)
     calib = native_endian(fx[0].data.astype('f8'))
     ivar = native_endian(fx["IVAR"].data.astype('f8'))
     mask = native_endian(fx["MASK"].data)
     wave = native_endian(fx["WAVELENGTH"].data.astype('f8'))
 
-    fluxcalib = FluxCalib(wave, calib, ivar, mask)
+    if fx[0].header.get('CALIBFMT') == 'DECONV':
+        covariance = native_endian(fx["COVARIANCE"].data.astype('f8'))
+        fluxcalib = CompactFluxCalib(wave, calib, covariance, ivar, mask,
+                                     nspec=fx[0].header['NSPEC'])
+    else:
+        fluxcalib = FluxCalib(wave, calib, ivar, mask)
     fluxcalib.header = fx[0].header
     fx.close()
     return fluxcalib
@@ -156,3 +181,75 @@ def read_stdstar_templates(stellarmodelfile):
     phdu.close()
 
     return wavebins,fluxData,templateid,teff,logg,feh
+
+def _file_checksum(filename, blocksize=2**20):
+    """Returns the SHA1 hex digest of the content of a file"""
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fx:
+        for block in iter(lambda: fx.read(blocksize), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def _save_cache_array(filename, array):
+    """Writes an array to a .npy file of the cache, atomically so that
+    concurrent processes never read a partial file"""
+    tmpfile = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmpfile, 'wb') as fx:
+        numpy.save(fx, array)
+    os.rename(tmpfile, filename)
+
+def read_stdstar_templates_cached(stellarmodelfile, filters, cache_dir=None):
+    """
+    Reads an input stellar model file and the AB magnitudes of its models
+
+    If cache_dir is given, the templates and the model magnitudes in each
+    filter are saved as .npy files in the subdirectory of cache_dir named
+    after the SHA1 checksum of the model file, and are memory-mapped by the
+    following calls (e.g. for the other spectrographs and exposures of a
+    night). Only the magnitudes of the filters missing from the cache are
+    computed.
+
+    Args:
+        stellarmodelfile : input filename
+        filters : list of filter names, as in the fibermap (e.g. DECAM_R)
+        cache_dir : optional cache directory, created if needed
+
+    Returns (wave, flux, templateid, teff, logg, feh, mags) tuple:
+        wave, flux, templateid, teff, logg, feh : as read_stdstar_templates
+        mags : 2D[nmodel, nfilter] array of AB magnitudes of the models
+    """
+    fluxunits = 1e-17 * units.erg / units.s / units.cm**2 / units.Angstrom
+    names = ['wave', 'flux', 'templateid', 'teff', 'logg', 'feh']
+
+    if cache_dir is None:
+        templates = read_stdstar_templates(stellarmodelfile)
+    else:
+        cache_dir = os.path.join(cache_dir, _file_checksum(stellarmodelfile))
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            #- may have been created by a concurrent process
+            if not os.path.isdir(cache_dir):
+                raise
+        paths = [os.path.join(cache_dir, name+'.npy') for name in names]
+        if not all([os.path.exists(path) for path in paths]):
+            templates = read_stdstar_templates(stellarmodelfile)
+            for path, array in zip(paths, templates):
+                _save_cache_array(path, native_endian(numpy.asarray(array)))
+        templates = [numpy.load(path, mmap_mode='r') for path in paths]
+    wave, flux = templates[0:2]
+
+    mags = numpy.zeros((flux.shape[0], len(filters)))
+    for i, name in enumerate(filters):
+        path = None
+        if cache_dir is not None:
+            path = os.path.join(cache_dir, 'mag-{}.npy'.format(name))
+            if os.path.exists(path):
+                mags[:, i] = numpy.load(path)
+                continue
+        filter_response = load_filter(name)
+        mags[:, i] = filter_response.get_ab_magnitude(flux*fluxunits, wave)
+        if path is not None:
+            _save_cache_array(path, mags[:, i])
+
+    return tuple(templates) + (mags,)
@@ -4,8 +4,6 @@ desispec.io.frame
 
 I/O routines for Frame objects
 """
-import os.path
-
 import numpy as np
 import scipy,scipy.sparse
 from astropy.io import fits
@@ -15,12 +13,15 @@ import desiutil.io
 
 from desispec.frame import Frame
 from desispec.io import findfile
-from desispec.io.util import fitsheader, native_endian, makepath
+from desispec.io.util import (fitsheader, native_endian, makepath,
+    encode_resolution)
+from desispec.io.storage import get_backend, read_rows
 from desispec.log import get_logger
 
 log = get_logger()
 
-def write_frame(outfile, frame, header=None, fibermap=None, units=None):
+def write_frame(outfile, frame, header=None, fibermap=None, units=None,
+    resolution_max_error=None, backend=None):
     """Write a frame fits file and returns path to file written.
 
     Args:
@@ -30,6 +31,11 @@ def write_frame(outfile, frame, header=None, fibermap=None, units=None):
     Optional:
         header: astropy.io.fits.Header or dict to override frame.header
         fibermap: table to store as FIBERMAP HDU
+        resolution_max_error: if set, store the resolution data as quantized
+            differences to a reference kernel with this maximum absolute error
+            (see desispec.io.util.encode_resolution), instead of float32
+        backend: storage backend object or name, 'fits' (default) or 'npydir'
+            (see desispec.io.storage)
 
     Returns:
         full filepath of output file that was written
@@ -62,7 +68,10 @@ def write_frame(outfile, frame, header=None, fibermap=None, units=None):
     hdus.append( fits.CompImageHDU(frame.mask, name='MASK') )
     hdus.append( fits.ImageHDU(frame.wave.astype('f4'), name='WAVELENGTH') )
     hdus[-1].header['BUNIT'] = 'Angstrom'
-    hdus.append( fits.ImageHDU(frame.resolution_data.astype('f4'), name='RESOLUTION' ) )
+    if resolution_max_error is not None:
+        hdus.append( encode_resolution(frame.resolution_data, resolution_max_error) )
+    else:
+        hdus.append( fits.ImageHDU(frame.resolution_data.astype('f4'), name='RESOLUTION' ) )
     
     if fibermap is not None:
         fibermap = desiutil.io.encode_table(fibermap)  #- unicode -> bytes
@@ -80,20 +89,34 @@ def write_frame(outfile, frame, header=None, fibermap=None, units=None):
     if frame.chi2pix is not None:
         hdus.append( fits.ImageHDU(frame.chi2pix.astype('f4'), name='CHI2PIX' ) )
 
-    hdus.writeto(outfile+'.tmp', clobber=True, checksum=True)
-    os.rename(outfile+'.tmp', outfile)
+    get_backend(backend).write(hdus, outfile)
 
     return outfile
 
-def read_frame(filename, nspec=None):
+def read_frame(filename, nspec=None, fibers=None, skip_hdus=None, keep_float32=False):
     """Reads a frame fits file and returns its data.
 
+    The file is memory-mapped, so only the requested spectra are read
+    from the FLUX, IVAR, RESOLUTION and CHI2PIX HDUs. Encoded resolution
+    data (see write_frame) are decoded.  Frames written with the npydir
+    backend (see desispec.io.storage) are read from their directory, where
+    only the chunks of the requested spectra are read.
+
     Args:
-        filename: path to a file, or (night, expid, camera) tuple where
+        filename: path to a file or npydir directory, or (night, expid, camera) tuple where
             night = string YEARMMDD
             expid = integer exposure ID
             camera = b0, r1, .. z9
 
+    Options:
+        nspec: only read the first nspec spectra
+        fibers: array of indices of the spectra to read, i.e. of the rows
+            0 to nspec-1 of the file, which need not be contiguous
+        skip_hdus: list of optional HDUs not to read, among MASK,
+            RESOLUTION, FIBERMAP and CHI2PIX
+        keep_float32: keep flux, ivar, resolution and chi2pix as float32
+            instead of converting them to float64
+
     Returns:
         desispec.Frame object with attributes wave, flux, ivar, etc.
     """
@@ -102,41 +125,60 @@ def read_frame(filename, nspec=None):
         night, expid, camera = filename
         filename = findfile('frame', night, expid, camera)
 
-    if not os.path.isfile(filename) :
+    backend = get_backend(path=filename)
+    if not backend.exists(filename) :
         raise IOError("cannot open"+filename)
 
-    fx = fits.open(filename, uint=True, memmap=False)
+    if nspec is not None and fibers is not None:
+        raise ValueError("set nspec or fibers, not both")
+
+    if skip_hdus is None:
+        skip_hdus = ()
+    for extname in skip_hdus:
+        if extname not in ('MASK', 'RESOLUTION', 'FIBERMAP', 'CHI2PIX'):
+            raise ValueError("cannot skip HDU {}".format(extname))
+
+    rows = None
+    if nspec is not None:
+        rows = slice(0, nspec)
+    elif fibers is not None:
+        rows = np.atleast_1d(np.asarray(fibers, dtype=int))
+
+    dtype = 'f4' if keep_float32 else 'f8'
+
+    fx = backend.open(filename)
     hdr = fx[0].header
-    flux = native_endian(fx['FLUX'].data.astype('f8'))
-    ivar = native_endian(fx['IVAR'].data.astype('f8'))
-    wave = native_endian(fx['WAVELENGTH'].data.astype('f8'))
-    if 'MASK' in fx:
-        mask = native_endian(fx['MASK'].data)
+    flux = read_rows(fx['FLUX'], rows, dtype)
+    ivar = read_rows(fx['IVAR'], rows, dtype)
+    wave = native_endian(read_rows(fx['WAVELENGTH']).astype('f8'))
+    if 'MASK' in fx and 'MASK' not in skip_hdus:
+        mask = read_rows(fx['MASK'], rows)
     else:
         mask = None   #- let the Frame object create the default mask
-        
-    resolution_data = native_endian(fx['RESOLUTION'].data.astype('f8'))
-    
-    if 'FIBERMAP' in fx:
-        fibermap = fx['FIBERMAP'].data
+
+    if 'RESOLUTION' not in skip_hdus:
+        resolution_data = read_rows(fx['RESOLUTION'], rows, dtype)
+    else:
+        resolution_data = None
+
+    if 'FIBERMAP' in fx and 'FIBERMAP' not in skip_hdus:
+        #- copied out of the memory map
+        fibermap = read_rows(fx['FIBERMAP'], rows)
     else:
         fibermap = None
-        
-    if 'CHI2PIX' in fx:
-        chi2pix = native_endian(fx['CHI2PIX'].data.astype('f8'))
+
+    if 'CHI2PIX' in fx and 'CHI2PIX' not in skip_hdus:
+        chi2pix = read_rows(fx['CHI2PIX'], rows, dtype)
     else:
         chi2pix = None
 
     fx.close()
 
-    if nspec is not None:
-        flux = flux[0:nspec]
-        ivar = ivar[0:nspec]
-        resolution_data = resolution_data[0:nspec]
-        if chi2pix is not None:
-            chi2pix = chi2pix[0:nspec]
-        if mask is not None:
-            mask = mask[0:nspec]
+    #- Keep track of the fiber numbers of a subset of the spectra
+    fiber_numbers = None
+    if fibers is not None and fibermap is None and 'FIBERMIN' in hdr:
+        fiber_numbers = hdr['FIBERMIN'] + rows
 
     # return flux,ivar,wave,resolution_data, hdr
-    return Frame(wave, flux, ivar, mask, resolution_data, meta=hdr, fibermap=fibermap, chi2pix=chi2pix)
+    return Frame(wave, flux, ivar, mask, resolution_data, fibers=fiber_numbers,
+                 meta=hdr, fibermap=fibermap, chi2pix=chi2pix)
@@ -5,11 +5,10 @@ desispec.io.image
 I/O routines for Image objects
 """
 
-import os
 import numpy as np
 
 from desispec.image import Image
-from desispec.io.util import fitsheader, native_endian, makepath
+from desispec.io.util import fitsheader, native_endian, makepath, write_hdulist
 from astropy.io import fits
 from desiutil.depend import add_dependencies
 
@@ -46,8 +45,7 @@ def write_image(outfile, image, meta=None):
     if not np.isscalar(image.readnoise):
         hx.append(fits.ImageHDU(image.readnoise.astype(np.float32), name='READNOISE'))
 
-    hx.writeto(outfile+'.tmp', clobber=True, checksum=True)
-    os.rename(outfile+'.tmp', outfile)
+    write_hdulist(hx, outfile)
 
     return outfile
 
@@ -12,6 +12,39 @@ import glob
 import re
 
 
+#- Location of each file type, relative to $DESI_SPECTRO_DATA or
+#- $DESI_SPECTRO_REDUX/$SPECPROD
+_file_locations = dict(
+    raw = '{rawdata_dir}/{night}/desi-{expid:08d}.fits.fz',
+    pix = '{rawdata_dir}/{night}/pix-{camera}-{expid:08d}.fits',
+    fiberflat = '{specprod_dir}/calib2d/{night}/fiberflat-{camera}-{expid:08d}.fits',
+    frame = '{specprod_dir}/exposures/{night}/{expid:08d}/frame-{camera}-{expid:08d}.fits',
+    cframe = '{specprod_dir}/exposures/{night}/{expid:08d}/cframe-{camera}-{expid:08d}.fits',
+    sky = '{specprod_dir}/exposures/{night}/{expid:08d}/sky-{camera}-{expid:08d}.fits',
+    stdstars = '{specprod_dir}/exposures/{night}/{expid:08d}/stdstars-{spectrograph:d}-{expid:08d}.fits',
+    calib = '{specprod_dir}/exposures/{night}/{expid:08d}/calib-{camera}-{expid:08d}.fits',
+    qa_data = '{specprod_dir}/exposures/{night}/{expid:08d}/qa-{camera}-{expid:08d}.yaml',
+    qa_data_exp = '{specprod_dir}/exposures/{night}/{expid:08d}/qa-{expid:08d}.yaml',
+    qa_sky_fig = '{specprod_dir}/exposures/{night}/{expid:08d}/qa-sky-{camera}-{expid:08d}.png',
+    qa_flux_fig = '{specprod_dir}/exposures/{night}/{expid:08d}/qa-flux-{camera}-{expid:08d}.png',
+    qa_calib = '{specprod_dir}/calib2d/{night}/qa-{camera}-{expid:08d}.yaml',
+    qa_calib_exp = '{specprod_dir}/calib2d/{night}/qa-{expid:08d}.yaml',
+    qa_flat_fig = '{specprod_dir}/calib2d/{night}/qa-flat-{camera}-{expid:08d}.png',
+    qa_ztruth = '{specprod_dir}/exposures/{night}/qa-ztruth-{night}.yaml',
+    qa_ztruth_fig = '{specprod_dir}/exposures/{night}/qa-ztruth-{night}.png',
+    ### psf = '{specprod_dir}/exposures/{night}/{expid:08d}/psf-{camera}-{expid:08d}.fits',
+    psf = '{specprod_dir}/calib2d/{night}/psf-{camera}-{expid:08d}.fits',
+    fibermap = '{rawdata_dir}/{night}/fibermap-{expid:08d}.fits',
+    brick = '{specprod_dir}/bricks/{brickname}/brick-{band}-{brickname}.fits',
+    coadd = '{specprod_dir}/bricks/{brickname}/coadd-{band}-{brickname}.fits',
+    coadd_all = '{specprod_dir}/bricks/{brickname}/coadd-{brickname}.fits',
+    zbest = '{specprod_dir}/bricks/{brickname}/zbest-{brickname}.fits',
+    zspec = '{specprod_dir}/bricks/{brickname}/zspec-{brickname}.fits',
+    zcatalog = '{specprod_dir}/zcatalog-{specprod}.fits',
+)
+_file_locations['desi'] = _file_locations['raw']
+
+
 def findfile(filetype, night=None, expid=None, camera=None, brickname=None,
     band=None, spectrograph=None, rawdata_dir=None, specprod_dir=None,
     download=False, outdir=None):
@@ -38,35 +71,7 @@ def findfile(filetype, night=None, expid=None, camera=None, brickname=None,
     #- NOTE: specprod_dir is the directory $DESI_SPECTRO_REDUX/$SPECPROD,
     #-       specprod is just the environment variable $SPECPROD
 
-    location = dict(
-        raw = '{rawdata_dir}/{night}/desi-{expid:08d}.fits.fz',
-        pix = '{rawdata_dir}/{night}/pix-{camera}-{expid:08d}.fits',
-        fiberflat = '{specprod_dir}/calib2d/{night}/fiberflat-{camera}-{expid:08d}.fits',
-        frame = '{specprod_dir}/exposures/{night}/{expid:08d}/frame-{camera}-{expid:08d}.fits',
-        cframe = '{specprod_dir}/exposures/{night}/{expid:08d}/cframe-{camera}-{expid:08d}.fits',
-        sky = '{specprod_dir}/exposures/{night}/{expid:08d}/sky-{camera}-{expid:08d}.fits',
-        stdstars = '{specprod_dir}/exposures/{night}/{expid:08d}/stdstars-{spectrograph:d}-{expid:08d}.fits',
-        calib = '{specprod_dir}/exposures/{night}/{expid:08d}/calib-{camera}-{expid:08d}.fits',
-        qa_data = '{specprod_dir}/exposures/{night}/{expid:08d}/qa-{camera}-{expid:08d}.yaml',
-        qa_data_exp = '{specprod_dir}/exposures/{night}/{expid:08d}/qa-{expid:08d}.yaml',
-        qa_sky_fig = '{specprod_dir}/exposures/{night}/{expid:08d}/qa-sky-{camera}-{expid:08d}.png',
-        qa_flux_fig = '{specprod_dir}/exposures/{night}/{expid:08d}/qa-flux-{camera}-{expid:08d}.png',
-        qa_calib = '{specprod_dir}/calib2d/{night}/qa-{camera}-{expid:08d}.yaml',
-        qa_calib_exp = '{specprod_dir}/calib2d/{night}/qa-{expid:08d}.yaml',
-        qa_flat_fig = '{specprod_dir}/calib2d/{night}/qa-flat-{camera}-{expid:08d}.png',
-        qa_ztruth = '{specprod_dir}/exposures/{night}/qa-ztruth-{night}.yaml',
-        qa_ztruth_fig = '{specprod_dir}/exposures/{night}/qa-ztruth-{night}.png',
-        ### psf = '{specprod_dir}/exposures/{night}/{expid:08d}/psf-{camera}-{expid:08d}.fits',
-        psf = '{specprod_dir}/calib2d/{night}/psf-{camera}-{expid:08d}.fits',
-        fibermap = '{rawdata_dir}/{night}/fibermap-{expid:08d}.fits',
-        brick = '{specprod_dir}/bricks/{brickname}/brick-{band}-{brickname}.fits',
-        coadd = '{specprod_dir}/bricks/{brickname}/coadd-{band}-{brickname}.fits',
-        coadd_all = '{specprod_dir}/bricks/{brickname}/coadd-{brickname}.fits',
-        zbest = '{specprod_dir}/bricks/{brickname}/zbest-{brickname}.fits',
-        zspec = '{specprod_dir}/bricks/{brickname}/zspec-{brickname}.fits',
-        zcatalog = '{specprod_dir}/zcatalog-{specprod}.fits',
-    )
-    location['desi'] = location['raw']
+    location = _file_locations
 
     #- Do we know about this kind of file?
     if filetype not in location:
@@ -112,12 +117,34 @@ def findfile(filetype, night=None, expid=None, camera=None, brickname=None,
 
     return filepath
 
+def _indexed_exposure_files(filetype, night, expid, rawdata_dir=None, specprod_dir=None):
+    """Returns the files of an exposure found in the file index of their raw
+    data or production directory, as a list of (camera, path) sorted by path,
+    or None if this directory has no file index."""
+    from .fileindex import open_index
+    if _file_locations[filetype].startswith('{rawdata_dir}'):
+        root = rawdata_dir if rawdata_dir is not None else rawdata_root()
+    else:
+        root = specprod_dir if specprod_dir is not None else specprod_root()
+    index = open_index(root)
+    if index is None:
+        return None
+    try:
+        path = findfile(filetype, night, expid, camera='*', rawdata_dir=root, specprod_dir=root)
+        if not index.check_dir(os.path.relpath(os.path.dirname(path), root)):
+            return []
+        rows = index.query(filetype, night=night, expid=expid)
+        return [(row['camera'], os.path.normpath(os.path.join(root, row['path']))) for row in rows]
+    finally:
+        index.close()
+
 def get_raw_files(filetype, night, expid, rawdata_dir=None):
     """Get files for a specified exposure.
 
     Uses :func:`findfile` to determine the valid file names for the specified type.
     Any camera identifiers not matching the regular expression [brz][0-9] will be
-    silently ignored.
+    silently ignored. If the raw data directory has a file index
+    (:mod:`desispec.io.fileindex`), it is used instead of globbing the directory.
 
     Args:
         filetype(str): Type of files to get. Valid choices are 'frame','cframe','psf'.
@@ -129,6 +156,11 @@ def get_raw_files(filetype, night, expid, rawdata_dir=None):
         dict: Dictionary of found file names using camera id strings as keys, which are
             guaranteed to match the regular expression [brz][0-9].
     """
+    indexed = _indexed_exposure_files(filetype, night, expid, rawdata_dir=rawdata_dir)
+    if indexed is not None:
+        if len(indexed) == 1:
+            return indexed[0][1]
+        return dict([(camera, path) for camera, path in indexed if camera is not None])
     glob_pattern = findfile(filetype, night, expid, camera='*', rawdata_dir=rawdata_dir)
     literals = [re.escape(tmp) for tmp in glob_pattern.split('*')]
     re_pattern = re.compile('([brz][0-9])'.join(literals))
@@ -147,7 +179,8 @@ def get_files(filetype, night, expid, specprod_dir=None):
 
     Uses :func:`findfile` to determine the valid file names for the specified type.
     Any camera identifiers not matching the regular expression [brz][0-9] will be
-    silently ignored.
+    silently ignored. If the production directory has a file index
+    (:mod:`desispec.io.fileindex`), it is used instead of globbing the directory.
 
     Args:
         filetype(str): Type of files to get. Valid choices are 'frame','cframe','psf'.
@@ -161,6 +194,9 @@ def get_files(filetype, night, expid, specprod_dir=None):
         dict: Dictionary of found file names using camera id strings as keys, which are
             guaranteed to match the regular expression [brz][0-9].
     """
+    indexed = _indexed_exposure_files(filetype, night, expid, specprod_dir=specprod_dir)
+    if indexed is not None:
+        return dict([(camera, path) for camera, path in indexed if camera is not None])
     glob_pattern = findfile(filetype, night, expid, camera='*', specprod_dir=specprod_dir)
     literals = [re.escape(tmp) for tmp in glob_pattern.split('*')]
     re_pattern = re.compile('([brz][0-9])'.join(literals))
@@ -194,7 +230,8 @@ def get_exposures(night, raw=False, rawdata_dir=None, specprod_dir=None):
 
     Exposures are identified as correctly formatted subdirectory names within the
     night directory, but no checks for valid contents of these exposure subdirectories
-    are performed.
+    are performed. The file index of the raw data or production directory
+    (:mod:`desispec.io.fileindex`) is used if there is one.
 
     Args:
         night(str): Date string for the requested night in the format YYYYMMDD.
@@ -223,6 +260,21 @@ def get_exposures(night, raw=False, rawdata_dir=None, specprod_dir=None):
             specprod_dir = specprod_root()
         night_path = os.path.join(specprod_dir,'exposures',night)
 
+    from .fileindex import open_index
+    index = open_index(rawdata_dir if raw else specprod_dir)
+    if index is not None:
+        try:
+            night_dir = os.path.relpath(night_path, index.root)
+            if not index.check_dir(night_dir):
+                raise RuntimeError('Non-existent night %s' % night)
+            if raw:
+                return sorted([row['expid'] for row in index.query('fibermap', night=night)])
+            subdirs = index.subdirs(night_dir)
+        finally:
+            index.close()
+        return sorted([int(tail) for tail in subdirs
+            if tail.isdigit() and tail == "{:08d}".format(int(tail))])
+
     if not os.path.exists(night_path):
         raise RuntimeError('Non-existent night %s' % night)
 
@@ -5,7 +5,9 @@ See DESI-1229 for format details
 TODO: move into datamodel after we have verified the format
 '''
 
+import collections
 import os.path
+import multiprocessing.pool
 from astropy.io import fits
 import numpy as np
 
@@ -35,18 +37,87 @@ def read_raw(filename, camera, **kwargs):
         raise IOError('Camera {} not in {}'.format(camera, filename))
 
     rawimage = fx[camera.upper()].data
-    header = fx[camera.upper()].header
+    header = _inherit_header(fx, camera)
+
+    fx.close()
+
+    img = desispec.preproc.preproc(rawimage, header, **kwargs)
+    return img
 
+def _inherit_header(fx, camera):
+    '''
+    Returns the header of the `camera` HDU of an opened raw data file,
+    completed by the keywords of HDU 0 if INHERIT is set
+    '''
+    header = fx[camera.upper()].header
     if 'INHERIT' in header and header['INHERIT']:
         h0 = fx[0].header
         for key in h0:
             if key not in header:
                 header[key] = h0[key]
+    return header
 
-    fx.close()
+def iter_raw(filename, cameras=None, nthreads=4):
+    '''
+    Yields the raw data of several cameras of an exposure, reading the file once
 
-    img = desispec.preproc.preproc(rawimage, header, **kwargs)
-    return img
+    The camera HDUs are decompressed concurrently by a pool of threads, so
+    that the next cameras are decoded while the first ones are preprocessed.
+    At most nthreads cameras are decoded ahead of the one being yielded, so
+    that decoded images do not pile up when the caller is slower than the
+    threads. The headers are read before any data, in the calling thread.
+
+    The threads access the .data of HDUs of the same astropy HDUList, which
+    relies on astropy reading separate HDUs of a file safely from several
+    threads; use nthreads=1 if it does not.
+
+    Args:
+        filename : input fits filename with DESI raw data
+
+    Options:
+        cameras : list of camera names (B0,R1, .. Z9); default is all cameras
+            in the file. Cameras not in the file are logged and skipped.
+        nthreads : number of threads decompressing camera HDUs
+
+    Yields (camera, rawimage, header) tuples, with lowercase camera names,
+        in the order of cameras
+    '''
+    fx = fits.open(filename, memmap=True)
+    try:
+        extnames = [hdu.name.upper() for hdu in fx[1:]]
+        if cameras is None:
+            cameras = [name for name in extnames
+                if len(name) == 2 and name[0] in 'BRZ' and name[1].isdigit()]
+        headers = collections.OrderedDict()
+        for camera in cameras:
+            if camera.upper() not in extnames:
+                log.error('Camera {} not in {}'.format(camera, filename))
+                continue
+            headers[camera.lower()] = _inherit_header(fx, camera)
+
+        def read_data(camera):
+            return camera, fx[camera.upper()].data
+
+        if nthreads > 1 and len(headers) > 1:
+            pool = multiprocessing.pool.ThreadPool(min(nthreads, len(headers)))
+            try:
+                pending = collections.deque()
+                for camera in headers:
+                    pending.append(pool.apply_async(read_data, (camera,)))
+                    if len(pending) > nthreads:
+                        camera, rawimage = pending.popleft().get()
+                        yield camera, rawimage, headers[camera]
+                while len(pending) > 0:
+                    camera, rawimage = pending.popleft().get()
+                    yield camera, rawimage, headers[camera]
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for camera in headers:
+                yield camera, fx[camera.upper()].data, headers[camera]
+    finally:
+        fx.close()
 
 def write_raw(filename, rawdata, header, camera=None, primary_header=None):
     '''
@@ -4,16 +4,15 @@ desispec.io.sky
 
 IO routines for sky.
 """
-import os
 from astropy.io import fits
 
 from desiutil.depend import add_dependencies
 
-from desispec.sky import SkyModel
+from desispec.sky import SkyModel, CompactSkyModel
 from desispec.io import findfile
-from desispec.io.util import fitsheader, native_endian, makepath
+from desispec.io.util import fitsheader, native_endian, makepath, write_hdulist
 
-def write_sky(outfile, skymodel, header=None):
+def write_sky(outfile, skymodel, header=None, compact=False):
     """Write sky model.
 
     Args:
@@ -24,6 +23,9 @@ def write_sky(outfile, skymodel, header=None):
             ivar : 2D inverse variance of sky flux
             mask : 2D mask for sky flux
         header : optional fits header data (fits.Header, dict, or list)
+        compact : write the 1D deconvolved sky, the band of its covariance
+            and the 1D ivar and mask of a CompactSkyModel instead of the
+            2D arrays (SKYFMT='DECONV' in the header)
     """
     outfile = makepath(outfile, 'sky')
 
@@ -38,14 +40,23 @@ def write_sky(outfile, skymodel, header=None):
     hx = fits.HDUList()
 
     hdr['EXTNAME'] = ('SKY', 'no dimension')
-    hx.append( fits.PrimaryHDU(skymodel.flux.astype('f4'), header=hdr) )
-    hx.append( fits.ImageHDU(skymodel.ivar.astype('f4'), name='IVAR') )
-    hx.append( fits.CompImageHDU(skymodel.mask, name='MASK') )
+    if compact:
+        if not isinstance(skymodel, CompactSkyModel):
+            raise ValueError('compact sky files require a CompactSkyModel')
+        hdr['SKYFMT'] = ('DECONV', 'deconvolved sky, convolve with frame resolution')
+        hdr['NSPEC'] = (skymodel.nspec, 'number of spectra')
+        hx.append( fits.PrimaryHDU(skymodel.deconvolved.astype('f4'), header=hdr) )
+        hx.append( fits.ImageHDU(skymodel.mean_ivar.astype('f4'), name='IVAR') )
+        hx.append( fits.ImageHDU(skymodel.mean_mask, name='MASK') )
+        hx.append( fits.ImageHDU(skymodel.covariance.astype('f4'), name='COVARIANCE') )
+    else:
+        hx.append( fits.PrimaryHDU(skymodel.flux.astype('f4'), header=hdr) )
+        hx.append( fits.ImageHDU(skymodel.ivar.astype('f4'), name='IVAR') )
+        hx.append( fits.CompImageHDU(skymodel.mask, name='MASK') )
     hx.append( fits.ImageHDU(skymodel.wave.astype('f4'), name='WAVELENGTH') )
     hx[-1].header['BUNIT'] = 'Angstrom'
 
-    hx.writeto(outfile+'.tmp', clobber=True, checksum=True)
-    os.rename(outfile+'.tmp', outfile)
+    write_hdulist(hx, outfile)
 
     return outfile
 
@@ -54,6 +65,9 @@ def read_sky(filename) :
     wave, flux, ivar, mask, header.
     
     skymodel.wave is 1D common wavelength grid, the others are 2D[nspec, nwave]
+
+    Compact files (see write_sky) are returned as a CompactSkyModel without
+    resolution_data, which must be set from the frame before accessing flux.
     """
     #- check if filename is (night, expid, camera) tuple instead
     if not isinstance(filename, str):
@@ -67,6 +81,11 @@ def read_sky(filename) :
     skyflux = native_endian(fx["SKY"].data.astype('f8'))
     ivar = native_endian(fx["IVAR"].data.astype('f8'))
     mask = native_endian(fx["MASK"].data)
+    if hdr.get('SKYFMT') == 'DECONV':
+        covariance = native_endian(fx["COVARIANCE"].data.astype('f8'))
+        fx.close()
+        return CompactSkyModel(wave, skyflux, covariance, ivar, mask,
+                               nspec=hdr['NSPEC'], header=hdr)
     fx.close()
 
     skymodel = SkyModel(wave, skyflux, ivar, mask, header=hdr)
@@ -0,0 +1,527 @@
+"""
+desispec.io.storage
+===================
+
+Storage backends for the images, tables and headers of frame and brick files.
+
+Both backends write an :class:`astropy.io.fits.HDUList` built by the I/O
+functions and read back objects with the ``name``, ``ver``, ``header`` and
+``data`` of HDUs, which :func:`read_rows` reads partially:
+
+* ``fits`` (the default) stores them as FITS files.
+* ``npydir`` stores them in a directory, with one subdirectory of ``.npy``
+  chunks per image or table and an ``index.json`` file with their headers.
+  Images are chunked along their first axis (fibers) and their last axis
+  (wavelengths), optionally gzip compressed, so that reading a few spectra
+  only reads their chunks.  Rows can be appended to the images and tables
+  of an existing directory (:meth:`NpyDirBackend.append`) without rewriting
+  it, and separate processes can write chunk-aligned rows of a file created
+  with :meth:`NpyDirFile.create_image` (:meth:`NpyDirFile.write_rows`).
+
+Readers detect the backend from the path with :func:`get_backend`.
+"""
+from __future__ import absolute_import, division
+
+import os
+import gzip
+import json
+import shutil
+
+import numpy as np
+import astropy.io.fits
+import astropy.table
+import desiutil.io
+
+from .util import native_endian, write_hdulist, decode_resolution
+
+#- Index file of npydir directories
+index_filename = 'index.json'
+
+#- FITS keywords describing the data layout, not kept in npydir headers
+_structural_keys = ('SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2',
+    'NAXIS3', 'EXTEND', 'PCOUNT', 'GCOUNT', 'TFIELDS', 'ZIMAGE', 'ZBITPIX',
+    'ZNAXIS', 'ZNAXIS1', 'ZNAXIS2', 'ZNAXIS3', 'ZTILE1', 'ZTILE2', 'ZTILE3',
+    'ZCMPTYPE', 'ZQUANTIZ', 'ZDITHER0', 'ZNAME1', 'ZVAL1', 'ZNAME2', 'ZVAL2',
+    'ZSIMPLE', 'ZEXTEND', 'ZPCOUNT', 'ZGCOUNT', 'ZHECKSUM', 'ZDATASUM',
+    'CHECKSUM', 'DATASUM', 'BSCALE', 'BZERO')
+
+def read_rows(hdu, rows=None, dtype=None):
+    """Read rows of an image or table of any backend.
+
+    Resolution data encoded by :func:`desispec.io.util.encode_resolution`
+    are decoded.  Only the requested rows are read from memory-mapped FITS
+    HDUs and from npydir chunks.
+
+    Args:
+        hdu: FITS HDU or :class:`NpyDirItem`
+
+    Options:
+        rows: index, slice or index array along the first axis
+        dtype: output data type of images (default: data type of the file)
+
+    Returns:
+        native endian numpy array (FITS_rec for tables)
+    """
+    if isinstance(hdu, NpyDirItem):
+        return hdu.read(rows, dtype)
+    if _is_table(hdu):
+        data = hdu.data
+        if rows is not None:
+            data = data[rows]
+        return data.copy()
+    if 'RESENC' in hdu.header:
+        return decode_resolution(hdu, rows, 'f8' if dtype is None else dtype)
+    data = hdu.data
+    if rows is not None:
+        data = data[rows]
+    if dtype is None:
+        return native_endian(np.array(data))
+    return native_endian(data.astype(dtype))
+
+
+class FITSBackend(object):
+    """FITS files, one HDU per image or table"""
+    name = 'fits'
+
+    #- append() adds HDUs; the images of a file can't grow
+    appends_rows = False
+
+    def exists(self, path):
+        return os.path.isfile(path)
+
+    def open(self, path):
+        """Returns the memory-mapped HDUList of a file"""
+        return astropy.io.fits.open(path, uint=True, memmap=True)
+
+    def open_hdulist(self, path):
+        """Returns the HDUList of a file, for updates in memory"""
+        return astropy.io.fits.open(path, mode='readonly')
+
+    def write(self, hdus, path):
+        """Write an HDUList, see :func:`desispec.io.util.write_hdulist`"""
+        write_hdulist(hdus, path)
+
+    def append(self, hdus, path):
+        """Append HDUs to an existing file"""
+        with astropy.io.fits.open(path, mode='append') as hdu_list:
+            for hdu in hdus:
+                hdu_list.append(hdu)
+
+
+def _descr_to_json(dtype):
+    return np.lib.format.dtype_to_descr(dtype)
+
+def _json_to_descr(descr):
+    """Restore the tuples of a structured dtype descr read from JSON"""
+    if isinstance(descr, str):
+        return descr
+    fields = list()
+    for field in descr:
+        field = [field[0], _json_to_descr(field[1])] + [tuple(x) for x in field[2:]]
+        fields.append(tuple(field))
+    return fields
+
+def _is_table(hdu):
+    #- CompImageHDU is a BinTableHDU in astropy
+    return isinstance(hdu, astropy.io.fits.BinTableHDU) and \
+        not isinstance(hdu, astropy.io.fits.CompImageHDU)
+
+def _hdu_data(hdu):
+    """Returns the data of an HDU as a numpy array, structured for tables
+    with bytes strings"""
+    if hdu.data is None:
+        return None
+    if _is_table(hdu):
+        return desiutil.io.encode_table(astropy.table.Table(hdu.data)).as_array()
+    return np.asarray(hdu.data)
+
+
+class NpyDirItem(object):
+    """Image or table of an npydir directory, with the name, ver, header and
+    data attributes of an HDU.
+
+    Args:
+        dirname(str): npydir directory
+        info(dict): entry of the index file
+    """
+    def __init__(self, dirname, info):
+        self.dirname = dirname
+        self.info = info
+        self.name = info['name']
+        self.ver = info['ver']
+        self._header = None
+        self._data = None
+
+    @property
+    def header(self):
+        if self._header is None:
+            self._header = astropy.io.fits.Header.fromstring(self.info['header'], sep='\n')
+        return self._header
+
+    @property
+    def is_table(self):
+        return self.info['kind'] == 'table'
+
+    @property
+    def shape(self):
+        if self.info['shape'] is None:
+            return None
+        return tuple(self.info['shape'])
+
+    @property
+    def dtype(self):
+        return np.dtype(_json_to_descr(self.info['dtype']))
+
+    @property
+    def data(self):
+        """All the data, read when first accessed (None for empty HDUs)"""
+        if self._data is None and self.shape is not None:
+            self._data = self.read()
+        return self._data
+
+    def _col_starts(self):
+        ncol = self.shape[-1] if len(self.shape) > 1 and not self.is_table else 1
+        step = self.info['col_chunk'] or ncol
+        return list(range(0, max(ncol, 1), step))
+
+    def _chunk_path(self, irow, icol):
+        suffix = '.npy.gz' if self.info['compress'] else '.npy'
+        return os.path.join(self.dirname, self.info['subdir'],
+            'r{:d}_c{:d}{}'.format(irow, icol, suffix))
+
+    def _read_chunk(self, irow):
+        """Returns the rows of chunk irow, all column chunks joined"""
+        parts = list()
+        for icol in range(len(self._col_starts())):
+            path = self._chunk_path(irow, icol)
+            if self.info['compress']:
+                with gzip.open(path, 'rb') as fx:
+                    parts.append(np.load(fx))
+            else:
+                parts.append(np.load(path, mmap_mode='r'))
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts, axis=-1)
+
+    def _read_raw(self, rows):
+        """Read rows (index array or None for all) of the stored array"""
+        shape = self.shape
+        if len(shape) == 0 or (len(shape) == 1 and not self.is_table):
+            data = np.array(self._read_chunk(0))
+            return data if rows is None else data[rows]
+        row_starts = np.asarray(self.info['row_starts'] + [shape[0]])
+        if rows is None:
+            rows = np.arange(shape[0])
+        out = np.empty((len(rows),)+shape[1:], dtype=self.dtype)
+        chunk = np.searchsorted(row_starts, rows, side='right') - 1
+        for irow in np.unique(chunk):
+            select = np.where(chunk == irow)[0]
+            data = self._read_chunk(irow)
+            out[select] = data[rows[select] - row_starts[irow]]
+        return out
+
+    def read(self, rows=None, dtype=None):
+        """Read rows (index, slice or index array) of the data, see read_rows"""
+        if self.shape is None:
+            return None
+        index = None
+        if rows is not None and len(self.shape) > 0:
+            index = np.arange(self.shape[0])[rows]
+        if 'RESENC' in self.header:
+            if self.header['RESENC'] != 'QREF':
+                raise ValueError('unknown resolution encoding {}'.format(self.header['RESENC']))
+            #- row 0 is the reference kernel, see encode_resolution
+            nspec = self.shape[0] - 1
+            if index is None:
+                index = np.arange(nspec)
+            scalar = np.ndim(index) == 0
+            q = self._read_raw(np.atleast_1d(index) + 1)
+            data = (q + self._read_raw(np.array([0]))[0]).astype('f8' if dtype is None else dtype)
+            data *= self.header['RESQSTEP']
+            return data[0] if scalar else data
+        scalar = np.ndim(index) == 0 and index is not None
+        data = self._read_raw(None if index is None else np.atleast_1d(index))
+        if scalar:
+            data = data[0]
+        if self.is_table:
+            #- FITS_rec, as read from FITS files, with str columns
+            return astropy.io.fits.BinTableHDU(data).data
+        if dtype is not None:
+            data = data.astype(dtype)
+        return native_endian(data)
+
+
+class NpyDirFile(object):
+    """Images and tables of an npydir directory, indexed like an HDUList by
+    position, EXTNAME or (EXTNAME, EXTVER).
+
+    Args:
+        path(str): npydir directory
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, index_filename)) as fx:
+            self.index = json.load(fx)
+        self.items = [NpyDirItem(path, info) for info in self.index['items']]
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def _find(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.items[key]
+        if isinstance(key, tuple):
+            name, ver = key
+        else:
+            name, ver = key, None
+        for item in self.items:
+            if item.name == name and (ver is None or item.ver == ver):
+                return item
+        raise KeyError('{} not found in {}'.format(key, self.path))
+
+    def __getitem__(self, key):
+        return self._find(key)
+
+    def __contains__(self, key):
+        try:
+            self._find(key)
+        except KeyError:
+            return False
+        return True
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _save_index(self):
+        self.index['items'] = [item.info for item in self.items]
+        filename = os.path.join(self.path, index_filename)
+        with open(filename+'.tmp', 'w') as fx:
+            json.dump(self.index, fx)
+        os.rename(filename+'.tmp', filename)
+
+    def _write_chunks(self, item, irow, data):
+        """Write the column chunks of rows data as chunk row irow of item"""
+        col_starts = item._col_starts()
+        for icol, start in enumerate(col_starts):
+            if len(item.shape) > 1 and not item.is_table:
+                stop = col_starts[icol+1] if icol+1 < len(col_starts) else None
+                part = data[..., start:stop]
+            else:
+                part = data
+            path = item._chunk_path(irow, icol)
+            if item.info['compress']:
+                with gzip.open(path+'.tmp', 'wb', compresslevel=4) as fx:
+                    np.save(fx, np.ascontiguousarray(part))
+            else:
+                with open(path+'.tmp', 'wb') as fx:
+                    np.save(fx, np.ascontiguousarray(part))
+            os.rename(path+'.tmp', path)
+
+    def add(self, name, data, header=None, ver=1, table=False, chunks=(50, 1000),
+            compress=False, shape=None, dtype=None):
+        """Add an image or table and write its data, if any.
+
+        Args:
+            name(str): EXTNAME
+            data: numpy array (structured for tables), or None to only declare
+                an image of the given shape and dtype written by write_rows
+
+        Options:
+            header: astropy.io.fits.Header
+            ver(int): EXTVER
+            table(bool): data is a table, chunked along rows only
+            chunks: number of (rows, columns) per chunk of images; tables
+                and 1D images use chunks[0] rows
+            compress(bool): gzip the chunks
+            shape, dtype: shape and dtype of an image without data
+        """
+        if header is None:
+            header = astropy.io.fits.Header()
+        header = header.copy()
+        for key in _structural_keys:
+            header.remove(key, ignore_missing=True, remove_all=True)
+        header['EXTNAME'] = name
+        if data is not None:
+            shape, dtype = data.shape, data.dtype
+        subdir = '{}_{}'.format(name, ver)
+        if os.path.exists(os.path.join(self.path, subdir)):
+            raise ValueError('{} already has {}'.format(self.path, subdir))
+        os.makedirs(os.path.join(self.path, subdir))
+        info = dict(name=name, ver=ver, kind='table' if table else 'image',
+            header=header.tostring(sep='\n', endcard=False, padding=False),
+            shape=None, dtype=None, row_starts=[0], col_chunk=None,
+            compress=bool(compress), subdir=subdir)
+        if shape is not None:
+            info['shape'] = list(shape)
+            info['dtype'] = _descr_to_json(np.dtype(dtype))
+            if len(shape) > 1 or table:
+                info['row_starts'] = list(range(0, max(shape[0], 1), chunks[0]))
+                if not table and len(shape) > 1 and chunks[1] is not None:
+                    info['col_chunk'] = chunks[1]
+        item = NpyDirItem(self.path, info)
+        self.items.append(item)
+        if data is not None:
+            if len(shape) == 0 or (len(shape) == 1 and not table):
+                self._write_chunks(item, 0, data)
+            else:
+                starts = info['row_starts'] + [shape[0]]
+                for irow in range(len(starts)-1):
+                    self._write_chunks(item, irow, data[starts[irow]:starts[irow+1]])
+        self._save_index()
+        return item
+
+    def create_image(self, name, shape, dtype, header=None, chunks=(50, 1000), compress=False):
+        """Declare an image whose rows are then written with write_rows()"""
+        return self.add(name, None, header=header, chunks=chunks, compress=compress,
+                        shape=shape, dtype=dtype)
+
+    def write_rows(self, name, start, data):
+        """Write rows start:start+len(data) of an image declared by create_image().
+
+        start and the end of the rows must be chunk boundaries (or the end of
+        the image), so that processes writing separate rows write separate
+        chunk files and don't need to update the index.
+        """
+        item = self._find(name)
+        starts = item.info['row_starts'] + [item.shape[0]]
+        stop = start + len(data)
+        if start not in starts or stop not in starts:
+            raise ValueError('rows {}:{} are not aligned with the chunks of {}'.format(
+                start, stop, name))
+        if tuple(data.shape[1:]) != item.shape[1:]:
+            raise ValueError('rows of shape {} do not match {}'.format(data.shape, item.shape))
+        for irow in range(starts.index(start), starts.index(stop)):
+            self._write_chunks(item, irow, data[starts[irow]-start:starts[irow+1]-start])
+
+    def append_rows(self, name, data, ver=None):
+        """Append rows to an image or table as a new chunk row"""
+        item = self._find(name if ver is None else (name, ver))
+        if 'RESENC' in item.header:
+            raise ValueError('cannot append rows to encoded resolution data')
+        if item.shape is None:
+            raise ValueError('cannot append rows to an empty HDU')
+        if tuple(data.shape[1:]) != item.shape[1:]:
+            raise ValueError('rows of shape {} do not match {}'.format(data.shape, item.shape))
+        if len(data) == 0:
+            return
+        if item.is_table:
+            #- same columns in the same order and types
+            data = np.asarray(data).astype(item.dtype)
+        nrow = item.shape[0]
+        if nrow == 0:
+            irow = 0
+        else:
+            irow = len(item.info['row_starts'])
+            item.info['row_starts'].append(nrow)
+        self._write_chunks(item, irow, data)
+        item.info['shape'][0] = nrow + len(data)
+        item._data = None
+        self._save_index()
+
+    def to_hdulist(self):
+        """Returns an in-memory astropy HDUList with all the data"""
+        hdus = astropy.io.fits.HDUList()
+        for i, item in enumerate(self.items):
+            data = item.read() if 'RESENC' not in item.header else item._read_raw(None)
+            header = item.header.copy()
+            if item.is_table:
+                hdu = astropy.io.fits.BinTableHDU(data, header=header, name=item.name, ver=item.ver)
+            elif i == 0:
+                hdu = astropy.io.fits.PrimaryHDU(data, header=header)
+            else:
+                hdu = astropy.io.fits.ImageHDU(data, header=header, name=item.name, ver=item.ver)
+            hdus.append(hdu)
+        return hdus
+
+
+class NpyDirBackend(object):
+    """Directories of chunked .npy files, see :class:`NpyDirFile`
+
+    Options:
+        chunks: number of (fibers, wavelengths) per image chunk
+        compress(bool): gzip the chunks
+    """
+    name = 'npydir'
+
+    #- append() adds rows to the images and tables of the same name
+    appends_rows = True
+
+    def __init__(self, chunks=(50, 1000), compress=False):
+        self.chunks = chunks
+        self.compress = compress
+
+    def exists(self, path):
+        return os.path.isfile(os.path.join(path, index_filename))
+
+    def open(self, path):
+        return NpyDirFile(path)
+
+    def open_hdulist(self, path):
+        """Returns the NpyDirFile of a directory, whose data are read when
+        first accessed; use NpyDirFile.to_hdulist() to update them in memory"""
+        return NpyDirFile(path)
+
+    def write(self, hdus, path):
+        """Write an HDUList to a new directory that replaces path, if any"""
+        tmppath = path+'.tmp'
+        if os.path.exists(tmppath):
+            shutil.rmtree(tmppath)
+        os.makedirs(tmppath)
+        with open(os.path.join(tmppath, index_filename), 'w') as fx:
+            json.dump(dict(format='desispec-npydir', version=1, items=[]), fx)
+        npydir = NpyDirFile(tmppath)
+        for hdu in hdus:
+            name = hdu.name if hdu.name != '' else 'PRIMARY'
+            npydir.add(name, _hdu_data(hdu), header=hdu.header, ver=hdu.ver,
+                table=_is_table(hdu),
+                chunks=self.chunks, compress=self.compress)
+        #- chunk paths are relative to the directory, which can be renamed
+        if os.path.exists(path):
+            oldpath = path+'.old'
+            os.rename(path, oldpath)
+            os.rename(tmppath, path)
+            if os.path.isdir(oldpath):
+                shutil.rmtree(oldpath)
+            else:
+                os.remove(oldpath)
+        else:
+            os.rename(tmppath, path)
+
+    def append(self, hdus, path):
+        """Append the rows of HDUs to the images and tables of the same name"""
+        npydir = NpyDirFile(path)
+        for hdu in hdus:
+            npydir.append_rows(hdu.name, _hdu_data(hdu))
+
+
+_backends = dict(fits=FITSBackend, npydir=NpyDirBackend)
+
+def get_backend(backend=None, path=None):
+    """Returns a storage backend.
+
+    Options:
+        backend: backend object, or name among 'fits' and 'npydir'
+        path(str): if backend is None, use the backend of this existing
+            file or directory, or fits
+
+    Returns:
+        FITSBackend or NpyDirBackend object
+    """
+    if backend is None:
+        if path is not None and os.path.isfile(os.path.join(path, index_filename)):
+            return NpyDirBackend()
+        return FITSBackend()
+    if isinstance(backend, str):
+        if backend not in _backends:
+            raise ValueError('unknown storage backend {}'.format(backend))
+        return _backends[backend]()
+    return backend
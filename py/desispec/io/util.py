@@ -5,11 +5,19 @@ desispec.io.util
 Utility functions for desispec IO.
 """
 import os
+import contextlib
+import threading
 import astropy.io
 import numpy as np
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import desiutil.io
 
+from .fileindex import record_file
+
 def iterfiles(root, prefix):
     '''
     Returns iterator over files starting with `prefix` found under `root` dir
@@ -79,6 +87,66 @@ def native_endian(data):
     else:
         return data.byteswap().newbyteorder()
 
+def encode_resolution(resolution_data, max_error, name='RESOLUTION'):
+    """Returns a compressed HDU storing resolution data with a maximum error.
+
+    The values are quantized in steps of 2*max_error. Row 0 of the integer
+    image holds the median kernel of all spectra, and rows 1 to nspec hold
+    the difference of each spectrum to it, which is small and compresses
+    well (RICE).
+
+    Args:
+        resolution_data: 3D[nspec, ndiag, nwave] resolution data
+        max_error: maximum absolute error of the decoded values
+
+    Options:
+        name: EXTNAME of the HDU
+
+    Returns:
+        astropy.io.fits.CompImageHDU, decoded by decode_resolution
+    """
+    step = 2.*max_error
+    q = np.rint(np.asarray(resolution_data, dtype=np.float64)/step)
+    if q.size > 0 and np.max(np.abs(q)) >= 2**30:
+        raise ValueError('max_error {} is too small for resolution values up to {}'.format(
+            max_error, np.max(np.abs(resolution_data))))
+    q = q.astype(np.int32)
+    ref = np.rint(np.median(q, axis=0)).astype(np.int32)
+    hdu = astropy.io.fits.CompImageHDU(np.concatenate([ref[None], q-ref]),
+        name=name, compression_type='RICE_1')
+    hdu.header['RESENC'] = ('QREF', 'row 0 is a reference, others are differences')
+    hdu.header['RESQSTEP'] = (step, 'quantization step of resolution values')
+    return hdu
+
+def decode_resolution(hdu, rows=None, dtype='f8'):
+    """Returns the resolution data of an HDU, decoding it if it was written
+    by encode_resolution.
+
+    Args:
+        hdu: image HDU with resolution data
+
+    Options:
+        rows: index or slice of the spectra to read
+        dtype: output data type
+
+    Returns:
+        3D[nspec, ndiag, nwave] native endian array
+    """
+    if 'RESENC' not in hdu.header:
+        data = hdu.data
+        if rows is not None:
+            data = data[rows]
+        return native_endian(data.astype(dtype))
+    if hdu.header['RESENC'] != 'QREF':
+        raise ValueError('unknown resolution encoding {}'.format(hdu.header['RESENC']))
+    data = hdu.data
+    q = data[1:]
+    if rows is not None:
+        q = q[rows]
+    resolution_data = (q + data[0]).astype(dtype)
+    resolution_data *= hdu.header['RESQSTEP']
+    return resolution_data
+
 def makepath(outfile, filetype=None):
     """Create path to outfile if needed.
 
@@ -102,6 +170,112 @@ def makepath(outfile, filetype=None):
 
     return outfile
 
+class _WriteBehind(object):
+    """Writes HDU lists in a background thread, from a bounded queue.
+
+    Args:
+        maxsize(int): maximum number of files waiting to be written, after
+            which write_hdulist blocks until one of them is written.
+    """
+    def __init__(self, maxsize=2):
+        self.queue = queue.Queue(maxsize)
+        self.errors = list()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                hdus, outfile = item
+                try:
+                    _write_hdulist_now(hdus, outfile)
+                except Exception as err:
+                    self.errors.append((outfile, err))
+            finally:
+                self.queue.task_done()
+
+    def put(self, hdus, outfile):
+        self.queue.put((hdus, outfile))
+
+    def flush(self):
+        """Wait for the queued files and raise IOError if any of the writes
+        since the last flush failed."""
+        self.queue.join()
+        errors, self.errors = self.errors, list()
+        if len(errors) > 0:
+            raise IOError('failed to write {}'.format(', '.join(
+                ['{} ({})'.format(outfile, err) for outfile, err in errors])))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.flush()
+
+#- Background writer used by write_hdulist, if any
+_write_behind = None
+
+def _write_hdulist_now(hdus, outfile):
+    hdus.writeto(outfile+'.tmp', clobber=True, checksum=True)
+    os.rename(outfile+'.tmp', outfile)
+    record_file(outfile)
+
+def write_hdulist(hdus, outfile):
+    """Write an HDUList with checksums to outfile+'.tmp' and rename it outfile.
+
+    Inside a write_behind() block, the file is written by a background thread
+    and this returns as soon as it is queued; the data of compressed HDUs,
+    which astropy does not copy, are copied first.
+
+    Args:
+        hdus: astropy.io.fits.HDUList, which must not be modified afterwards
+        outfile: output file path
+    """
+    if _write_behind is None:
+        _write_hdulist_now(hdus, outfile)
+    else:
+        for hdu in hdus:
+            if isinstance(hdu, astropy.io.fits.CompImageHDU) and hdu.data is not None:
+                hdu.data = np.array(hdu.data)
+        _write_behind.put(hdus, outfile)
+
+def flush_writes():
+    """Wait until the files queued in a write_behind() block are written.
+
+    Raises IOError if any of them could not be written since the last flush.
+    Does nothing outside of a write_behind() block.
+    """
+    if _write_behind is not None:
+        _write_behind.flush()
+
+@contextlib.contextmanager
+def write_behind(maxsize=2):
+    """Context manager writing the FITS files of write_frame, write_sky,
+    write_fiberflat, write_flux_calibration and write_image in a background
+    thread, so that the next computations overlap with their compression,
+    checksums and writes.
+
+    Files are still written to a temporary file renamed when complete.
+    Write errors are raised by flush_writes() or when leaving the block.
+
+    Args:
+        maxsize(int): maximum number of files waiting to be written
+    """
+    global _write_behind
+    if _write_behind is not None:
+        #- nested blocks use the outer writer
+        yield
+        return
+    _write_behind = _WriteBehind(maxsize)
+    try:
+        yield
+    finally:
+        writer, _write_behind = _write_behind, None
+        writer.close()
+
 def write_bintable(filename, data, header=None, comments=None, units=None,
                    extname=None, clobber=False):
     """Utility function to write a fits binary table complete with
@@ -159,6 +333,7 @@ def write_bintable(filename, data, header=None, comments=None, units=None,
     #- Write updated header and close file
     fx.flush()
     fx.close()
+    record_file(filename)
 
 def _dict2ndarray(data, columns=None):
     """
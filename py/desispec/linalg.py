@@ -5,7 +5,7 @@ desispec.linalg
 Some linear algebra functions.
 """
 import numpy as np
-import scipy,scipy.linalg,scipy.interpolate
+import scipy,scipy.linalg,scipy.interpolate,scipy.sparse
 from desispec.log import get_logger
 
 def cholesky_solve(A,B,overwrite=False,lower=False):
@@ -66,6 +66,158 @@ def cholesky_invert(A) :
     return inv
 
 
+def cholesky_solve_banded(Ab,B,overwrite=False,lower=False):
+    """Returns the solution X of the linear system A.X=B
+    assuming A is a banded positive definite matrix
+
+    Args :
+         Ab : 2D (u+1)xn positive definite matrix in LAPACK banded storage,
+              with A[i,j] = Ab[u+i-j,j] for i<=j (upper form, default)
+              or A[i,j] = Ab[i-j,j] for i>=j (lower form)
+         B : 1D vector of dimension n, or 2D array (n,m)  (numpy.ndarray)
+
+    Options :
+        overwrite: replace Ab data by cholesky decomposition (faster)
+        lower: Ab is stored in lower instead of upper banded form
+
+    Returns :
+         X : same dimension as B  (numpy.ndarray)
+
+    """
+    C = scipy.linalg.cholesky_banded(Ab, lower=lower, overwrite_ab=overwrite)
+    X = scipy.linalg.cho_solve_banded((C,lower),B)
+    return X
+
+
+def _band_to_rows(Cb,lower):
+    """Returns the (n,u+1) array T with T[i,d] = M[i,i+d] of the banded matrix
+    M stored in Cb, taking the transpose of a lower banded matrix"""
+    u = Cb.shape[0]-1
+    n = Cb.shape[1]
+    T = np.zeros((n,u+1))
+    for d in range(u+1) :
+        if lower :
+            T[:n-d,d] = Cb[d,:n-d]
+        else :
+            T[:n-d,d] = Cb[u-d,d:]
+    return T
+
+def _rows_to_band(T,lower):
+    """Inverse of _band_to_rows for a symmetric matrix"""
+    n,m = T.shape
+    u = m-1
+    Cb = np.zeros((m,n))
+    for d in range(m) :
+        if lower :
+            Cb[d,:n-d] = T[:n-d,d]
+        else :
+            Cb[u-d,d:] = T[:n-d,d]
+    return Cb
+
+def cholesky_invert_banded(Ab,overwrite=False,lower=False,diagonal=False):
+    """Returns the band of the inverse of a banded positive definite matrix
+
+    The entries of the inverse within the band of A are computed with the
+    selected inversion recurrence on the banded Cholesky decomposition of A,
+    in O(n u^2) operations and O(n u) memory, without the dense nxn inverse.
+
+    Args :
+         Ab : 2D (u+1)xn positive definite matrix in LAPACK banded storage,
+              as in cholesky_solve_banded
+
+    Options :
+        overwrite: replace Ab data by cholesky decomposition (faster)
+        lower: Ab is stored in lower instead of upper banded form
+        diagonal: only return the diagonal of the inverse
+
+    Returns :
+         Cb : 2D (u+1)xn band of the inverse of A in the same storage as Ab
+              (numpy.ndarray), or 1D diagonal of dimension n if diagonal=True
+    """
+    C = scipy.linalg.cholesky_banded(Ab, lower=lower, overwrite_ab=overwrite)
+    return cholesky_invert_banded_factor(C,lower=lower,diagonal=diagonal)
+
+def cholesky_invert_banded_factor(C,lower=False,diagonal=False):
+    """Returns the band of the inverse of a banded positive definite matrix
+    given its banded Cholesky decomposition
+
+    Args :
+         C : 2D (u+1)xn banded Cholesky decomposition of A, as returned by
+             scipy.linalg.cholesky_banded
+
+    Options :
+        lower: C is stored in lower instead of upper banded form
+        diagonal: only return the diagonal of the inverse
+
+    Returns :
+         same as cholesky_invert_banded
+    """
+    u = C.shape[0]-1
+    n = C.shape[1]
+    # U[i,i+d] of the upper triangular factor A = U^T U (for a lower factor, U = L^T)
+    U = _band_to_rows(C,lower)
+    # Z[i,i+d] of the inverse, filled from the last row up with
+    # Z[i,j] = (delta_ij/U[i,i] - sum_{k>i} U[i,k] Z[k,j])/U[i,i]
+    Z = np.zeros((n,u+1))
+    a,b = np.meshgrid(np.arange(1,u+1),np.arange(1,u+1),indexing='ij')
+    first = np.minimum(a,b)
+    offset = np.abs(a-b)
+    for i in range(n-1,-1,-1) :
+        m = min(u,n-1-i)
+        inv_uii = 1./U[i,0]
+        if m > 0 :
+            # symmetric block Z[i+1:i+m+1,i+1:i+m+1]
+            block = Z[i+first[:m,:m],offset[:m,:m]]
+            Z[i,1:m+1] = -inv_uii*U[i,1:m+1].dot(block)
+            Z[i,0] = inv_uii*(inv_uii-U[i,1:m+1].dot(Z[i,1:m+1]))
+        else :
+            Z[i,0] = inv_uii**2
+    if diagonal :
+        return Z[:,0].copy()
+    return _rows_to_band(Z,lower)
+
+def banded_sandwich_diagonal(R,Cb,lower=False):
+    """Returns the diagonal of R.C.R^T for a sparse matrix R and a symmetric
+    banded matrix C, without computing any dense matrix
+
+    This is typically used to compute the variance of a deconvolved solution
+    convolved by a resolution matrix, with C the band of the covariance
+    returned by cholesky_invert_banded. Only the entries C[k,l] with |k-l|<=u
+    are needed, so the band must be at least as wide as R.
+
+    Args :
+         R : 2D (m x n) sparse matrix (e.g. desispec.resolution.Resolution)
+         Cb : 2D (u+1)xn symmetric banded matrix in LAPACK banded storage
+
+    Options :
+        lower: Cb is stored in lower instead of upper banded form
+
+    Returns :
+         1D vector of dimension m (numpy.ndarray)
+    """
+    u = Cb.shape[0]-1
+    n = Cb.shape[1]
+    Rd = scipy.sparse.dia_matrix(R)
+    nrow = Rd.shape[0]
+    offsets = Rd.offsets
+    if offsets.size > 0 and np.max(offsets)-np.min(offsets) > u :
+        raise ValueError("band of C (u={0:d}) does not cover the width of R ({1:d})".format(u,np.max(offsets)-np.min(offsets)))
+    # C[k,k+d] for d>=0
+    T = _band_to_rows(Cb,lower)
+    result = np.zeros(nrow)
+    rows = np.arange(nrow)
+    for a,oa in enumerate(offsets) :
+        for b,ob in enumerate(offsets) :
+            # R[i,i+oa] C[i+oa,i+ob] R[i,i+ob], with R[i,i+o] = data[.,i+o] in dia storage
+            ka = rows+oa
+            kb = rows+ob
+            ok = (ka>=0)&(ka<min(n,Rd.data.shape[1]))&(kb>=0)&(kb<min(n,Rd.data.shape[1]))
+            ka = ka[ok]
+            kb = kb[ok]
+            result[rows[ok]] += Rd.data[a,ka]*Rd.data[b,kb]*T[np.minimum(ka,kb),np.abs(ob-oa)]
+    return result
+
+
 def spline_fit(output_wave,input_wave,input_flux,required_resolution,input_ivar=None,order=3):
     """Performs spline fit of input_flux vs. input_wave and resamples at output_wave
     
@@ -101,3 +253,177 @@ def spline_fit(output_wave,input_wave,input_flux,required_resolution,input_ivar=
     toto=scipy.interpolate.splrep(input_wave,input_flux,w=input_ivar,k=order,task=-1,t=knots)
     output_flux = scipy.interpolate.splev(output_wave,toto)
     return output_flux
+
+
+class SplineFitter(object):
+    """Weighted least-squares spline fits of many spectra sampled on the same grid
+
+    fit() returns for each row of y, w and valid the same result as
+    spline_fit(x,x[valid],y[valid],required_resolution,w[valid]), i.e. the
+    boundary knots are the first and last valid points and the interior knots
+    are spaced by about required_resolution between the first and last points
+    with w>0. As for scipy.interpolate.splrep, the fit minimizes
+    sum (w*(y-spline))^2, so w is usually an inverse variance.
+
+    The sparse B-spline design matrix of each knot vector is built once and
+    the normal equations of all rows sharing it are filled and solved
+    together. The normal equations of each row are kept, so that refit()
+    only adds the pixels whose weights or values have changed.
+
+    Args:
+        x : 1D sorted vector of sample positions shared by all rows
+        required_resolution (float) : resolution for spline knot placement
+
+    Options:
+        order (int) : spline order
+    """
+    def __init__(self, x, required_resolution, order=3):
+        self.x = np.asarray(x, dtype=float)
+        self.required_resolution = required_resolution
+        self.order = order
+        self._bases = {}
+        self._rows = {}
+
+    def _key(self, w, valid):
+        """Indices of the first and last valid points and points with w>0"""
+        positive = np.where(valid & (w>0))[0]
+        if positive.size == 0 :
+            return None
+        selection = np.where(valid)[0]
+        return (selection[0], selection[-1], positive[0], positive[-1])
+
+    def _basis(self, key):
+        """Returns the CSR design matrix B[nx,ncoef] and the CSR matrix P[nx,ncoef**2]
+        of the products B[i,a]*B[i,b], for a knot vector defined by key"""
+        if key in self._bases :
+            return self._bases[key]
+        k = self.order
+        xb = self.x[key[0]]
+        xe = self.x[key[1]]
+        # interior knots, as in spline_fit
+        w1 = self.x[key[2]]
+        w2 = self.x[key[3]]
+        n = int((w2-w1)/self.required_resolution)
+        res = (w2-w1)/(n+1)
+        knots = w1+res*(0.5+np.arange(n))
+        t = np.concatenate([np.repeat(xb,k+1), knots, np.repeat(xe,k+1)])
+        ncoef = t.size-k-1
+        # evaluate (and extrapolate) each basis spline as splev does
+        coef = np.zeros(t.size)
+        dense = np.zeros((self.x.size, ncoef))
+        for j in range(ncoef) :
+            coef[j] = 1.
+            dense[:, j] = scipy.interpolate.splev(self.x, (t, coef, k))
+            coef[j] = 0.
+        # each row has (at most) k+1 consecutive non-zero entries
+        first = np.clip(np.argmax(dense!=0, axis=1), 0, ncoef-k-1)
+        cols = first[:, None]+np.arange(k+1)[None, :]
+        values = dense[np.arange(self.x.size)[:, None], cols]
+        rows = np.repeat(np.arange(self.x.size), k+1)
+        B = scipy.sparse.csr_matrix((values.ravel(), (rows, cols.ravel())), shape=dense.shape)
+        pcols = (cols[:, :, None]*ncoef+cols[:, None, :]).reshape(self.x.size, -1)
+        pvalues = (values[:, :, None]*values[:, None, :]).reshape(self.x.size, -1)
+        prows = np.repeat(np.arange(self.x.size), (k+1)**2)
+        P = scipy.sparse.csr_matrix((pvalues.ravel(), (prows, pcols.ravel())), shape=(self.x.size, ncoef**2))
+        self._bases[key] = (B, P)
+        return B, P
+
+    def _weighted(self, y, w, valid):
+        W = np.where(valid, np.asarray(w, dtype=float)**2, 0.)
+        Wy = np.where(W>0, W*y, 0.)
+        return W, Wy
+
+    def _solve(self, A, b, B, y, w, valid):
+        """Solve the normal equations of one row, falling back to spline_fit
+        (which raises the same errors as before) if they are singular"""
+        try :
+            coef = np.linalg.solve(A, b)
+        except np.linalg.LinAlgError :
+            return spline_fit(self.x, self.x[valid], y[valid], self.required_resolution, w[valid], order=self.order)
+        return B.dot(coef)
+
+    def fit(self, y, w, valid=None):
+        """Fit all rows
+
+        Args:
+            y : 2D[nrow, nx] values to fit
+            w : 2D[nrow, nx] weights (>=0)
+
+        Options:
+            valid : 2D[nrow, nx] boolean selection of the points used as input
+                    to the fit (default is w>0)
+
+        Returns:
+            2D[nrow, nx] fitted splines evaluated at x, 0 for rows without w>0
+        """
+        y = np.asarray(y, dtype=float)
+        w = np.asarray(w, dtype=float)
+        if valid is None :
+            valid = (w>0)
+        result = np.zeros(y.shape)
+        W, Wy = self._weighted(y, w, valid)
+        keys = [self._key(w[i], valid[i]) for i in range(y.shape[0])]
+        groups = {}
+        for i, key in enumerate(keys) :
+            self._rows.pop(i, None)
+            if key is not None :
+                groups.setdefault(key, []).append(i)
+        for key, rows in groups.items() :
+            B, P = self._basis(key)
+            ncoef = B.shape[1]
+            A = P.T.dot(W[rows].T).T.reshape(len(rows), ncoef, ncoef)
+            b = B.T.dot(Wy[rows].T).T
+            try :
+                coef = np.linalg.solve(A, b[:, :, None])[:, :, 0]
+                result[rows] = B.dot(coef.T).T
+            except np.linalg.LinAlgError :
+                for j, i in enumerate(rows) :
+                    result[i] = self._solve(A[j], b[j], B, y[i], w[i], valid[i])
+            for j, i in enumerate(rows) :
+                self._rows[i] = (key, W[i], Wy[i], A[j], b[j])
+        return result
+
+    def refit(self, index, y, w, valid=None, max_fraction=0.1):
+        """Fit a single row, updating its previous normal equations
+
+        Only the points whose weighted values differ from the previous fit of
+        this row are added/removed, unless the knots have changed or more than
+        max_fraction of the points have changed.
+
+        Args:
+            index : row index, as in fit()
+            y : 1D[nx] values to fit
+            w : 1D[nx] weights (>=0)
+
+        Options:
+            valid : 1D[nx] boolean selection of the points used as input (default is w>0)
+            max_fraction : refill the normal equations from scratch above this fraction
+
+        Returns:
+            1D[nx] fitted spline evaluated at x
+        """
+        y = np.asarray(y, dtype=float)
+        w = np.asarray(w, dtype=float)
+        if valid is None :
+            valid = (w>0)
+        key = self._key(w, valid)
+        if key is None :
+            # same error as spline_fit
+            return spline_fit(self.x, self.x[valid], y[valid], self.required_resolution, w[valid], order=self.order)
+        W, Wy = self._weighted(y, w, valid)
+        B, P = self._basis(key)
+        ncoef = B.shape[1]
+        previous = self._rows.get(index)
+        changed = None
+        if previous is not None and previous[0] == key :
+            changed = np.where((W != previous[1]) | (Wy != previous[2]))[0]
+            if changed.size > max_fraction*W.size :
+                changed = None
+        if changed is None :
+            A = P.T.dot(W).reshape(ncoef, ncoef)
+            b = B.T.dot(Wy)
+        else :
+            A = previous[3] + P[changed].T.dot(W[changed]-previous[1][changed]).reshape(ncoef, ncoef)
+            b = previous[4] + B[changed].T.dot(Wy[changed]-previous[2][changed])
+        self._rows[index] = (key, W, Wy, A, b)
+        return self._solve(A, b, B, y, w, valid)
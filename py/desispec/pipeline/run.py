@@ -32,6 +32,7 @@ import desispec
 import desispec.log
 from desispec.log import get_logger
 from desispec.util import default_nproc, dist_uniform, dist_discrete
+from desispec.io.fileindex import open_index
 from .plan import *
 from .utils import option_list
 
@@ -122,7 +123,19 @@ def finish_task(name, node):
     pass
 
 
-def is_finished(rawdir, proddir, grph, name):
+def _file_state(path, indexed):
+    """Returns (mtime, islink) of a file, or None if it doesn't exist, from
+    the (root, states) file indexes in indexed if path is under one of them."""
+    path = os.path.normpath(path)
+    for root, states in indexed:
+        if path.startswith(root+os.sep):
+            return states.get(path)
+    if not os.path.isfile(path):
+        return None
+    return (os.path.getmtime(path), os.path.islink(path))
+
+
+def is_finished(rawdir, proddir, grph, name, indexed=()):
     '''
     Determine whether a single data object is finished.
 
@@ -134,35 +147,37 @@ def is_finished(rawdir, proddir, grph, name):
         proddir (str): the path to the production directory.
         grph (dict): the dependency graph.
         name (str): the object name.
+        indexed (list): optional (root, states) tuples, where states is
+            the dictionary returned by FileIndex.file_states() for the
+            files under the root directory.
 
     Returns (bool):
         True if the object is finished, False otherwise.
     '''
-    # eventually, we could check a database to get this info...
-
     type = grph[name]['type']
 
     if type == 'night':
         return True
 
     outpath = graph_path(rawdir, proddir, name, type)
-    if not os.path.isfile(outpath):
+    outstate = _file_state(outpath, indexed)
+    if outstate is None:
         return False
 
-    if os.path.islink(outpath):
+    tout, islink = outstate
+    if islink:
         # this is a fake bootcalib symlink
         return True
 
-    tout = os.path.getmtime(outpath)
-
     for input in grph[name]['in']:
         if grph[input]['type'] == 'night':
             continue
         inpath = graph_path(rawdir, proddir, input, grph[input]['type'])
         # if the input file exists, check if its timestamp
         # is newer than the output.
-        if os.path.isfile(inpath):
-            tin = os.path.getmtime(inpath)
+        instate = _file_state(inpath, indexed)
+        if instate is not None:
+            tin = instate[0]
             if tin > tout:
                 return False
     return True
@@ -176,6 +191,10 @@ def prod_state(rawdir, proddir, grph):
     for whether it is finished.  If the object is done, it marks the
     the state of the node in the graph.
 
+    If the raw data or production directories have a file index (see
+    desispec.io.fileindex), it is incrementally updated and the files
+    under them are looked up in the index instead of testing each of them.
+
     Args:
         rawdir (str): the path to the raw data directory.
         proddir (str): the path to the production directory.
@@ -184,8 +203,17 @@ def prod_state(rawdir, proddir, grph):
     Returns:
         Nothing.  The graph is modified in place.
     '''
+    indexed = []
+    for root in (proddir, rawdir):
+        index = open_index(root)
+        if index is not None:
+            try:
+                index.update()
+                indexed.append((os.path.normpath(root), index.file_states()))
+            finally:
+                index.close()
     for name, nd in grph.items():
-        if is_finished(rawdir, proddir, grph, name):
+        if is_finished(rawdir, proddir, grph, name, indexed=indexed):
             nd['state'] = 'done'
     return
 
@@ -3,12 +3,16 @@ Preprocess raw DESI exposures
 '''
 
 import re
+import os
+import collections
+import multiprocessing.pool
 import numpy as np
 from desispec.image import Image
 
 from desispec import cosmics
 from desispec.maskbits import ccdmask
 from desispec.log import get_logger
+from desispec import util
 log = get_logger()
 
 def _parse_sec_keyword(value):
@@ -76,7 +80,54 @@ def _overscan(pix, nsigma=5, niter=3):
 
     return overscan, readnoise
 
-def preproc(rawimage, header, bias=False, pixflat=False, mask=False):
+def _preproc_amp(rawimage, bias, header, amp, image):
+    '''
+    Subtracts the overscan of one amplifier and applies its gain
+
+    The data of this amplifier are written in place in image[CCDSECx]
+
+    Args:
+        rawimage : 2D raw image
+        bias : bias image with the shape of rawimage, or None
+        header : dict-like metadata with keywords BIASSECx, DATASECx,
+            CCDSECx and optionally GAINx, for x=amp
+        amp : amplifier '1', '2', '3' or '4'
+        image : output image
+
+    Returns (gain, overscan, readnoise) of this amplifier,
+        with readnoise in electrons
+    '''
+    ii = _parse_sec_keyword(header['BIASSEC'+amp])
+    jj = _parse_sec_keyword(header['DATASEC'+amp])
+    kk = _parse_sec_keyword(header['CCDSEC'+amp])
+
+    #- Initial teststand data may be missing GAIN* keywords; don't crash
+    if 'GAIN'+amp in header:
+        gain = header['GAIN'+amp]          #- gain = electrons / ADU
+    else:
+        log.error('Missing keyword GAIN{}; using 1.0'.format(amp))
+        gain = 1.0
+
+    #- the bias image is only subtracted from the regions of this amp
+    overscan_pix = rawimage[ii]
+    if bias is not None:
+        overscan_pix = overscan_pix - bias[ii]
+    overscan, rdnoise = _overscan(overscan_pix)
+    rdnoise *= gain
+
+    #- subtract overscan from data region and apply gain, in place
+    data = image[kk]
+    if bias is not None:
+        np.subtract(rawimage[jj], bias[jj], out=data, casting='unsafe')
+    else:
+        data[...] = rawimage[jj]
+    data -= overscan
+    data *= gain
+
+    return gain, overscan, rdnoise
+
+def preproc(rawimage, header, bias=False, pixflat=False, mask=False,
+    dtype=np.float64, nthreads=1):
     '''
     preprocess image using metadata in header
 
@@ -95,6 +146,12 @@ def preproc(rawimage, header, bias=False, pixflat=False, mask=False):
         filename (str or unicode): read HDU 0 and use that
         DATE-OBS is required in header if bias, pixflat, or mask=True
 
+    Options:
+        dtype : float type of the output image, ivar and readnoise;
+            np.float32 halves their memory
+        nthreads : number of threads processing the amplifiers and
+            rejecting cosmic rays
+
     Returns Image object with member variables:
         image : 2D preprocessed image in units of electrons per pixel
         ivar : 2D inverse variance of image
@@ -124,6 +181,10 @@ def preproc(rawimage, header, bias=False, pixflat=False, mask=False):
 
     The inverse variance is estimated from the readnoise and the image itself,
     and thus is biased.
+
+    The output arrays are computed in place, so that the only full-frame
+    arrays are the input rawimage, the output image, ivar, readnoise and
+    mask, and one temporary array of dtype.
     '''
     #- TODO: Check for required keywords first
 
@@ -140,28 +201,27 @@ def preproc(rawimage, header, bias=False, pixflat=False, mask=False):
             #- treat as filename
             bias = read_bias(filename=bias)
 
-        if bias.shape == rawimage.shape:
-            rawimage = rawimage - bias
-        else:
+        if bias.shape != rawimage.shape:
             raise ValueError('shape mismatch bias {} != rawimage {}'.format(bias.shape, rawimage.shape))
+    else:
+        bias = None
 
     #- Output arrays
     yy, xx = _parse_sec_keyword(header['CCDSEC4'])  #- 4 = upper right
-    image = np.zeros( (yy.stop, xx.stop) )
+    image = np.zeros( (yy.stop, xx.stop), dtype=dtype )
     readnoise = np.zeros_like(image)
 
-    for amp in ['1', '2', '3', '4']:
-        ii = _parse_sec_keyword(header['BIASSEC'+amp])
-
-        #- Initial teststand data may be missing GAIN* keywords; don't crash
-        if 'GAIN'+amp in header:
-            gain = header['GAIN'+amp]          #- gain = electrons / ADU
-        else:
-            log.error('Missing keyword GAIN{}; using 1.0'.format(amp))
-            gain = 1.0
+    amps = ['1', '2', '3', '4']
+    if nthreads > 1:
+        #- amps write disjoint regions of image
+        pool = multiprocessing.pool.ThreadPool(min(nthreads, len(amps)))
+        results = pool.map(lambda amp : _preproc_amp(rawimage, bias, header, amp, image), amps)
+        pool.close()
+        pool.join()
+    else:
+        results = [_preproc_amp(rawimage, bias, header, amp, image) for amp in amps]
 
-        overscan, rdnoise = _overscan(rawimage[ii])
-        rdnoise *= gain
+    for amp, (gain, overscan, rdnoise) in zip(amps, results):
         kk = _parse_sec_keyword(header['CCDSEC'+amp])
         readnoise[kk] = rdnoise
 
@@ -186,11 +246,6 @@ def preproc(rawimage, header, bias=False, pixflat=False, mask=False):
         else:
             log.warning('Expected readnoise keyword {} missing'.format('RDNOISE'+amp))
 
-        #- subtract overscan from data region and apply gain
-        jj = _parse_sec_keyword(header['DATASEC'+amp])
-        data = rawimage[jj] - overscan
-        image[kk] = data*gain
-
     #- Load mask
     if mask is not False and mask is not None:
         if mask is True:
@@ -199,6 +254,10 @@ def preproc(rawimage, header, bias=False, pixflat=False, mask=False):
         ### elif isinstance(mask, (str, unicode)):
         elif isinstance(mask, str):
             mask = read_mask(filename=mask)
+        #- the cached calibration images are read-only
+        mask = util.mask32(mask)
+        if not mask.flags.writeable:
+            mask = mask.copy()
     else:
         mask = np.zeros(image.shape, dtype=np.int32)
 
@@ -231,13 +290,15 @@ def preproc(rawimage, header, bias=False, pixflat=False, mask=False):
             mask[lowpixflat] |= ccdmask.PIXFLATLOW
 
     #- Inverse variance, estimated directly from the data (BEWARE: biased!)
-    var = image.clip(0) + readnoise**2
-    ivar = 1.0 / var
+    #- var = image.clip(0) + readnoise**2 ; ivar = 1/var
+    ivar = np.maximum(image, 0)
+    ivar += np.square(readnoise)
+    np.divide(1.0, ivar, out=ivar)
 
     img = Image(image, ivar=ivar, mask=mask, meta=header, readnoise=readnoise, camera=camera)
 
     #- update img.mask to mask cosmic rays
-    cosmics.reject_cosmic_rays(img)
+    cosmics.reject_cosmic_rays(img, nthreads=nthreads)
 
     return img
 
@@ -246,6 +307,46 @@ def preproc(rawimage, header, bias=False, pixflat=False, mask=False):
 #- circular dependency between io and preproc:
 #- io.read_raw -> preproc.preproc -> io.read_bias (bad)
 
+#: Maximum number of bytes of calibration images kept by :func:`read_calib`.
+calib_cache_bytes = 2*1024**3
+
+_calib_cache = collections.OrderedDict()
+
+def read_calib(calibtype, filename):
+    '''
+    Return a read-only calibration image, cached across calls
+
+    The image of HDU 0 is memory-mapped when possible. The most recently used
+    images are cached, keyed on (calibtype, path, modification time, size), until
+    their total size exceeds calib_cache_bytes, so that preprocessing many
+    exposures with the same calibration files only reads them once.
+
+    Args:
+        calibtype : 'bias', 'pixflat' or 'mask'
+        filename : input filename to read
+
+    Returns read-only 2D ndarray
+    '''
+    from astropy.io import fits
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    key = (calibtype, path, stat.st_mtime, stat.st_size)
+    if key in _calib_cache:
+        data = _calib_cache.pop(key)
+    else:
+        fx = fits.open(path, memmap=True)
+        data = fx[0].data
+        fx.close()
+        data.flags.writeable = False
+        #- an image larger than the cache is not cached and evicts nothing
+        if data.nbytes > calib_cache_bytes:
+            return data
+        cached_bytes = sum([x.nbytes for x in _calib_cache.values()])
+        while len(_calib_cache) > 0 and cached_bytes + data.nbytes > calib_cache_bytes:
+            cached_bytes -= _calib_cache.popitem(last=False)[1].nbytes
+    _calib_cache[key] = data
+    return data
+
 def read_bias(filename=None, camera=None, dateobs=None):
     '''
     Return calibration bias filename for camera on dateobs or night
@@ -257,13 +358,13 @@ def read_bias(filename=None, camera=None, dateobs=None):
 
     Notes:
         must provide filename, or both camera and dateobs
+        returns a read-only array, cached by read_calib
     '''
-    from astropy.io import fits
     if filename is None:
         #- use camera and dateobs to derive what bias file should be used
         raise NotImplementedError
     else:
-        return fits.getdata(filename, 0)
+        return read_calib('bias', filename)
 
 def read_pixflat(filename=None, camera=None, dateobs=None):
     '''
@@ -276,13 +377,13 @@ def read_pixflat(filename=None, camera=None, dateobs=None):
 
     Notes:
         must provide filename, or both camera and dateobs
+        returns a read-only array, cached by read_calib
     '''
-    from astropy.io import fits
     if filename is None:
         #- use camera and dateobs to derive what pixflat file should be used
         raise NotImplementedError
     else:
-        return fits.getdata(filename, 0)
+        return read_calib('pixflat', filename)
 
 def read_mask(filename=None, camera=None, dateobs=None):
     '''
@@ -295,10 +396,10 @@ def read_mask(filename=None, camera=None, dateobs=None):
 
     Notes:
         must provide filename, or both camera and dateobs
+        returns a read-only array, cached by read_calib
     '''
-    from astropy.io import fits
     if filename is None:
         #- use camera and dateobs to derive what mask file should be used
         raise NotImplementedError
     else:
-        return fits.getdata(filename, 0)
+        return read_calib('mask', filename)
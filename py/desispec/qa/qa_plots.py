@@ -9,6 +9,7 @@ import pdb
 
 from desispec.log import get_logger
 from desispec import fluxcalibration as dsflux
+from desispec.sky import CompactSkyModel
 from desispec.util import set_backend
 set_backend()
 
@@ -101,6 +102,9 @@ def frame_skyres(outfil, frame, skymodel, qaframe):
     skyfibers = np.where(frame.fibermap['OBJTYPE'] == 'SKY')[0]
     assert np.max(skyfibers) < 500  #- indices, not fiber numbers
 
+    if isinstance(skymodel, CompactSkyModel) and skymodel.resolution_data is None:
+        skymodel.resolution_data = frame.resolution_data
+
     # Residuals
     res = frame.flux[skyfibers] - skymodel.flux[skyfibers] # Residuals
     res_ivar = util.combine_ivar(frame.ivar[skyfibers], skymodel.ivar[skyfibers])
@@ -306,6 +310,8 @@ def frame_fluxcalib(outfil, qaframe, frame, fluxcalib):
     stdfibers = (frame.fibermap['OBJTYPE'] == 'STD')
     stdstars = frame[stdfibers]
     nstds = np.sum(stdfibers)
+    if isinstance(fluxcalib, dsflux.CompactFluxCalib) and fluxcalib.resolution_data is None:
+        fluxcalib.resolution_data = frame.resolution_data
 
     # Median spectrum
     medcalib = np.median(fluxcalib.calib[stdfibers],axis=0)
@@ -153,6 +153,94 @@ class Resolution(scipy.sparse.dia_matrix):
         """
         return self.data
 
+class ResolutionStack(object):
+    """Resolution matrices of several spectra sharing one wavelength grid.
+
+    This wraps the 3D[nspec, ndiag, nwave] resolution data as stored in FITS
+    files (see :meth:`Resolution.to_fits_array`) and applies all the matrices
+    at once with array operations, instead of looping over an array of
+    :class:`Resolution` objects.
+
+    Args:
+        data: 3D numpy array[nspec, ndiag, nwave] of sparse diagonal values
+            with an odd number of diagonals.
+
+    Raises:
+        ValueError: Invalid input data.
+
+    Indexing with an integer returns the :class:`Resolution` of that spectrum;
+    indexing with a slice or an index array returns a new ResolutionStack.
+    """
+    def __init__(self, data):
+        data = np.asarray(data)
+        if data.ndim != 3:
+            raise ValueError('ResolutionStack data should be 3D[nspec, ndiag, nwave], not {}D'.format(data.ndim))
+        if data.shape[1]%2 == 0:
+            raise ValueError("Number of diagonals ({}) should be odd".format(data.shape[1]))
+        self.data = data
+        self.nspec, self.ndiag, self.nwave = data.shape
+        self.offsets = np.arange(self.ndiag//2,-(self.ndiag//2)-1,-1)
+
+    def __len__(self):
+        return self.nspec
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return Resolution(self.data[index])
+        if not isinstance(index, slice):
+            index = np.atleast_1d(index)
+        return ResolutionStack(self.data[index])
+
+    def __iter__(self):
+        for i in range(self.nspec):
+            yield Resolution(self.data[i])
+
+    def _broadcast(self, x):
+        x = np.asarray(x)
+        if x.ndim == 1:
+            x = x[None, :]
+        if x.shape[-1] != self.nwave or x.shape[0] not in (1, self.nspec):
+            raise ValueError('Cannot apply ResolutionStack[{},{}] to array of shape {}'.format(
+                self.nspec, self.nwave, x.shape))
+        return x
+
+    def dot(self, x):
+        """Apply each resolution matrix to x.
+
+        Args:
+            x: 1D[nwave] vector shared by all spectra, or 2D[nspec, nwave]
+                array with one vector per spectrum.
+
+        Returns:
+            numpy.ndarray: 2D[nspec, nwave] array of R_i.x (or R_i.x_i).
+        """
+        x = self._broadcast(x)
+        y = np.zeros((self.nspec, self.nwave), dtype=np.result_type(self.data, x))
+        for k, offset in enumerate(self.offsets):
+            #- R[i,i+offset] = data[k,i+offset]
+            j0 = max(0, offset)
+            j1 = min(self.nwave, self.nwave+offset)
+            y[:, j0-offset:j1-offset] += self.data[:, k, j0:j1] * x[:, j0:j1]
+        return y
+
+    def tdot(self, x):
+        """Apply the transpose of each resolution matrix to x.
+
+        Args:
+            x: 1D[nwave] vector shared by all spectra, or 2D[nspec, nwave]
+                array with one vector per spectrum.
+
+        Returns:
+            numpy.ndarray: 2D[nspec, nwave] array of R_i^T.x (or R_i^T.x_i).
+        """
+        x = self._broadcast(x)
+        y = np.zeros((self.nspec, self.nwave), dtype=np.result_type(self.data, x))
+        for k, offset in enumerate(self.offsets):
+            j0 = max(0, offset)
+            j1 = min(self.nwave, self.nwave+offset)
+            y[:, j0:j1] += self.data[:, k, j0:j1] * x[:, j0-offset:j1-offset]
+        return y
+
 def _gauss_pix(x, mean=0.0, sigma=1.0):
     """
     Utility function to integrate Gaussian density within pixels
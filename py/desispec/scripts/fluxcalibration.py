@@ -39,6 +39,8 @@ def parse(options=None):
                         help='path of QA file.')
     parser.add_argument('--qafig', type = str, default = None, required=False,
                         help = 'path of QA figure file')
+    parser.add_argument('--compact', action = 'store_true',
+                        help = 'write the deconvolved calibration instead of the calibration of each fiber')
     
     args = None
     if options is None:
@@ -102,7 +104,7 @@ def main(args) :
             qa_plots.frame_fluxcalib(args.qafig, qaframe, frame, fluxcalib)
 
     # write result
-    write_flux_calibration(args.outfile, fluxcalib, header=frame.meta)
+    write_flux_calibration(args.outfile, fluxcalib, header=frame.meta, compact=args.compact)
 
     log.info("successfully wrote %s"%args.outfile)
 
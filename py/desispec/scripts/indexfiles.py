@@ -0,0 +1,40 @@
+"""
+Create or update the file index of a production or raw data directory
+(see desispec.io.fileindex), used by desispec.io.get_files, get_raw_files,
+get_exposures and the pipeline status instead of globbing directories.
+"""
+
+from __future__ import absolute_import, division
+
+import argparse
+import time
+
+from desispec.io.fileindex import FileIndex
+from desispec.io.meta import specprod_root
+from desispec.log import get_logger
+
+
+def parse(options=None):
+    parser = argparse.ArgumentParser(description="Create or update the file index of a directory.")
+    parser.add_argument('--root', type = str, default = None, metavar = 'PATH',
+        help = 'Directory to index (default is $DESI_SPECTRO_REDUX/$SPECPROD).')
+    parser.add_argument('--full', action = 'store_true',
+        help = 'Rescan all directories and files, instead of the directories modified since the last scan.')
+
+    args = None
+    if options is None:
+        args = parser.parse_args()
+    else:
+        args = parser.parse_args(options)
+    return args
+
+
+def main(args):
+    log = get_logger()
+    root = args.root
+    if root is None:
+        root = specprod_root()
+    t0 = time.time()
+    with FileIndex(root, create=True) as index:
+        nscan = index.update(full=args.full)
+    log.info('Scanned {} directories of {} in {:.1f} sec.'.format(nscan, root, time.time()-t0))
@@ -1,10 +1,25 @@
-
 """
 Read fibermap and cframe files for all exposures of a single night and update or create brick files.
+
+The fibers of each exposure fibermap are grouped by spectrograph and brick once. Each cframe is
+then read by one of --nproc reader processes, which sends the spectra of each brick to the writer
+process that owns this brick. Writers add the spectra to their brick files and append the largest
+buffered bricks to disk whenever they hold more than --max-buffered spectra, so that memory stays
+bounded and reading overlaps with writing. The job fails, rather than hangs, if a writer dies.
 """
 
+from __future__ import absolute_import, division
+
 import argparse
+import multiprocessing
 import os.path
+import time
+import zlib
+
+try:
+    from queue import Full
+except ImportError:
+    from Queue import Full
 
 import numpy as np
 
@@ -20,6 +35,14 @@ def parse(options=None):
         help = 'Night to process in the format YYYYMMDD')
     parser.add_argument('--specprod', type = str, default = None, metavar = 'PATH',
         help = 'Override default path ($DESI_SPECTRO_REDUX/$SPECPROD) to processed data.')
+    parser.add_argument('--nproc', type = int, default = 1, metavar = 'N',
+        help = 'Number of processes reading cframe files (1 to read and write in this process).')
+    parser.add_argument('--nwriters', type = int, default = 2, metavar = 'N',
+        help = 'Number of processes writing brick files, each owning a subset of the bricks.')
+    parser.add_argument('--max-buffered', type = int, default = 10000, metavar = 'N',
+        help = 'Maximum number of spectra held by a writer before appending them to its brick files.')
+    parser.add_argument('--resolution-max-error', type = float, default = None, metavar = 'ERR',
+        help = 'Store the resolution data as quantized integers with this maximum absolute error.')
 
     args = None
     if options is None:
@@ -29,6 +52,173 @@ def parse(options=None):
     return args
 
 
+def group_fibers(fibermap):
+    """Group the fibers of a fibermap by spectrograph and brick.
+
+    Args:
+        fibermap: fibermap table with SPECTROID and BRICKNAME columns.
+
+    Returns:
+        dict: Dictionary mapping each spectrograph ID to a list of (brick_name,rows) tuples
+            sorted by brick name, where rows are the indices of the fibermap rows of this
+            spectrograph and brick in fibermap order.
+    """
+    spectro_ids = np.asarray(fibermap['SPECTROID'])
+    brick_names = np.asarray(fibermap['BRICKNAME'])
+    # Stable sort so that the rows of each group stay in fibermap order.
+    order = np.lexsort((brick_names,spectro_ids))
+    spectro_ids = spectro_ids[order]
+    brick_names = brick_names[order]
+    starts = np.flatnonzero((spectro_ids[1:] != spectro_ids[:-1]) | (brick_names[1:] != brick_names[:-1])) + 1
+    starts = np.concatenate(([0],starts))
+    ends = np.concatenate((starts[1:],[len(order)]))
+    groups = { }
+    for start,end in zip(starts,ends):
+        if end > start:
+            brick_name = brick_names[start]
+            if isinstance(brick_name,bytes):
+                brick_name = brick_name.decode('ascii')
+            groups.setdefault(int(spectro_ids[start]),[ ]).append((str(brick_name),order[start:end]))
+    return groups
+
+
+def read_brick_slices(task):
+    """Read one cframe and split its spectra by brick.
+
+    Args:
+        task(tuple): Tuple (cframe_path,band,night,expid,bricks) where bricks is a list of
+            (brick_name,brick_data) tuples with the fibermap rows of each brick on this camera.
+
+    Returns:
+        list: List of (brick_name,band,flux,ivar,wave,resolution,brick_data,night,expid) tuples
+            with the spectra of each brick.
+    """
+    cframe_path,band,night,expid,bricks = task
+    # Only read the spectra of this camera's fibers from the cframe file.
+    camera_fibers = np.unique(np.concatenate([np.mod(brick_data['FIBER'],500) for brick_name,brick_data in bricks]))
+    frame = desispec.io.read_frame(cframe_path,fibers = camera_fibers,skip_hdus = ['CHI2PIX'])
+    slices = [ ]
+    for brick_name,brick_data in bricks:
+        # Convert fibers to rows of the frame we read.
+        rows = np.searchsorted(camera_fibers,np.mod(brick_data['FIBER'],500))
+        # Note that the wavelength array is not per-fiber, so we do not slice it.
+        slices.append((brick_name,band,frame.flux[rows],frame.ivar[rows],frame.wave,
+            frame.resolution_data[rows],brick_data,night,expid))
+    return slices
+
+
+class BrickWriter(object):
+    """Add spectra to a set of brick files, keeping a bounded number of them in memory.
+
+    Args:
+        specprod(str): Path to processed data, or None to use the default.
+        max_buffered(int): When more than this number of spectra are buffered, append the
+            spectra of the bricks buffering the most of them to their files until at most
+            half of this number are buffered. Bricks are only appended when they hold many
+            spectra, so that they are not fragmented into many small groups of HDUs.
+        resolution_max_error(float): If set, encode the resolution data with this
+            maximum absolute error (see :func:`desispec.io.util.encode_resolution`).
+    """
+    def __init__(self,specprod = None,max_buffered = 10000,resolution_max_error = None):
+        self.specprod = specprod
+        self.max_buffered = max_buffered
+        self.resolution_max_error = resolution_max_error
+        self.bricks = { }
+        self.buffered = { }
+        self.num_buffered = 0
+        self.num_spectra = { }
+
+    def add(self,brick_slice):
+        """Add the spectra returned for one brick by :func:`read_brick_slices`.
+        """
+        brick_name,band,flux,ivar,wave,resolution,brick_data,night,expid = brick_slice
+        brick_key = '{}_{}'.format(band,brick_name)
+        # Open the brick file if this is the first time we are using it since the last flush.
+        if brick_key not in self.bricks:
+            brick_path = desispec.io.findfile('brick',brickname = brick_name,band = band,
+                specprod_dir = self.specprod)
+            header = dict(BRICKNAM=(brick_name, 'Imaging brick name'),
+                          CHANNEL=(band, 'Spectrograph channel [b,r,z]'), )
+            self.bricks[brick_key] = desispec.io.brick.Brick(brick_path,mode = 'update',header = header,
+                resolution_max_error = self.resolution_max_error)
+        self.bricks[brick_key].add_objects(flux,ivar,wave,resolution,brick_data,night,expid)
+        self.num_spectra[brick_key] = self.num_spectra.get(brick_key,0) + len(flux)
+        self.buffered[brick_key] = self.buffered.get(brick_key,0) + len(flux)
+        self.num_buffered += len(flux)
+        if self.num_buffered > self.max_buffered:
+            self.flush(self.max_buffered//2)
+
+    def flush(self,max_buffered = 0):
+        """Write the buffered spectra of the largest open bricks and close them.
+
+        Args:
+            max_buffered(int): Close bricks, largest first, until at most this
+                number of spectra are buffered. Close all bricks by default.
+        """
+        for brick_key in sorted(self.buffered,key = self.buffered.get,reverse = True):
+            if self.num_buffered <= max_buffered:
+                break
+            self.bricks.pop(brick_key).close()
+            self.num_buffered -= self.buffered.pop(brick_key)
+
+    def close(self):
+        """Flush and log the number of spectra added to each brick.
+        """
+        self.flush()
+        log = get_logger()
+        for brick_key in sorted(self.num_spectra):
+            log.debug('Added {} spectra to brick {}.'.format(self.num_spectra[brick_key],brick_key))
+
+
+def _brick_owner(brick_name,band,nwriters):
+    """Return the index of the writer process that owns a brick file."""
+    brick_key = '{}_{}'.format(band,brick_name)
+    return zlib.crc32(brick_key.encode('ascii')) % nwriters
+
+
+def _put_while_alive(queue,item,process,timeout = 1.0):
+    """Put an item in a bounded queue read by a process, unless this process dies.
+
+    Returns:
+        bool: True if the item was put in the queue, False if the process died.
+    """
+    while True:
+        try:
+            queue.put(item,timeout = timeout)
+            return True
+        except Full:
+            if not process.is_alive():
+                return False
+
+
+def _run_writer(queue,specprod,max_buffered,resolution_max_error):
+    """Main function of a writer process: add brick slices from a queue until None is received."""
+    writer = BrickWriter(specprod,max_buffered,resolution_max_error)
+    while True:
+        brick_slice = queue.get()
+        if brick_slice is None:
+            break
+        writer.add(brick_slice)
+    writer.close()
+
+
+# Writer queues of reader processes, set by _init_reader.
+_writer_queues = None
+
+def _init_reader(queues):
+    global _writer_queues
+    _writer_queues = queues
+
+def _read_and_route(task):
+    """Read one cframe in a reader process and send each brick slice to its writer."""
+    nspec = 0
+    for brick_slice in read_brick_slices(task):
+        brick_name,band = brick_slice[0:2]
+        _writer_queues[_brick_owner(brick_name,band,len(_writer_queues))].put(brick_slice)
+        nspec += len(brick_slice[2])
+    return task[0],nspec
+
+
 def main(args):
 
     if args.verbose:
@@ -40,10 +230,9 @@ def main(args):
         log.critical('Missing required night argument.')
         return -1
 
-    # Initialize a dictionary of Brick objects indexed by '<band>_<brick-id>' strings.
-    bricks = { }
     try:
-        # Loop over exposures available for this night.
+        # Build the list of cframes to read, with the fibermap rows of each brick they contain.
+        tasks = [ ]
         for exposure in desispec.io.get_exposures(args.night, specprod_dir = args.specprod):
             # Ignore exposures with no fibermap, assuming they are calibration data.
             fibermap_path = desispec.io.findfile(filetype = 'fibermap',night = args.night,
@@ -51,8 +240,9 @@ def main(args):
             if not os.path.exists(fibermap_path):
                 log.debug('Skipping exposure {:08d} with no fibermap.'.format(exposure))
                 continue
-            # Open the fibermap.
+            # Open the fibermap and group its fibers by spectrograph and brick.
             fibermap_data = desispec.io.read_fibermap(fibermap_path)
+            groups = group_fibers(fibermap_data)
             brick_names = set(fibermap_data['BRICKNAME'])
             # Loop over per-camera cframes available for this exposure.
             cframes = desispec.io.get_files(
@@ -61,34 +251,62 @@ def main(args):
             log.debug('Exposure {:08d} covers {} bricks and has cframes for {}.'.format(exposure, len(brick_names), ','.join(list(cframes.keys()))))
             for camera,cframe_path in cframes.items():
                 band,spectro_id = camera[0],int(camera[1:])
-                this_camera = (fibermap_data['SPECTROID'] == spectro_id)
-                # Read this cframe file.
-                frame = desispec.io.read_frame(cframe_path)
-                # Loop over bricks.
-                for brick_name in brick_names:
-                    # Lookup the fibers belong to this brick.
-                    this_brick = (fibermap_data['BRICKNAME'] == brick_name)
-                    brick_data = fibermap_data[this_camera & this_brick]
-                    fibers = np.mod(brick_data['FIBER'],500)
-                    if len(fibers) == 0:
+                if spectro_id not in groups:
+                    continue
+                bricks = [(brick_name,fibermap_data[rows]) for brick_name,rows in groups[spectro_id]]
+                tasks.append((cframe_path,band,args.night,exposure,bricks))
+
+        if args.nproc <= 1:
+            writer = BrickWriter(args.specprod,args.max_buffered,args.resolution_max_error)
+            for task in tasks:
+                for brick_slice in read_brick_slices(task):
+                    writer.add(brick_slice)
+            writer.close()
+        else:
+            # Bounded queues block readers when writers fall behind.
+            nwriters = max(1,args.nwriters)
+            queues = [multiprocessing.Queue(maxsize = 4*args.nproc) for i in range(nwriters)]
+            writers = [multiprocessing.Process(target = _run_writer,args = (queue,args.specprod,args.max_buffered,
+                args.resolution_max_error))
+                for queue in queues]
+            for writer in writers:
+                writer.start()
+            pool = multiprocessing.Pool(args.nproc,initializer = _init_reader,initargs = (queues,))
+            try:
+                # Readers block on the queue of a dead writer, so check that all writers
+                # are alive while waiting for the readers.
+                results = pool.imap_unordered(_read_and_route,tasks)
+                num_read = 0
+                while num_read < len(tasks):
+                    try:
+                        cframe_path,nspec = results.next(timeout = 1.0)
+                    except multiprocessing.TimeoutError:
+                        if not all([writer.is_alive() for writer in writers]):
+                            raise RuntimeError('some brick writers failed')
                         continue
-                    brick_key = '{}_{}'.format(band,brick_name)
-                    # Open the brick file if this is the first time we are using it.
-                    if brick_key not in bricks:
-                        brick_path = desispec.io.findfile('brick',brickname = brick_name,band = band)
-                        header = dict(BRICKNAM=(brick_name, 'Imaging brick name'),
-                                      CHANNEL=(band, 'Spectrograph channel [b,r,z]'), )
-                        bricks[brick_key] = desispec.io.brick.Brick(brick_path,mode = 'update',header = header)
-                    # Add these fibers to the brick file. Note that the wavelength array is
-                    # not per-fiber, so we do not slice it before passing it to add_objects().
-                    bricks[brick_key].add_objects(frame.flux[fibers], frame.ivar[fibers],
-                        frame.wave, frame.resolution_data[fibers], brick_data,args.night,exposure)
-        # Close all brick files.
-        for brick in bricks.values():
-            log.debug('Brick {} now contains {} spectra for {} targets.'.format(brick.path, brick.get_num_spectra(), brick.get_num_targets()))
-            brick.close()
+                    log.debug('Read {} spectra from {}.'.format(nspec,cframe_path))
+                    num_read += 1
+                # Readers only exit once their last slices are in the writer queues.
+                pool.close()
+                while any([child not in writers for child in multiprocessing.active_children()]):
+                    if not all([writer.is_alive() for writer in writers]):
+                        raise RuntimeError('some brick writers failed')
+                    time.sleep(0.1)
+                pool.join()
+            except:
+                # Readers stopped in the middle of a put can leave the writer queues
+                # unusable, so stop the writers too rather than waiting for them.
+                pool.terminate()
+                for writer in writers:
+                    writer.terminate()
+                raise
+            for queue,writer in zip(queues,writers):
+                _put_while_alive(queue,None,writer)
+            for writer in writers:
+                writer.join()
+            if any([writer.exitcode != 0 for writer in writers]):
+                raise RuntimeError('some brick writers failed')
 
     except RuntimeError as e:
         log.critical(str(e))
         return -2
-
@@ -9,7 +9,9 @@ from __future__ import absolute_import, division
 import argparse
 
 import os
+import numpy as np
 from desispec import io
+from desispec.preproc import preproc
 from desispec.log import get_logger
 log = get_logger()
 
@@ -38,6 +40,12 @@ to use, but also only if a single camera is specified.
                         help = 'pixflat image calibration file')
     parser.add_argument('--mask', type = str, default = None, required=False,
                         help = 'mask image calibration file')
+    parser.add_argument('--float32', action = 'store_true',
+                        help = 'preprocess images in single precision to use less memory')
+    parser.add_argument('--nthreads', type = int, default = 1, required=False,
+                        help = 'number of threads per camera')
+    parser.add_argument('--nreaders', type = int, default = 4, required=False,
+                        help = 'number of threads decompressing camera HDUs')
 
     #- uses sys.argv if options=None
     args = parser.parse_args(options)
@@ -65,13 +73,13 @@ def main(args=None):
     if args.outdir is None:
         args.outdir = os.getcwd()
     
-    for camera in args.cameras:
-        try:
-            img = io.read_raw(args.infile, camera,
-                bias=args.bias, pixflat=args.pixflat, mask=args.mask)
-        except IOError:
-            log.error('Camera {} not in {}'.format(camera, args.infile))
-            continue
+    #- cameras are preprocessed as soon as they are decompressed
+    for camera, rawimage, header in io.iter_raw(args.infile, args.cameras,
+            nthreads=args.nreaders):
+        img = preproc(rawimage, header,
+            bias=args.bias, pixflat=args.pixflat, mask=args.mask,
+            dtype=(np.float32 if args.float32 else np.float64),
+            nthreads=args.nthreads)
 
         if args.pixfile is None:
             night = img.meta['NIGHT']
@@ -24,6 +24,8 @@ def parse(options=None):
                         help = 'path of DESI fiberflat fits file')
     parser.add_argument('--sky', type = str, default = None,
                         help = 'path of DESI sky fits file')
+    parser.add_argument('--resolution-max-error', type = float, default = None,
+                        help = 'store the resolution data as quantized integers with this maximum absolute error')
     parser.add_argument('--calib', type = str, default = None,
                         help = 'path of DESI calibration fits file')
     parser.add_argument('--outfile', type = str, default = None, required=True,
@@ -71,7 +73,8 @@ def main(args):
 
 
     # save output
-    write_frame(args.outfile, frame, units='1e-17 erg/(s cm2 A)')
+    write_frame(args.outfile, frame, units='1e-17 erg/(s cm2 A)',
+                resolution_max_error=args.resolution_max_error)
 
     log.info("successfully wrote %s"%args.outfile)
 
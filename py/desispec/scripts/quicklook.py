@@ -15,6 +15,7 @@ import desispec.image as image
 import desispec.frame as frame
 import desispec.io.frame as frIO
 import desispec.io.image as imIO
+from desispec.io.util import write_behind
 
 import os,sys
 import yaml
@@ -38,6 +39,7 @@ def parse():
     parser.add_argument("--specprod_dir",type=str, required=False, help="specprod directory, overrides $DESI_SPECTRO_REDUX/$SPECPROD in config")
     parser.add_argument("--save",type=str, required=False,help="save this config to a file")
     parser.add_argument("--qlf",type=str,required=False,help="setup for QLF run", default=False)
+    parser.add_argument("--write-behind",action="store_true",help="write output files in a background thread",dest="write_behind")
     
     args=parser.parse_args()
     return args
@@ -75,6 +77,15 @@ def ql_main(args=None):
             else:
                 log.info("Can save config to only yaml output. Put a yaml in the argument")
         
+    if getattr(args,"write_behind",False):
+        #- intermediate and final files are written while the next steps run
+        with write_behind():
+            finalname=_run_and_write(configdict,log)
+    else:
+        finalname=_run_and_write(configdict,log)
+    log.info("Pipeline completed. Final result is in %s"%finalname)
+
+def _run_and_write(configdict,log):
     pipeline, convdict = quicklook.setup_pipeline(configdict)
     res=quicklook.runpipeline(pipeline,convdict,configdict)
     inpname=configdict["RawImage"]
@@ -92,6 +103,6 @@ def ql_main(args=None):
     else:
         log.error("Result of pipeline is in unkown type %s. Don't know how to write"%(type(res)))
         sys.exit("Unknown pipeline result type %s."%(type(res)))
-    log.info("Pipeline completed. Final result is in %s"%finalname)
+    return finalname
 if __name__=='__main__':
     ql_main()    
@@ -27,6 +27,8 @@ def parse(options=None):
                         help = 'path of QA file. Will calculate for Sky Subtraction')
     parser.add_argument('--qafig', type = str, default = None, required=False,
                         help = 'path of QA figure file')
+    parser.add_argument('--compact', action = 'store_true',
+                        help = 'write the deconvolved sky instead of the sky of each fiber')
 
     args = None
     if options is None:
@@ -71,7 +73,7 @@ def main(args) :
             qa_plots.frame_skyres(args.qafig, frame, skymodel, qaframe)
 
     # write result
-    write_sky(args.outfile, skymodel, frame.meta)
+    write_sky(args.outfile, skymodel, frame.meta, compact=args.compact)
     log.info("successfully wrote %s"%args.outfile)
 
 
@@ -31,6 +31,7 @@ def main(args) :
     from desispec.io import get_files
     from desispec.io import read_frame
     from desispec.io.sky import read_sky
+    from desispec.sky import CompactSkyModel
     from desispec.qa.qa_plots import skysub_resid
     import copy
     import pdb
@@ -100,6 +101,8 @@ def main(args) :
                 sky_file = findfile(str('sky'), night=night, camera=camera,
                                     expid=exposure, specprod_dir=args.specprod_dir)
                 skymodel = read_sky(sky_file)
+                if isinstance(skymodel, CompactSkyModel):
+                    skymodel.resolution_data = cframe.resolution_data
                 # Resid
                 skyfibers = np.where(cframe.fibermap['OBJTYPE'] == 'SKY')[0]
                 res = cframe.flux[skyfibers]
@@ -7,17 +7,17 @@ Get the normalized best template to do flux calibration.
 #- TODO: refactor algorithmic code into a separate module/function
 
 import argparse
+import multiprocessing
 
 import numpy as np
 from astropy.io import fits
-from astropy import units
 
 from desispec import io
 from desispec.fluxcalibration import match_templates,normalize_templates
 from desispec.interpolation import resample_flux
 from desispec.log import get_logger
+from desispec.sky import CompactSkyModel
 from desispec.util import default_nproc
-from desispec.io.filters import load_filter
 
 def parse(options=None):
     parser = argparse.ArgumentParser(description="Extract spectra from pre-processed raw data.")
@@ -28,6 +28,7 @@ def parse(options=None):
     parser.add_argument('--fiberflats', type = str, default = None, required=True, nargs='*', 
                         help = 'list of path to DESI fiberflats fits files (needs to be same exposure, spectro)')
     parser.add_argument('--starmodels', type = str, help = 'path of spectro-photometric stellar spectra fits')
+    parser.add_argument('--template-cache', type = str, default = None, required = False, help = 'directory where the star models and their magnitudes are cached for the next runs')
     parser.add_argument('-o','--outfile', type = str, help = 'output file for normalized stdstar model flux')
     parser.add_argument('--ncpu', type = int, default = default_nproc, required = False, help = 'use ncpu for multiprocessing')
     parser.add_argument('--delta-color', type = float, default = 0.1, required = False, help = 'max delta-color for the selection of standard stars (on top of meas. errors)')
@@ -42,6 +43,19 @@ def parse(options=None):
         args = parser.parse_args(options)
     return args
 
+# Template library of the worker processes, set by _init_match_worker.
+_templates = None
+
+def _init_match_worker(stdwave,stdflux,teff,logg,feh) :
+    global _templates
+    _templates = (stdwave,stdflux,teff,logg,feh)
+
+def _match_star(task) :
+    """Find the best template of one star, among the preselected templates of the library."""
+    wave,flux,ivar,resolution_data,selection,z_max,z_res = task
+    stdwave,stdflux,teff,logg,feh = _templates
+    return match_templates(wave,flux,ivar,resolution_data,stdwave,stdflux[selection],teff[selection],logg[selection],feh[selection],ncpu=1,z_max=z_max,z_res=z_res)
+
 def safe_read_key(header,key) :
     value = None
     try :
@@ -78,6 +92,49 @@ def get_color(mags,filters,color_name) :
         return 0.
     return mags[index1]-mags[index2]
 
+def apply_flats_and_skies(frames, flats, skies, starindices) :
+    """Divide the standard star spectra of frames by their fiberflat and subtract the sky
+
+    Args:
+        frames : dict of camera -> Frame with only the spectra of the standard stars;
+            modified in place, and frames of cameras without sky or flat are removed
+        flats : dict of camera -> FiberFlat of all the fibers
+        skies : dict of camera -> SkyModel or CompactSkyModel of all the fibers
+        starindices : indices of the standard stars in the fibers of flats and skies
+
+    The sky of a CompactSkyModel is only convolved with the resolution of the
+    standard stars.
+    """
+    log = get_logger()
+    for cam in list(frames.keys()) :
+        
+        if not cam in skies:
+            log.warning("Missing sky for %s"%cam)
+            frames.pop(cam)
+            continue
+        if not cam in flats:
+            log.warning("Missing flat for %s"%cam)
+            frames.pop(cam)
+            continue
+        
+        # frames only contain the spectra of the standard stars
+        frames[cam].ivar *= (frames[cam].mask == 0)
+        frames[cam].ivar *= (skies[cam].ivar[starindices] != 0)
+        frames[cam].ivar *= (skies[cam].mask[starindices] == 0)
+        frames[cam].ivar *= (flats[cam].ivar[starindices] != 0)
+        frames[cam].ivar *= (flats[cam].mask[starindices] == 0)
+        frames[cam].flux *= ( frames[cam].ivar > 0) # just for clean plots
+        fiberflat = flats[cam].fiberflat[starindices]
+        if isinstance(skies[cam], CompactSkyModel) :
+            skyflux = frames[cam].R.dot(skies[cam].deconvolved)
+        else :
+            skyflux = skies[cam].flux[starindices]
+        for star in range(frames[cam].flux.shape[0]) :
+            ok=np.where((frames[cam].ivar[star]>0)&(fiberflat[star]!=0))[0]
+            if ok.size > 0 :
+                frames[cam].flux[star] = frames[cam].flux[star]/fiberflat[star] - skyflux[star]
+
+
 def main(args) :
     """ finds the best models of all standard stars in the frame
     and normlize the model flux. Output is written to a file and will be called for calibration.
@@ -103,10 +160,14 @@ def main(args) :
     for filename in args.frames :
         
         log.info("reading %s"%filename)
-        frame=io.read_frame(filename)
         header=fits.getheader(filename, 0)
-        frame_fibermap = frame.fibermap
+        frame_fibermap = fits.getdata(filename, 'FIBERMAP')
         frame_starindices=np.where(frame_fibermap["OBJTYPE"]=="STD")[0]
+        if frame_starindices.size == 0 :
+            log.error("no STD star found in fibermap")
+            raise ValueError("no STD star found in fibermap")
+        # only read the spectra of the standard stars
+        frame=io.read_frame(filename, fibers=frame_starindices, skip_hdus=['CHI2PIX'])
         camera=safe_read_key(header,"CAMERA").strip().lower()
         
         if spectrograph is None :
@@ -171,58 +232,30 @@ def main(args) :
     
     # DIVIDE FLAT AND SUBTRACT SKY , TRIM DATA
     ############################################     
-    for cam in frames :
-        
-        if not cam in skies:
-            log.warning("Missing sky for %s"%cam)
-            frames.pop(cam)
-            continue
-        if not cam in flats:
-            log.warning("Missing flat for %s"%cam)
-            frames.pop(cam)
-            continue
-        
-        frames[cam].flux = frames[cam].flux[starindices]
-        frames[cam].ivar = frames[cam].ivar[starindices]
-        
-
-        frames[cam].ivar *= (frames[cam].mask[starindices] == 0)
-        frames[cam].ivar *= (skies[cam].ivar[starindices] != 0)
-        frames[cam].ivar *= (skies[cam].mask[starindices] == 0)
-        frames[cam].ivar *= (flats[cam].ivar[starindices] != 0)
-        frames[cam].ivar *= (flats[cam].mask[starindices] == 0)
-        frames[cam].flux *= ( frames[cam].ivar > 0) # just for clean plots
-        for star in range(frames[cam].flux.shape[0]) :
-            ok=np.where((frames[cam].ivar[star]>0)&(flats[cam].fiberflat[star]!=0))[0]
-            if ok.size > 0 :
-                frames[cam].flux[star] = frames[cam].flux[star]/flats[cam].fiberflat[star] - skies[cam].flux[star]
+    apply_flats_and_skies(frames, flats, skies, starindices)
     nstars = starindices.size
     starindices=None # we don't need this anymore
     
-    # READ MODELS
-    ############################################   
-    log.info("reading star models in %s"%args.starmodels)
-    stdwave,stdflux,templateid,teff,logg,feh=io.read_stdstar_templates(args.starmodels)
-    
-    # COMPUTE MAGS OF MODELS FOR EACH STD STAR MAG
+    # READ MODELS AND COMPUTE MAGS OF MODELS FOR EACH STD STAR MAG
     ############################################
     model_filters = []
     for tmp in np.unique(imaging_filters) :
         if len(tmp)>0 : # can be one empty entry
             model_filters.append(tmp)
+    computed_filters = []
+    for fname in model_filters :
+        if fname.startswith('WISE'):
+            log.warning('not computing stdstar {} mags'.format(fname))
+        else :
+            computed_filters.append(fname)
     
-    log.info("computing model mags %s"%model_filters)
+    log.info("reading star models in %s and computing model mags %s"%(args.starmodels,computed_filters))
+    if args.template_cache is not None :
+        log.info("using star model cache in %s"%args.template_cache)
+    stdwave,stdflux,templateid,teff,logg,feh,computed_mags=io.read_stdstar_templates_cached(args.starmodels,computed_filters,args.template_cache)
     model_mags = np.zeros((stdflux.shape[0],len(model_filters)))
-    fluxunits = 1e-17 * units.erg / units.s / units.cm**2 / units.Angstrom
-    
-    for index in range(len(model_filters)) :
-        if model_filters[index].startswith('WISE'):
-            log.warning('not computing stdstar {} mags'.format(model_filters[index]))
-            continue
-
-        filter_response=load_filter(model_filters[index])
-        for m in range(stdflux.shape[0]) :
-            model_mags[m,index]=filter_response.get_ab_magnitude(stdflux[m]*fluxunits,stdwave)
+    for index,fname in enumerate(computed_filters) :
+        model_mags[:,model_filters.index(fname)]=computed_mags[:,index]
     log.info("done computing model mags")
     
     
@@ -234,9 +267,12 @@ def main(args) :
     redshift=np.zeros((nstars))
     normflux=[]
     
+    # first preselect the models of each star, then match all stars in one
+    # pool of processes that each hold a copy of the template library
+    tasks=[]
     for star in range(nstars) :
         
-        log.info("finding best model for observed star #%d"%star)
+        log.info("preselecting models for observed star #%d"%star)
         
         # np.array of wave,flux,ivar,resol
         wave = {}
@@ -278,7 +314,22 @@ def main(args) :
         
         log.info("star#%d fiber #%d, %s = %s-%s = %f, number of pre-selected models = %d/%d"%(star,starfibers[star],args.color,filter1,filter2,star_color,selection.size,stdflux.shape[0]))
         
-        index_in_selection,redshift[star],chi2dof[star]=match_templates(wave,flux,ivar,resolution_data,stdwave,stdflux[selection], teff[selection], logg[selection], feh[selection], ncpu=args.ncpu,z_max=args.z_max,z_res=args.z_res)
+        tasks.append((wave,flux,ivar,resolution_data,selection,args.z_max,args.z_res))
+
+    if args.ncpu > 1 and nstars > 1 :
+        log.info("finding best models of %d stars with %d processes"%(nstars,args.ncpu))
+        pool = multiprocessing.Pool(args.ncpu,initializer=_init_match_worker,initargs=(stdwave,stdflux,teff,logg,feh))
+        results = pool.map(_match_star,tasks)
+        pool.close()
+        pool.join()
+    else :
+        _init_match_worker(stdwave,stdflux,teff,logg,feh)
+        results = [_match_star(task) for task in tasks]
+
+    for star in range(nstars) :
+        
+        selection = tasks[star][4]
+        index_in_selection,redshift[star],chi2dof[star]=results[star]
         
         bestModelIndex[star] = selection[index_in_selection]
 
@@ -5,10 +5,21 @@ Reads the b,r,z files containing all observed spectra for a single brick and per
 of coaddition: (1) create b,r,z coadd files containing the coadditions of every target observed
 in each band, using the native band wavelength grid; and (2) combine the b,r,z coadds for each
 object into a global coadd using linear resampling to the global wavelength grid.
+
+Exposures are grouped by target ID before any coaddition, and each target is then coadded and
+finalized independently, either serially, in a pool of --nproc processes or over an MPI
+communicator. Results are copied into preallocated output arrays as soon as they are available,
+so that only the targets in flight hold coadd accumulators in memory.
 """
 
+from __future__ import absolute_import, division
+
 import argparse
+import multiprocessing
 import os.path
+import sys
+import time
+import traceback
 
 import numpy as np
 
@@ -16,6 +27,7 @@ import desispec.io
 import desispec.coaddition
 import desispec.resolution
 from desispec.log import get_logger, DEBUG
+from desispec.util import default_nproc, dist_uniform
 
 
 def parse(options=None):
@@ -30,6 +42,14 @@ def parse(options=None):
         help = 'String listing the bands to include.')
     parser.add_argument('--specprod', type = str, default = None, metavar = 'PATH',
         help = 'Override default path ($DESI_SPECTRO_REDUX/$SPECPROD) to processed data.')
+    parser.add_argument('--banded', action = 'store_true',
+        help = 'Accumulate sparse banded inverse covariances and decorrelate them in blocks.')
+    parser.add_argument('--block-size', type = int, default = 500, metavar = 'N',
+        help = 'Number of wavelength bins decorrelated at once with --banded.')
+    parser.add_argument('--halo', type = int, default = 50, metavar = 'N',
+        help = 'Number of extra bins on each side of a block with --banded.')
+    parser.add_argument('--nproc', type = int, default = default_nproc, metavar = 'N',
+        help = 'Number of processes used to coadd targets (forced to 1 with MPI).')
 
     args = None
     if options is None:
@@ -39,7 +59,64 @@ def parse(options=None):
     return args
 
 
-def main(args):
+
+
+def _coadd_target(task):
+    """Coadd all exposures of a single target, in each band and then across bands.
+
+    This is the unit of work distributed over processes, so it only depends on its
+    (picklable) argument.
+
+    Args:
+        task(tuple): Tuple (target_id,exposures,banded,block_size,halo) where exposures is
+            a list of (band,wlen,flux,ivar,resolution) tuples holding the (nexp,nwave) flux
+            and ivar and (nexp,ndiag,nwave) resolution of this target's exposures in one band.
+
+    Returns:
+        tuple: Tuple (target_id,band_coadds,global_coadd,nexp,elapsed) where band_coadds is a
+            list of (band,flux,ivar,resolution) tuples, global_coadd is a (flux,ivar,resolution)
+            tuple, nexp is the number of exposures used and elapsed is the time in seconds
+            spent on this target.
+    """
+    target_id,exposures,banded,block_size,halo = task
+    start = time.time()
+    nexp = 0
+    band_coadds = [ ]
+    coadd_all = desispec.coaddition.Spectrum(desispec.coaddition.global_wavelength_grid,banded = banded)
+    for band,wlen,flux,ivar,resolution in exposures:
+        coadd = desispec.coaddition.Spectrum(wlen,banded = banded)
+        for index in range(len(flux)):
+            resolution_matrix = desispec.resolution.Resolution(resolution[index])
+            coadd += desispec.coaddition.Spectrum(wlen,flux[index],ivar[index],
+                resolution = resolution_matrix,banded = banded)
+        nexp += len(flux)
+        coadd.finalize(block_size = block_size,halo = halo)
+        band_coadds.append((band,coadd.flux,coadd.ivar,coadd.resolution.to_fits_array()))
+        coadd_all += coadd
+    coadd_all.finalize(block_size = block_size,halo = halo)
+    global_coadd = (coadd_all.flux,coadd_all.ivar,coadd_all.resolution.to_fits_array())
+    return (target_id,band_coadds,global_coadd,nexp,time.time() - start)
+
+
+def _pop_ready(pending):
+    """Remove and return the first finished result from a list of pool results.
+
+    Waits for the oldest result when none is finished yet.
+
+    Args:
+        pending(list): List of :class:`multiprocessing.pool.AsyncResult` objects.
+
+    Returns:
+        multiprocessing.pool.AsyncResult: The finished result, removed from the list.
+    """
+    while True:
+        for index,result in enumerate(pending):
+            if result.ready():
+                return pending.pop(index)
+        pending[0].wait(0.05)
+
+
+def main(args, comm=None):
 
     if args.verbose:
         log = get_logger(DEBUG)
@@ -50,137 +127,241 @@ def main(args):
         log.critical('Missing required brick argument.')
         return -1
 
-    # Open the combined coadd file for this brick, for updating.
-    coadd_all_path = desispec.io.meta.findfile('coadd_all',brickname = args.brick,specprod_dir = args.specprod)
-    coadd_all_file = desispec.io.brick.CoAddedBrick(coadd_all_path,mode = 'update')
-
-    # Initialize dictionaries of co-added spectra for each object ID.
-    coadded_spectra = { }
+    if args.nproc < 1:
+        log.warning('Need nproc>=1, changing this %d -> 1' % args.nproc)
+        args.nproc = 1
+    if comm is not None:
+        if args.nproc != 1:
+            if comm.rank == 0:
+                log.warning('Using MPI, forcing multiprocessing nproc -> 1')
+            args.nproc = 1
+    is_root = (comm is None) or (comm.rank == 0)
 
     # Keep track of the index we assign to each target.
     next_coadd_index = 0
     target_index = { }
 
-    # The HDU4 table for the global coadd will go here.
+    # Input brick data and exposure rows of each target, for each band.
+    bands = [ ]
+    brick_files = { }
+    wlens = { }
+    target_rows = { }
+
+    # The HDU4 tables for the band coadds and the global coadd will go here.
+    coadd_info = { }
     coadd_all_info = None
 
-    # Loop over bands for this brick.
+    # Group the exposures of each band by target ID.
     for band in args.bands:
-        # Open this band's brick file for reading.
+        # Open this band's brick file for reading. Image HDUs are only read when
+        # the exposures of a target are sliced out of them.
         brick_path = desispec.io.meta.findfile('brick',brickname = args.brick,band = band,specprod_dir = args.specprod)
         if not os.path.exists(brick_path):
-            log.info('Skipping non-existent brick file {0}.'.format(brick_path))
+            if is_root:
+                log.info('Skipping non-existent brick file {0}.'.format(brick_path))
             continue
         brick_file = desispec.io.brick.Brick(brick_path,mode = 'readonly')
-        flux_in,ivar_in,wlen,resolution_in = (brick_file.hdu_list[0].data,brick_file.hdu_list[1].data,
-            brick_file.hdu_list[2].data,brick_file.hdu_list[3].data)
-        log.debug('Processing %s with %d exposures of %d targets...' % (
-                brick_path,brick_file.get_num_spectra(),brick_file.get_num_targets()))
-        if resolution_in.shape[1] != desispec.resolution.num_diagonals:
+        resolution_in = brick_file.hdu_list[3].data
+        if is_root:
+            log.debug('Processing %s with %d exposures of %d targets...' % (
+                    brick_path,brick_file.get_num_spectra(),brick_file.get_num_targets()))
+        if resolution_in.shape[1] != desispec.resolution.default_ndiag:
             log.error('resolution has unexpected shape (ndiag=%d != %d). Skipping this file.' % (
-                resolution_in.shape[1],desispec.resolution.num_diagonals))
+                resolution_in.shape[1],desispec.resolution.default_ndiag))
             brick_file.close()
             continue
-        # Open this band's coadd file for updating.
-        coadd_path = desispec.io.meta.findfile('coadd',brickname = args.brick,band = band, specprod_dir = args.specprod)
-        coadd_file = desispec.io.brick.CoAddedBrick(coadd_path,mode = 'update')
+        bands.append(band)
+        brick_files[band] = brick_file
+        wlens[band] = np.copy(brick_file.get_wavelength_grid())
+
         # Copy the input fibermap info for each exposure into memory.
-        coadd_info = np.copy(brick_file.hdu_list[4].data)
+        info = np.copy(brick_file.hdu_list[4].data)
+        assert np.array_equal(info['INDEX'],np.arange(len(info))),'Index mismatch in %s' % brick_path
         # Also copy the first band's info to initialize the global coadd info, but remember that this
         # band might not have all targets so we could see new targets in other bands.
         if coadd_all_info is None:
-            coadd_all_info = np.copy(brick_file.hdu_list[4].data)
-
-        # Loop over objects in the input brick file.
-        for index,info in enumerate(brick_file.hdu_list[4].data):
-            assert index == info['INDEX'],'Index mismatch: %d != %d' % (index,info['INDEX'])
-            resolution_matrix = desispec.resolution.Resolution(resolution_in[index])
-            spectrum = desispec.coaddition.Spectrum(wlen,flux_in[index],ivar_in[index],resolution_matrix)
-            target_id = info['TARGETID']
+            coadd_all_info = np.copy(info)
+
+        # Stable sort so that the exposures of each target keep their input order.
+        order = np.argsort(info['TARGETID'],kind = 'mergesort')
+        target_ids,first,counts = np.unique(info['TARGETID'][order],return_index = True,return_counts = True)
+        target_rows[band] = { }
+        # Assign coadd indices in the order that targets first appear in the input.
+        for group in np.argsort(order[first]):
+            target_id = target_ids[group]
             # Are we only processing specified targets?
             if len(args.target) > 0 and target_id not in args.target:
                 continue
+            rows = order[first[group]:first[group] + counts[group]]
+            target_rows[band][target_id] = rows
             # Have we seen this target before?
-            if target_id not in coadded_spectra:
-                coadded_spectra[target_id] = { }
+            if target_id not in target_index:
                 target_index[target_id] = next_coadd_index
                 next_coadd_index += 1
-            # Save the coadd index to our output table.
-            coadd_info['INDEX'][index] = target_index[target_id]
-            # Initialize the coadd for this band and target if necessary.
-            if band not in coadded_spectra[target_id]:
-                coadded_spectra[target_id][band] = desispec.coaddition.Spectrum(wlen)
-            # Do the coaddition.
-            coadded_spectra[target_id][band] += spectrum
-
-            # Is this exposure of this target already in our global coadd table?
-            exposure = info['EXPID']
-            seen = (coadd_all_info['EXPID'] == exposure) & (coadd_all_info['TARGETID'] == target_id)
-            if not np.any(seen):
-                log.info('Adding exposure %d of target %d to global coadd with partial band coverage.' % (
-                    exposure,target_id))
-                coadd_all_info.append(coadd_info[index])
-            else:
-                coadd_all_info['INDEX'][index] = target_index[target_id]
-
-        # Allocate arrays for the coadded results for this band. Since we always use the same index
-        # for the same target in each band, there might be some unused entries in these arrays if
-        # some bands are missing for some targets.
-        num_targets = 1 + np.max(coadd_info['INDEX'])
-        nbins = len(wlen)
-        flux_out = np.zeros((num_targets,nbins))
-        ivar_out = np.zeros_like(flux_out)
-        resolution_out = np.zeros((num_targets,desispec.resolution.num_diagonals,nbins))
-
-        # Save the coadded spectra for this band.
-        for target_id in coadded_spectra:
-            if band not in coadded_spectra[target_id]:
-                continue
-            exposures = (coadd_info['TARGETID'] == target_id)
-            index = target_index[target_id]
-            log.debug('Saving coadd of %d exposures for target ID %d to index %d.' % (
-                    np.count_nonzero(exposures),target_id,index))
-            coadd = coadded_spectra[target_id][band]
-            coadd.finalize()
-            flux_out[index] = coadd.flux
-            ivar_out[index] = coadd.ivar
-            resolution_out[index] = coadd.resolution.to_fits_array()
-
-        # Save the coadds for this band.
-        coadd_file.add_objects(flux_out,ivar_out,wlen,resolution_out)
-        coadd_file.hdu_list[4].data = coadd_info
-
-        # Close files for this band.
-        coadd_file.close()
-        brick_file.close()
+            # Save the coadd index to our output tables.
+            info['INDEX'][rows] = target_index[target_id]
+            # Are these exposures of this target already in our global coadd table?
+            for row in rows:
+                exposure = info['EXPID'][row]
+                seen = (coadd_all_info['EXPID'] == exposure) & (coadd_all_info['TARGETID'] == target_id)
+                if not np.any(seen):
+                    if is_root:
+                        log.info('Adding exposure %d of target %d to global coadd with partial band coverage.' % (
+                            exposure,target_id))
+                    coadd_all_info = np.append(coadd_all_info,info[row:row + 1])
+                else:
+                    coadd_all_info['INDEX'][seen] = target_index[target_id]
+        coadd_info[band] = info
+
+    targets = sorted(target_index,key = lambda target_id: target_index[target_id])
+    num_targets = len(targets)
+
+    # Allocate arrays for the coadded results. Since we always use the same index for the same
+    # target in each band, there might be some unused entries in the band arrays if some bands
+    # are missing for some targets.
+    outputs = { }
+    if is_root:
+        for band in bands:
+            nbins = len(wlens[band])
+            num_band_targets = 1 + np.max(coadd_info[band]['INDEX'])
+            outputs[band] = (np.zeros((num_band_targets,nbins)),np.zeros((num_band_targets,nbins)),
+                np.zeros((num_band_targets,desispec.resolution.default_ndiag,nbins)))
+        nbins = len(desispec.coaddition.global_wavelength_grid)
+        flux_all = np.empty((num_targets,nbins))
+        ivar_all = np.empty_like(flux_all)
+        resolution_all = np.empty((num_targets,desispec.resolution.default_ndiag,nbins))
 
-    # Allocate space for the global coadded results.
-    num_targets = next_coadd_index
-    nbins = len(desispec.coaddition.global_wavelength_grid)
-    flux_all = np.empty((num_targets,nbins))
-    ivar_all = np.empty_like(flux_all)
-    resolution_all = np.empty((num_targets,desispec.resolution.num_diagonals,nbins))
+    def make_task(target_id):
+        exposures = [ ]
+        for band in bands:
+            if target_id in target_rows[band]:
+                rows = target_rows[band][target_id]
+                hdu_list = brick_files[band].hdu_list
+                exposures.append((band,wlens[band],hdu_list[0].data[rows],
+                    hdu_list[1].data[rows],hdu_list[3].data[rows]))
+        return (target_id,exposures,args.banded,args.block_size,args.halo)
 
-    # Coadd the bands for each target ID.
     all_bands = ','.join(sorted(args.bands))
-    for target_id in coadded_spectra:
+    timing = [ ]
+
+    def save_result(result):
+        target_id,band_coadds,global_coadd,nexp,elapsed = result
         index = target_index[target_id]
-        bands = ','.join(sorted(coadded_spectra[target_id].keys()))
-        log.debug('Combining %s bands for target %d at index %d.' % (bands,target_id,index))
-        if bands != all_bands:
-            log.warning('WARNING: target %d has partial band coverage: %s' % (target_id,bands))
-        coadd_all = desispec.coaddition.Spectrum(desispec.coaddition.global_wavelength_grid)
-        for coadd_band in coadded_spectra[target_id].values():
-            coadd_all += coadd_band
-        coadd_all.finalize()
-        flux_all[index] = coadd_all.flux
-        ivar_all[index] = coadd_all.ivar
-        resolution_all[index] = coadd_all.resolution.to_fits_array()
+        coadd_bands = ','.join(sorted([band_coadd[0] for band_coadd in band_coadds]))
+        if coadd_bands != all_bands:
+            log.warning('WARNING: target %d has partial band coverage: %s' % (target_id,coadd_bands))
+        for band,flux,ivar,resolution in band_coadds:
+            outputs[band][0][index] = flux
+            outputs[band][1][index] = ivar
+            outputs[band][2][index] = resolution
+        flux_all[index],ivar_all[index],resolution_all[index] = global_coadd
+        log.debug('Coadded %d exposures in %s bands for target %d at index %d in %.2f s.' % (
+                nexp,coadd_bands,target_id,index,elapsed))
+        timing.append(elapsed)
+
+    def coadd_or_log(target_id):
+        # Log any exception and return None, so that the caller can keep going.
+        try:
+            return _coadd_target(make_task(target_id))
+        except:
+            log.error('process {} FAILED coadd of target {}'.format(
+                0 if comm is None else comm.rank,target_id))
+            exc_type,exc_value,exc_traceback = sys.exc_info()
+            lines = traceback.format_exception(exc_type,exc_value,exc_traceback)
+            log.error(''.join(lines))
+            return None
+
+    start = time.time()
+    if comm is None:
+        if args.nproc > 1:
+            # Keep a bounded number of targets in flight, so that the number of coadds
+            # in memory does not grow with the number of targets in the brick, and
+            # save each result as soon as it is ready whatever its submission order.
+            pool = multiprocessing.Pool(args.nproc)
+            max_pending = 2*args.nproc
+            pending = [ ]
+            for target_id in targets:
+                pending.append(pool.apply_async(_coadd_target,(make_task(target_id),)))
+                while len(pending) >= max_pending:
+                    save_result(_pop_ready(pending).get())
+            while len(pending) > 0:
+                save_result(_pop_ready(pending).get())
+            pool.close()
+            pool.join()
+        else:
+            for target_id in targets:
+                save_result(_coadd_target(make_task(target_id)))
+    else:
+        # Distribute the targets among processes. Each process coadds its own targets
+        # and sends each coadd to the root process as soon as it is done, while the
+        # root process saves the coadds it receives between its own targets.
+        my_first,my_num = dist_uniform(num_targets,comm.size,comm.rank)
+        my_targets = targets[my_first:my_first + my_num]
+        if my_num > 0:
+            log.info('process {} coadding targets {} - {}'.format(comm.rank,my_first,my_first + my_num - 1))
+        else:
+            log.info('process {} idle'.format(comm.rank))
+
+        # If any process throws an exception, log that error and ensure that all
+        # processes raise an exception. Failed targets are sent as None.
+        failcount = 0
+        if comm.rank == 0:
+            num_remote = num_targets - my_num
+            for target_id in my_targets:
+                result = coadd_or_log(target_id)
+                if result is None:
+                    failcount += 1
+                else:
+                    save_result(result)
+                # Default source and tag receive from any process.
+                while num_remote > 0 and comm.iprobe(tag = 0):
+                    result = comm.recv(tag = 0)
+                    num_remote -= 1
+                    if result is not None:
+                        save_result(result)
+            while num_remote > 0:
+                result = comm.recv(tag = 0)
+                num_remote -= 1
+                if result is not None:
+                    save_result(result)
+        else:
+            for target_id in my_targets:
+                result = coadd_or_log(target_id)
+                if result is None:
+                    failcount += 1
+                comm.send(result,dest = 0,tag = 0)
+
+        failcount = comm.allreduce(failcount)
+        if failcount > 0:
+            # all processes throw
+            raise RuntimeError('some coadd tasks failed')
+
+    for brick_file in brick_files.values():
+        brick_file.close()
+
+    if not is_root:
+        return 0
+
+    if len(timing) > 0:
+        log.info('Coadded %d targets in %.1f s (%.2f s per target, slowest %.2f s).' % (
+                len(timing),time.time() - start,np.mean(timing),np.max(timing)))
+
+    # Save the coadds for each band.
+    for band in bands:
+        coadd_path = desispec.io.meta.findfile('coadd',brickname = args.brick,band = band, specprod_dir = args.specprod)
+        coadd_file = desispec.io.brick.CoAddedBrick(coadd_path,mode = 'update',
+            header = dict(BRICKNAM = args.brick,CHANNEL = band))
+        flux_out,ivar_out,resolution_out = outputs[band]
+        coadd_file.add_objects(flux_out,ivar_out,wlens[band],resolution_out)
+        coadd_file.hdu_list[4].data = coadd_info[band]
+        coadd_file.close()
 
     # Save the global coadds.
+    coadd_all_path = desispec.io.meta.findfile('coadd_all',brickname = args.brick,specprod_dir = args.specprod)
+    coadd_all_file = desispec.io.brick.CoAddedBrick(coadd_all_path,mode = 'update',
+        header = dict(BRICKNAM = args.brick))
     coadd_all_file.add_objects(flux_all,ivar_all,desispec.coaddition.global_wavelength_grid,resolution_all)
     coadd_all_file.hdu_list[4].data = coadd_all_info
-
-    # Close the combined coadd file.
     coadd_all_file.close()
 
+    return 0
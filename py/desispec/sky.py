@@ -7,17 +7,15 @@ Utility functions to compute a sky model and subtract it.
 
 
 import numpy as np
-from desispec.resolution import Resolution
-from desispec.linalg import cholesky_solve
-from desispec.linalg import cholesky_solve_and_invert
-from desispec.linalg import spline_fit
+from desispec.resolution import Resolution, ResolutionStack
+from desispec.deconvolution import MeanSpectrumSolver
+from desispec.linalg import banded_sandwich_diagonal
 from desispec.log import get_logger
 from desispec import util
 
 from desiutil import stats as dustat
 
 import scipy,scipy.sparse,scipy.stats,scipy.ndimage
-import sys
 
 def compute_sky(frame, nsig_clipping=4.) :
     """Compute a sky model.
@@ -35,7 +33,8 @@ def compute_sky(frame, nsig_clipping=4.) :
           - resolution_data : 3D[nspec, ndiag, nwave]  (only sky fibers)
         nsig_clipping : [optional] sigma clipping value for outlier rejection
 
-    returns SkyModel object with attributes wave, flux, ivar, mask
+    returns CompactSkyModel object, a SkyModel with attributes wave, flux,
+    ivar, mask and the deconvolved sky
     """
 
     log=get_logger()
@@ -46,51 +45,31 @@ def compute_sky(frame, nsig_clipping=4.) :
     assert np.max(skyfibers) < 500  #- indices, not fiber numbers
 
     nwave=frame.nwave
-    nfibers=len(skyfibers)
 
     current_ivar=frame.ivar[skyfibers].copy()
     flux = frame.flux[skyfibers]
-    Rsky = frame.R[skyfibers]
 
-    sqrtw=np.sqrt(current_ivar)
-    sqrtwflux=sqrtw*flux
+    # banded normal equations of the deconvolved sky
+    solver = MeanSpectrumSolver(frame.resolution_data[skyfibers])
 
     chi2=np.zeros(flux.shape)
 
-    #debug
-    #nfibers=min(nfibers,2)
-
     nout_tot=0
     for iteration in range(20) :
 
-        A=scipy.sparse.lil_matrix((nwave,nwave)).tocsr()
-        B=np.zeros((nwave))
-        # diagonal sparse matrix with content = sqrt(ivar)*flat of a given fiber
-        SD=scipy.sparse.lil_matrix((nwave,nwave))
-        # loop on fiber to handle resolution
-        for fiber in range(nfibers) :
-            if fiber%10==0 :
-                log.info("iter %d fiber %d"%(iteration,fiber))
-            R = Rsky[fiber]
-
-            # diagonal sparse matrix with content = sqrt(ivar)
-            SD.setdiag(sqrtw[fiber])
+        log.info("iter %d filling banded matrix"%iteration)
 
-            sqrtwR = SD*R # each row r of R is multiplied by sqrtw[r]
-
-            A = A+(sqrtwR.T*sqrtwR).tocsr()
-            B += sqrtwR.T*sqrtwflux[fiber]
+        # only the rejected pixels are removed after the first iteration
+        solver.update(current_ivar,flux)
 
         log.info("iter %d solving"%iteration)
 
-        skyflux=cholesky_solve(A.todense(),B)
+        skyflux=solver.solve()
 
         log.info("iter %d compute chi2"%iteration)
 
-        for fiber in range(nfibers) :
-
-            S = Rsky[fiber].dot(skyflux)
-            chi2[fiber]=current_ivar[fiber]*(flux[fiber]-S)**2
+        S = solver.model(skyflux)
+        chi2=current_ivar*(flux-S)**2
 
         log.info("rejecting")
 
@@ -104,16 +83,12 @@ def compute_sky(frame, nsig_clipping=4.) :
             for i in selection :
                 worst_entry=np.argmax(chi2[:,i])
                 current_ivar[worst_entry,i]=0
-                sqrtw[worst_entry,i]=0
-                sqrtwflux[worst_entry,i]=0
                 nout_iter += 1
 
         else :
             # remove all of them at once
             bad=(chi2>nsig_clipping**2)
             current_ivar *= (bad==0)
-            sqrtw *= (bad==0)
-            sqrtwflux *= (bad==0)
             nout_iter += np.sum(bad)
 
         nout_tot += nout_iter
@@ -132,35 +107,28 @@ def compute_sky(frame, nsig_clipping=4.) :
 
 
     # solve once again to get deconvolved sky variance
-    skyflux,skycovar=cholesky_solve_and_invert(A.todense(),B)
+    skyflux=solver.solve()
 
     #- sky inverse variance, but incomplete and not needed anyway
-    # skyvar=np.diagonal(skycovar)
+    # skyvar=solver.covariance(diagonal=True)
     # skyivar=(skyvar>0)/(skyvar+(skyvar==0))
 
     # Use diagonal of skycovar convolved with mean resolution of all fibers
     # first compute average resolution
     mean_res_data=np.mean(frame.resolution_data,axis=0)
     R = Resolution(mean_res_data)
-    # compute convolved sky and ivar
-    cskycovar=R.dot(skycovar).dot(R.T.todense())
-    cskyvar=np.diagonal(cskycovar)
+    # compute convolved sky ivar, using only the band of skycovar
+    skycovar=solver.covariance()
+    cskyvar=banded_sandwich_diagonal(R,skycovar)
     cskyivar=(cskyvar>0)/(cskyvar+(cskyvar==0))
 
-    # convert cskyivar to 2D; today it is the same for all spectra,
-    # but that may not be the case in the future
-    cskyivar = np.tile(cskyivar, frame.nspec).reshape(frame.nspec, nwave)
-
-    # Convolved sky
-    cskyflux = np.zeros(frame.flux.shape)
-    for i in range(frame.nspec):
-        cskyflux[i] = frame.R[i].dot(skyflux)
-
     # need to do better here
     mask = (cskyivar==0).astype(np.uint32)
 
-    return SkyModel(frame.wave.copy(), cskyflux, cskyivar, mask,
-                    nrej=nout_tot)
+    # cskyivar is the same for all spectra; the convolved sky of each
+    # spectrum, frame.R.dot(skyflux), is only computed when accessed
+    return CompactSkyModel(frame.wave.copy(), skyflux, skycovar, cskyivar, mask,
+                           resolution_data=frame.resolution_data, nrej=nout_tot)
 
 class SkyModel(object):
     def __init__(self, wave, flux, ivar, mask, header=None, nrej=0):
@@ -190,12 +158,78 @@ class SkyModel(object):
         self.nrej = nrej
 
 
+class CompactSkyModel(SkyModel):
+    def __init__(self, wave, deconvolved, covariance, mean_ivar, mean_mask,
+                 resolution_data=None, nspec=None, header=None, nrej=0):
+        """Sky model stored as the deconvolved sky shared by all spectra
+
+        Args:
+            wave : 1D[nwave] wavelength in Angstroms
+            deconvolved : 1D[nwave] deconvolved sky
+            covariance : 2D[ncov, nwave] band of the covariance of the
+                deconvolved sky, in upper banded storage
+                (see :meth:`desispec.deconvolution.MeanSpectrumSolver.covariance`)
+            mean_ivar : 1D[nwave] inverse variance of the sky convolved with
+                the mean resolution of the frame
+            mean_mask : 1D[nwave] 0=ok or >0 if problems; 32-bit
+            resolution_data : (optional) 3D[nspec, ndiag, nwave] resolution
+                of the spectra of the frame
+            nspec : (optional) number of spectra, if resolution_data is None
+            header : (optional) header from FITS file HDU0
+            nrej : (optional) Number of rejected pixels in fit
+
+        All input arguments become attributes.  The 2D[nspec, nwave] flux,
+        ivar and mask of SkyModel are computed when first accessed; flux
+        requires resolution_data, which can be set from the frame after
+        reading a compact sky file.  ivar and mask are read-only views of
+        mean_ivar and mean_mask.
+        """
+        assert wave.ndim == 1
+        assert deconvolved.shape == wave.shape
+        assert mean_ivar.shape == wave.shape
+        assert mean_mask.shape == wave.shape
+        if resolution_data is not None:
+            nspec = resolution_data.shape[0]
+
+        self.nspec = nspec
+        self.nwave = wave.size
+        self.wave = wave
+        self.deconvolved = deconvolved
+        self.covariance = covariance
+        self.mean_ivar = mean_ivar
+        self.mean_mask = util.mask32(mean_mask)
+        self.resolution_data = resolution_data
+        self.header = header
+        self.nrej = nrej
+        self._flux = None
+
+    @property
+    def flux(self):
+        """2D[nspec, nwave] deconvolved sky convolved with the resolution of each spectrum"""
+        if self._flux is None:
+            if self.resolution_data is None:
+                raise AttributeError("CompactSkyModel has no resolution_data")
+            self._flux = ResolutionStack(self.resolution_data).dot(self.deconvolved)
+        return self._flux
+
+    @property
+    def ivar(self):
+        return np.broadcast_to(self.mean_ivar, (self.nspec, self.nwave))
+
+    @property
+    def mask(self):
+        return np.broadcast_to(self.mean_mask, (self.nspec, self.nwave))
+
+
 def subtract_sky(frame, skymodel) :
     """Subtract skymodel from frame, altering frame.flux, .ivar, and .mask
 
     Args:
         frame : desispec.Frame object
         skymodel : desispec.SkyModel object
+
+    A CompactSkyModel is convolved with the resolution of the frame without
+    expanding its per-spectrum arrays.
     """
     assert frame.nspec == skymodel.nspec
     assert frame.nwave == skymodel.nwave
@@ -209,9 +243,14 @@ def subtract_sky(frame, skymodel) :
         log.error(message)
         raise ValueError(message)
 
-    frame.flux -= skymodel.flux
-    frame.ivar = util.combine_ivar(frame.ivar, skymodel.ivar)
-    frame.mask |= skymodel.mask
+    if isinstance(skymodel, CompactSkyModel):
+        frame.flux -= frame.R.dot(skymodel.deconvolved)
+        frame.ivar = util.combine_ivar(frame.ivar, skymodel.ivar)
+        frame.mask |= skymodel.mean_mask
+    else:
+        frame.flux -= skymodel.flux
+        frame.ivar = util.combine_ivar(frame.ivar, skymodel.ivar)
+        frame.mask |= skymodel.mask
 
     log.info("done")
 
@@ -247,6 +286,8 @@ def qa_skysub(param, frame, skymodel, quick_look=False):
 
     current_ivar=frame.ivar[skyfibers].copy()
     flux = frame.flux[skyfibers]
+    if isinstance(skymodel, CompactSkyModel) and skymodel.resolution_data is None:
+        skymodel.resolution_data = frame.resolution_data
 
     # Subtract
     res = flux - skymodel.flux[skyfibers] # Residuals
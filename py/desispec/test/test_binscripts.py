@@ -231,6 +231,19 @@ class TestBinScripts(unittest.TestCase):
             inputs=inputs, outputs=outputs, clobber=True)
         self.assertEqual(err, None)
 
+    def test_procexp_parse(self):
+        """
+        Tests desi_process_exposure argument parsing
+        """
+        import desispec.scripts.procexp
+        args = desispec.scripts.procexp.parse(['--infile', self.framefile,
+            '--outfile', self.framefile])
+        self.assertEqual(args.infile, self.framefile)
+        self.assertEqual(args.resolution_max_error, None)
+        args = desispec.scripts.procexp.parse(['--infile', self.framefile,
+            '--outfile', self.framefile, '--resolution-max-error', '1e-4'])
+        self.assertEqual(args.resolution_max_error, 1e-4)
+
 
 #- This runs all test* functions in any TestCase class in this file
 if __name__ == '__main__':
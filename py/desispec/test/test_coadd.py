@@ -1,7 +1,9 @@
 import unittest
 
 import numpy as np
-from desispec.coaddition import Spectrum
+import scipy.sparse
+from desispec import coaddition, interpolation
+from desispec.coaddition import Spectrum, get_resampling_matrix, decorrelate, decorrelate_blocks
 from desispec.resolution import Resolution
 
 class TestCoadd(unittest.TestCase):
@@ -55,5 +57,76 @@ class TestCoadd(unittest.TestCase):
         s1 = Spectrum(*self._getdata(10))
         s1 += Spectrum(*self._getdata(13))
 
+    def _getsmooth(self, n=300, wmin=5000.):
+        wave = np.linspace(wmin, wmin+0.5*n, n)
+        flux = 2 + np.sin(wave/10.)
+        ivar = np.random.uniform(50, 100, size=n)
+        sigma = np.linspace(1., 2., n)
+        xx = np.arange(-10, 11)
+        rdat = np.exp(-xx[:,None]**2/(2*sigma**2))
+        rdat /= rdat.sum(axis=0)
+        return wave, flux, ivar, None, Resolution(rdat)
+
+    def test_sparse_resampling_matrix(self):
+        """Test sparse resampling matrix matches the dense one"""
+        global_grid = np.linspace(4990, 5200, 300)
+        local_grid = np.linspace(5000, 5100, 151)
+        dense = get_resampling_matrix(global_grid, local_grid, sparse=False)
+        sparse = get_resampling_matrix(global_grid, local_grid)
+        self.assertTrue(scipy.sparse.issparse(sparse))
+        self.assertEqual(sparse.shape, dense.shape)
+        self.assertTrue(np.allclose(sparse.toarray(), dense))
+        #- local grid starting on the first global bin
+        dense = get_resampling_matrix(global_grid, global_grid[:100], sparse=False)
+        sparse = get_resampling_matrix(global_grid, global_grid[:100])
+        self.assertTrue(np.allclose(sparse.toarray(), dense))
+        #- rows interpolate linearly and sum to one
+        self.assertTrue(np.allclose(sparse.sum(axis=1), 1))
+        self.assertTrue(np.allclose(sparse.dot(global_grid), global_grid[:100]))
+
+    def test_resampling_matrix_cache(self):
+        """Test that resampling matrices are reused for equal grids"""
+        global_grid = np.linspace(4990, 5200, 300)
+        local_grid = np.linspace(5000, 5100, 151)
+        m1 = get_resampling_matrix(global_grid, local_grid)
+        m2 = get_resampling_matrix(global_grid.copy(), local_grid.copy())
+        self.assertTrue(m1 is m2)
+        m3 = get_resampling_matrix(global_grid, local_grid[1:])
+        self.assertFalse(m1 is m3)
+        self.assertEqual(m3.shape, (150, 300))
+        #- the cache only keeps the most recently used matrices
+        for i in range(interpolation.grid_operator_cache_size):
+            get_resampling_matrix(global_grid, local_grid[i+2:])
+        self.assertFalse(m1 is get_resampling_matrix(global_grid, local_grid))
+
+    def test_decorrelate_blocks(self):
+        """Test block decorrelation of a banded matrix"""
+        s = Spectrum(*self._getsmooth(300))
+        Cinv = scipy.sparse.csr_matrix(s.Cinv)
+        ivar, R = decorrelate(Cinv.toarray())
+        ivarb, Rb = decorrelate_blocks(Cinv, block_size=100, halo=40)
+        self.assertTrue(scipy.sparse.issparse(Rb))
+        self.assertTrue(np.allclose(ivarb, ivar))
+        #- halo truncation only drops tiny elements far from the diagonal
+        self.assertTrue(np.allclose(Rb.toarray(), R, atol=1e-8))
+
+    def test_banded_coadd(self):
+        """Test banded coaddition gives the same result as the dense one"""
+        data = [self._getsmooth(300) for i in range(3)]
+        for grid in (data[0][0], np.linspace(4990., 5200., 400)):
+            dense = Spectrum(grid)
+            banded = Spectrum(grid, banded=True)
+            for d in data:
+                dense += Spectrum(*d)
+                banded += Spectrum(*d, banded=True)
+            self.assertTrue(scipy.sparse.issparse(banded.Cinv))
+            dense.finalize()
+            banded.finalize(block_size=100, halo=40)
+            self.assertTrue(np.allclose(banded.ivar, dense.ivar))
+            self.assertTrue(np.allclose(banded.resolution.toarray(),
+                                        dense.resolution.toarray(), atol=1e-8))
+            #- the deconvolution is badly conditioned so allow some slop
+            self.assertTrue(np.allclose(banded.flux, dense.flux, rtol=0, atol=1e-2))
+
 if __name__ == '__main__':
     unittest.main()           
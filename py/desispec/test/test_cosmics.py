@@ -6,6 +6,7 @@ import unittest
 import numpy as np
 from desispec.image import Image
 from desispec.cosmics import reject_cosmic_rays_ala_sdss, reject_cosmic_rays
+from desispec.cosmics import reject_cosmic_rays_ala_sdss_single
 from desispec.log import get_logger
 from desispec.maskbits import ccdmask
 
@@ -78,6 +79,44 @@ class TestCosmics(unittest.TestCase):
             image = Image(self.pix, self.ivar, mask=self.badmask, camera='a0')
             rejected = reject_cosmic_rays_ala_sdss(image,dilate=False)                
         
+    def test_tiled_rejection(self):
+        """
+        Test that blocks, threads and sparse iterations do not change the mask
+        """
+        rng = np.random.RandomState(0)
+        pix = rng.normal(0, 1, (120, 90))
+        pix[:, 40:43] += [20., 50., 20.]
+        for n in range(30):
+            i, j = rng.randint(2, 100), rng.randint(2, 70)
+            length = rng.randint(1, 15)
+            pix[i+np.arange(length), j+np.arange(length)//2] += rng.uniform(10, 100, length)
+        ivar = np.ones(pix.shape)
+        mask = np.zeros(pix.shape, dtype=np.uint32)
+        mask[:, 60] = ccdmask.BAD
+        image = Image(pix, ivar, mask=mask, camera="b0")
+
+        #- reference: all neighbors of rejected pixels are tested at each iteration
+        selection = ((pix*np.sqrt(ivar)*(image.mask==0))[1:-1,1:-1] > 6.)
+        expected = reject_cosmic_rays_ala_sdss_single(image, selection, 6., 3., 0.8)
+        ref = Image(pix, ivar.copy(), mask=image.mask, camera="b0")
+        for iteration in range(20):
+            neighbors = np.zeros(expected.shape, dtype=bool)
+            for di in (-1, 0, 1):
+                for dj in (-1, 0, 1):
+                    neighbors |= np.roll(np.roll(expected, di, axis=0), dj, axis=1)
+            neighbors &= ~expected
+            ref.ivar[expected] = 0.
+            new = reject_cosmic_rays_ala_sdss_single(ref, neighbors[1:-1,1:-1], 3., 0., 1.)
+            if np.sum(new) < 2:
+                break
+            expected |= new
+        self.assertTrue(np.any(expected))
+
+        for nthreads, block_rows in [(1, 256), (1, 7), (3, 10)]:
+            rejected = reject_cosmic_rays_ala_sdss(image, niter=20, dilate=False,
+                nthreads=nthreads, block_rows=block_rows)
+            self.assertTrue(np.all(rejected == expected))
+
     def test_reject_cosmics(self):
         """
         Test that the generic cosmics interface updates the mask
@@ -0,0 +1,115 @@
+"""
+tests desispec.deconvolution
+"""
+
+import unittest
+
+import numpy as np
+from desispec.resolution import Resolution
+from desispec.deconvolution import resolution_rows, apply_resolution_rows
+from desispec.deconvolution import banded_normal_equation, MeanSpectrumSolver
+
+
+class TestDeconvolution(unittest.TestCase):
+
+    def setUp(self):
+        self.nspec = 6
+        self.nwave = 80
+        ndiag = 11
+        xx = np.arange(ndiag) - ndiag//2
+        self.rdata = np.zeros((self.nspec, ndiag, self.nwave))
+        for i in range(self.nspec):
+            sigma = np.linspace(1.0, 2.0, self.nwave) + 0.1*i
+            kernel = np.exp(-xx[:,None]**2/(2*sigma[None,:]**2))
+            self.rdata[i] = kernel/kernel.sum(axis=0)
+        self.R = [Resolution(r).toarray() for r in self.rdata]
+        self.ivar = np.random.uniform(0.5, 2., size=(self.nspec, self.nwave))
+        self.flux = np.random.normal(size=(self.nspec, self.nwave))
+
+    def _dense(self, ivar, flux, scale=None, colscale=None):
+        nwave = self.nwave
+        if scale is None:
+            scale = np.ones(ivar.shape)
+        if colscale is None:
+            colscale = np.ones(ivar.shape)
+        A = np.zeros((nwave, nwave))
+        B = np.zeros(nwave)
+        for i in range(self.nspec):
+            RC = scale[i][:,None] * self.R[i] * colscale[i][None,:]
+            A += RC.T.dot(ivar[i][:,None]*RC)
+            B += RC.T.dot(ivar[i]*flux[i])
+        return A, B
+
+    def _check_banded(self, Ab, A):
+        u = Ab.shape[0]-1
+        for d in range(u+1):
+            self.assertTrue(np.allclose(Ab[u-d, d:], np.diag(A, d)))
+
+    def test_apply_resolution_rows(self):
+        rows = resolution_rows(self.rdata)
+        x = np.random.normal(size=self.nwave)
+        model = apply_resolution_rows(rows, x)
+        for i in range(self.nspec):
+            self.assertTrue(np.allclose(model[i], self.R[i].dot(x)))
+        #- one vector per fiber
+        x = np.random.normal(size=(self.nspec, self.nwave))
+        model = apply_resolution_rows(rows, x)
+        for i in range(self.nspec):
+            self.assertTrue(np.allclose(model[i], self.R[i].dot(x[i])))
+
+    def test_banded_normal_equation(self):
+        rows = resolution_rows(self.rdata)
+        Ab, B = banded_normal_equation(rows, self.ivar, self.ivar*self.flux)
+        A, Bd = self._dense(self.ivar, self.flux)
+        self.assertEqual(Ab.shape, (self.rdata.shape[1], self.nwave))
+        self._check_banded(Ab, A)
+        self.assertTrue(np.allclose(B, Bd))
+
+    def test_solver(self):
+        scale = np.random.uniform(0.8, 1.2, size=self.flux.shape)
+        colscale = np.random.uniform(0.8, 1.2, size=self.flux.shape)
+        solver = MeanSpectrumSolver(self.rdata, column_scale=colscale)
+        solver.fill(self.ivar, self.flux, scale=scale)
+        A, B = self._dense(self.ivar, self.flux, scale, colscale)
+        self._check_banded(solver.Ab, A)
+        self.assertTrue(np.allclose(solver.solve(), np.linalg.solve(A, B)))
+        Ai = np.linalg.inv(A)
+        self._check_banded(solver.covariance(), Ai)
+        self.assertTrue(np.allclose(solver.covariance(diagonal=True), np.diag(Ai)))
+        Rm = Resolution(np.mean(self.rdata, axis=0))
+        self.assertTrue(np.allclose(solver.convolved_variance(Rm),
+                                    np.diag(Rm.dot(Ai).dot(Rm.T.toarray()))))
+        #- prior
+        solver.set_prior(0.5, 2.)
+        x = np.linalg.solve(A+0.5*np.eye(self.nwave), B+0.5*2.)
+        self.assertTrue(np.allclose(solver.solve(), x))
+        #- model
+        model = solver.model(x)
+        for i in range(self.nspec):
+            self.assertTrue(np.allclose(model[i], self.R[i].dot(colscale[i]*x)))
+
+    def test_update(self):
+        solver = MeanSpectrumSolver(self.rdata)
+        ivar = self.ivar.copy()
+        solver.fill(ivar, self.flux)
+        #- reject a few pixels, including at the edges
+        ivar[0, 0] = 0
+        ivar[2, 10] = 0
+        ivar[5, -1] = 0
+        solver.update(ivar, self.flux)
+        A, B = self._dense(ivar, self.flux)
+        self._check_banded(solver.Ab, A)
+        self.assertTrue(np.allclose(solver.B, B))
+        self.assertTrue(np.allclose(solver.solve(), np.linalg.solve(A, B)))
+        #- a large change triggers a complete refill
+        ivar[:, ::2] = 0
+        solver.update(ivar, self.flux)
+        A, B = self._dense(ivar, self.flux)
+        self._check_banded(solver.Ab, A)
+        self.assertTrue(np.allclose(solver.B, B))
+
+    def runTest(self):
+        pass
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,6 +17,9 @@ from desispec.resolution import Resolution
 from desispec.frame import Frame
 from desispec.fiberflat import FiberFlat
 from desispec.fiberflat import compute_fiberflat, apply_fiberflat
+from desispec.fiberflat import _masked_column_median, _worst_pixels, _max_run_length
+from desispec.fiberflat import _clip_smooth_fiberflat
+from desispec.linalg import SplineFitter, spline_fit, cholesky_solve
 from desispec.log import get_logger
 from desispec.io import write_frame
 import desispec.io as io
@@ -42,6 +45,206 @@ def _get_data():
     return wave, flux, ivar, mask
     
 
+def _get_cosmics_frame(seed):
+    """
+    Return a Frame of flat field spectra with varying throughput and
+    resolution, cosmics and segments of bad pixels, and the (fibers, pixels)
+    indices of the cosmics
+    """
+    rng = np.random.RandomState(seed)
+    nspec, nwave = 12, 400
+    wave = np.linspace(5000, 5400, nwave)
+    ndiag = 11
+    xx = np.arange(ndiag) - ndiag//2
+    Rdata = np.zeros((nspec, ndiag, nwave))
+    for i in range(nspec):
+        kernel = np.exp(-xx**2/(2*(1.0+0.1*i)**2))
+        Rdata[i] = (kernel/kernel.sum())[:, None]
+    spectrum = 100 + 50*np.sin(wave/20.) + 300*np.exp(-(wave-5200)**2/2.)
+    flux = np.array([Resolution(Rdata[i]).dot(spectrum)*(1+0.1*np.sin(wave/(100.+i))) for i in range(nspec)])
+    ivar = 1/flux
+    flux += rng.normal(size=flux.shape)/np.sqrt(ivar)
+    #- cosmics and long segments of bad pixels (which change the
+    #- smoothing resolution of the following fibers)
+    cosmics = (rng.randint(0, nspec, 20), rng.randint(0, nwave, 20))
+    flux[cosmics] += 500
+    ivar[2, 150:280] = 0
+    ivar[4, 50:80] = 0
+    ivar[6] = 0
+    frame = Frame(wave, flux, ivar, np.zeros(flux.shape, dtype=int), Rdata, spectrograph=0)
+    return frame, cosmics
+
+
+def _baseline_compute_fiberflat(frame, nsig_clipping=4., accuracy=5.e-4, minval=0.1, maxval=10.):
+    """
+    Reference copy of compute_fiberflat as it was before its passes were
+    vectorized (per-fiber loops, spline_fit and a dense cholesky_solve),
+    with the logging removed
+    """
+    nwave=frame.nwave
+    nfibers=frame.nspec
+    wave = frame.wave.copy()
+    flux = frame.flux
+    ivar = frame.ivar*(frame.mask==0)
+    max_iterations = 100
+    chi2pdf = 0.
+    smooth_fiberflat=np.ones((frame.flux.shape))
+    previous_smooth_fiberflat=smooth_fiberflat.copy()
+    chi2=np.zeros((flux.shape))
+
+    for iteration in range(max_iterations) :
+        mean_spectrum=np.zeros((flux.shape[1]))
+        for i in range(flux.shape[1]) :
+            ok=np.where(ivar[:,i]>0)[0]
+            if ok.size > 0 :
+                mean_spectrum[i]=np.median(flux[ok,i])
+        nout_iter=0
+        for fiber in range(nfibers) :
+            bad=np.where((ivar[fiber]>0)&((flux[fiber]>maxval*mean_spectrum)|(flux[fiber]<minval*mean_spectrum)))[0]
+        if bad.size>100 :
+            ivar[fiber]=0.
+        if bad.size>0 :
+            ivar[fiber,bad]=0.
+        nout_iter += bad.size
+        smoothing_res=100.
+        for fiber in range(nfibers) :
+            if np.sum(ivar[fiber]>0)==0 :
+                continue
+            F = np.ones((flux.shape[1]))
+            ok=np.where((mean_spectrum!=0)&(ivar[fiber]>0))[0]
+            F[ok] = flux[fiber,ok]/mean_spectrum[ok]
+            smooth_fiberflat[fiber]=spline_fit(wave,wave[ok],F[ok],smoothing_res,ivar[fiber,ok])
+        mean=np.mean(smooth_fiberflat,axis=0)
+        ok=np.where(mean!=0)[0]
+        for fiber in range(nfibers) :
+            smooth_fiberflat[fiber,ok] = smooth_fiberflat[fiber,ok]/mean[ok]
+        mean_spectrum *= mean
+        max_diff=np.max(np.abs(smooth_fiberflat-previous_smooth_fiberflat)*(ivar>0.))
+        previous_smooth_fiberflat=smooth_fiberflat.copy()
+        if max_diff>0.01 :
+            continue
+        chi2=ivar*(flux-smooth_fiberflat*mean_spectrum)**2
+        for fiber in range(nfibers) :
+            for loop in range(max_iterations) :
+                bad=np.where(chi2[fiber]>nsig_clipping**2)[0]
+                if bad.size>0 :
+                    if bad.size>5 :
+                        ii=np.argsort(chi2[fiber,bad])
+                        bad=bad[ii[-5:]]
+                    ivar[fiber,bad] = 0
+                    nout_iter += bad.size
+                    ok=np.where((mean_spectrum!=0)&(ivar[fiber]>0))[0]
+                    F[ok] = flux[fiber,ok]/mean_spectrum[ok]
+                    smooth_fiberflat[fiber]=spline_fit(wave,wave[ok],F[ok],smoothing_res,ivar[fiber,ok])
+                    chi2[fiber]=ivar[fiber]*(flux[fiber]-smooth_fiberflat[fiber]*mean_spectrum)**2
+                else :
+                    break
+        sum_chi2=float(np.sum(chi2))
+        ndf=int(np.sum(chi2>0)-nwave-nfibers*(nwave/smoothing_res))
+        chi2pdf=0.
+        if ndf>0 :
+            chi2pdf=sum_chi2/ndf
+        if max_diff>accuracy :
+            continue
+        if nout_iter == 0 :
+            break
+
+    for iteration in range(max_iterations) :
+        A=scipy.sparse.lil_matrix((nwave,nwave)).tocsr()
+        B=np.zeros((nwave))
+        SD=scipy.sparse.lil_matrix((nwave,nwave))
+        sqrtwflat=np.sqrt(ivar)*smooth_fiberflat
+        for fiber in range(nfibers) :
+            R = Resolution(frame.resolution_data[fiber])
+            SD.setdiag(sqrtwflat[fiber])
+            sqrtwflatR = SD*R
+            A = A+(sqrtwflatR.T*sqrtwflatR).tocsr()
+            B += sqrtwflatR.T.dot(np.sqrt(ivar[fiber])*flux[fiber])
+        mean_spectrum=cholesky_solve(A.todense(),B)
+        smoothing_res=100.
+        for fiber in range(nfibers) :
+            if np.sum(ivar[fiber]>0)==0 :
+                continue
+            R = Resolution(frame.resolution_data[fiber])
+            M = R.dot(mean_spectrum)
+            ok=np.where(M!=0)[0]
+            smooth_fiberflat[fiber]=spline_fit(wave,wave[ok],flux[fiber,ok]/M[ok],smoothing_res,ivar[fiber,ok])
+        mean=np.mean(smooth_fiberflat,axis=0)
+        ok=np.where(mean!=0)[0]
+        smooth_fiberflat[:,ok] /= mean[ok]
+        mean_spectrum *= mean
+        chi2=ivar*(flux-smooth_fiberflat*mean_spectrum)**2
+        max_diff=np.max(np.abs(smooth_fiberflat-previous_smooth_fiberflat)*(ivar>0.))
+        previous_smooth_fiberflat=smooth_fiberflat.copy()
+        sum_chi2=float(np.sum(chi2))
+        ndf=int(np.sum(chi2>0)-nwave-nfibers*(nwave/smoothing_res))
+        chi2pdf=0.
+        if ndf>0 :
+            chi2pdf=sum_chi2/ndf
+        if max_diff<accuracy :
+            break
+
+    fiberflat=np.ones((flux.shape))
+    fiberflat_ivar=np.zeros((flux.shape))
+    mask=np.zeros((flux.shape), dtype='uint32')
+    ivar=frame.ivar
+    fiberflat_mask=12
+    nsig_for_mask=nsig_clipping
+    for fiber in range(nfibers) :
+        if np.sum(ivar[fiber]>0)==0 :
+            continue
+        R = Resolution(frame.resolution_data[fiber])
+        M = np.array(np.dot(R.todense(),mean_spectrum)).flatten()
+        fiberflat[fiber] = (M!=0)*flux[fiber]/(M+(M==0)) + (M==0)
+        fiberflat_ivar[fiber] = ivar[fiber]*M**2
+        iteration=0
+        while iteration<500 :
+            smooth_fiberflat=spline_fit(wave,wave,fiberflat[fiber],smoothing_res,fiberflat_ivar[fiber])
+            chi2=fiberflat_ivar[fiber]*(fiberflat[fiber]-smooth_fiberflat)**2
+            bad=np.where(chi2>nsig_for_mask**2)[0]
+            if bad.size>0 :
+                if bad.size>5 :
+                    ii=np.argsort(chi2[bad])
+                    bad=bad[ii[-5:]]
+                mask[fiber,bad] += fiberflat_mask
+                fiberflat_ivar[fiber,bad] = 0.
+            else :
+                break
+            iteration += 1
+        bad=np.where((mask[fiber]>0)|(fiberflat_ivar[fiber]==0)|(fiberflat[fiber]<minval)|(fiberflat[fiber]>maxval))[0]
+        if bad.size>0 :
+            fiberflat_ivar[fiber,bad] = 0
+            length=0
+            for i in range(bad.size) :
+                ib=bad[i]
+                ilength=1
+                tmp=ib
+                for jb in bad[i+1:] :
+                    if jb==tmp+1 :
+                        ilength +=1
+                        tmp=jb
+                    else :
+                        break
+                length=max(length,ilength)
+            smoothing_res=float(max(100,2*length))
+            x=np.arange(wave.size)
+            ok=np.where(fiberflat_ivar[fiber]>0)[0]
+            smooth_fiberflat=spline_fit(x,x[ok],fiberflat[fiber,ok],smoothing_res,fiberflat_ivar[fiber,ok])
+            fiberflat[fiber,bad] = smooth_fiberflat[bad]
+
+    mean=np.ones((flux.shape[1]))
+    for i in range(flux.shape[1]) :
+        ok=np.where((mask[:,i]==0)&(ivar[:,i]>0))[0]
+        if ok.size > 0 :
+            mean[i] = np.median(fiberflat[ok,i])
+    ok=np.where(mean!=0)[0]
+    for fiber in range(nfibers) :
+        fiberflat[fiber,ok] /= mean[ok]
+
+    return FiberFlat(wave, fiberflat, fiberflat_ivar, mask, mean_spectrum,
+                     chi2pdf=chi2pdf)
+
+
 class TestFiberFlat(unittest.TestCase):
 
 
@@ -220,6 +423,118 @@ class TestFiberFlat(unittest.TestCase):
         diff = (ff.fiberflat[4]*1.2 - ff.fiberflat[mid])
         self.assertLess(np.max(np.abs(diff)), accuracy)
         
+    def test_rejection_helpers(self):
+        """
+        Test the vectorized rejection helpers against the per-column and
+        per-fiber loops they replace
+        """
+        rng = np.random.RandomState(1)
+        values = rng.normal(size=(9, 50))
+        good = rng.uniform(size=values.shape) > 0.3
+        good[:, 7] = False
+        good[:, 8] = False
+        good[4, 8] = True
+        median = np.zeros(values.shape[1])
+        for i in range(values.shape[1]):
+            ok = np.where(good[:, i])[0]
+            if ok.size > 0:
+                median[i] = np.median(values[ok, i])
+        self.assertTrue(np.all(_masked_column_median(values, good) == median))
+        self.assertEqual(_masked_column_median(values, good, default=1.)[7], 1.)
+
+        chi2 = rng.exponential(5., size=values.shape)
+        worst = _worst_pixels(chi2, 16.)
+        for fiber in range(chi2.shape[0]):
+            bad = np.where(chi2[fiber] > 16.)[0]
+            if bad.size > 5:
+                ii = np.argsort(chi2[fiber, bad])
+                bad = bad[ii[-5:]]
+            self.assertTrue(np.all(np.where(worst[fiber])[0] == np.sort(bad)))
+
+        for bad in ([], [3], [1, 2, 3, 7, 8, 10, 11, 12, 13], [0, 2, 4]):
+            bad = np.array(bad, dtype=int)
+            length = 0
+            for i in range(bad.size):
+                ilength = 1
+                tmp = bad[i]
+                for jb in bad[i+1:]:
+                    if jb == tmp+1:
+                        ilength += 1
+                        tmp = jb
+                    else:
+                        break
+                length = max(length, ilength)
+            self.assertEqual(_max_run_length(bad), length)
+
+    def test_clip_smooth_fiberflat(self):
+        """
+        Test that the batched clipping of the 3rd pass rejects the same pixels
+        as the per-fiber loop it replaced
+        """
+        nwave, nfibers, nsig = 300, 8, 4.
+        wave = np.linspace(5000, 5300, nwave)
+        for seed in range(4):
+            rng = np.random.RandomState(seed)
+            fiberflat = 1 + 0.05*np.sin(wave/(20.+np.arange(nfibers)[:, None]))
+            ivar = rng.uniform(1e4, 4e4, size=fiberflat.shape)
+            fiberflat += rng.normal(size=fiberflat.shape)/np.sqrt(ivar)
+            fiberflat[rng.randint(0, nfibers, 30), rng.randint(0, nwave, 30)] += rng.uniform(0.05, 0.5, 30)
+            ivar[rng.randint(0, nfibers), 100:130] = 0
+            fibers = np.arange(1, nfibers)
+
+            #- per-fiber loop
+            ref_ivar = ivar.copy()
+            ref_rejected = np.zeros((fibers.size, nwave), dtype=bool)
+            ref_niter = np.zeros(fibers.size, dtype=int)
+            spline_fitter = SplineFitter(wave, 20.)
+            all_pixels = np.ones(nwave, dtype=bool)
+            for index, fiber in enumerate(fibers):
+                while ref_niter[index] < 500:
+                    smooth = spline_fitter.refit(fiber, fiberflat[fiber], ref_ivar[fiber], valid=all_pixels)
+                    chi2 = ref_ivar[fiber]*(fiberflat[fiber]-smooth)**2
+                    bad = np.where(chi2 > nsig**2)[0]
+                    if bad.size == 0:
+                        break
+                    if bad.size > 5:
+                        ii = np.argsort(chi2[bad])
+                        bad = bad[ii[-5:]]
+                    ref_rejected[index, bad] = True
+                    ref_ivar[fiber, bad] = 0.
+                    ref_niter[index] += 1
+
+            new_ivar = ivar.copy()
+            rejected, niter = _clip_smooth_fiberflat(SplineFitter(wave, 20.), fibers,
+                fiberflat, new_ivar, nsig)
+            self.assertTrue(np.any(ref_rejected))
+            self.assertTrue(np.all(rejected == ref_rejected))
+            self.assertTrue(np.all(niter == ref_niter))
+            self.assertTrue(np.all(new_ivar == ref_ivar))
+
+    def test_rejection_masks_cosmics(self):
+        """
+        Test that compute_fiberflat masks the cosmics of a frame
+        """
+        frame, cosmics = _get_cosmics_frame(0)
+        ff = compute_fiberflat(frame)
+        self.assertTrue(np.all((ff.mask[cosmics] != 0) | (ff.ivar[cosmics] == 0)))
+        self.assertTrue(np.all(ff.ivar[6] == 0))
+        self.assertTrue(np.all(ff.ivar[2, 150:280] == 0))
+
+    def test_compare_baseline(self):
+        """
+        Test that compute_fiberflat gives the same mask, fiberflat and ivar
+        as the per-fiber implementation it replaced
+        """
+        for seed in range(3):
+            frame, cosmics = _get_cosmics_frame(seed)
+            ref = _baseline_compute_fiberflat(copy.deepcopy(frame))
+            ff = compute_fiberflat(frame)
+            self.assertTrue(np.any(ref.mask != 0))
+            self.assertTrue(np.all(ff.mask == ref.mask))
+            self.assertTrue(np.allclose(ff.fiberflat, ref.fiberflat, rtol=1e-6, atol=1e-8))
+            self.assertTrue(np.allclose(ff.ivar, ref.ivar, rtol=1e-6, atol=1e-8))
+            self.assertTrue(np.allclose(ff.meanspec, ref.meanspec, rtol=1e-6, atol=1e-8))
+
     def test_apply_fiberflat(self):
         '''test apply_fiberflat interface and changes to flux and mask'''
         wave = np.arange(5000, 5050)
@@ -7,6 +7,8 @@ from __future__ import division
 import unittest
 import copy
 import os
+import tempfile
+import shutil
 
 import numpy as np
 #import scipy.sparse
@@ -128,6 +130,23 @@ class TestFluxCalibration(unittest.TestCase):
 
             #- TODO: come up with assertions for new return values
 
+    def test_compute_chi2(self):
+        """
+        Test that the chi2 of several templates is that of each template
+        """
+        from desispec.fluxcalibration import compute_chi2
+        frame=get_frame_data(nspec=1)
+        wave={"b":frame.wave,"r":frame.wave+10}
+        flux={"b":frame.flux[0],"r":frame.flux[0]*1.1}
+        ivar={"b":frame.ivar[0],"r":frame.ivar[0]/1.1}
+        resol_data={"b":frame.resolution_data[0],"r":frame.resolution_data[0]}
+        modelwave,modelflux=get_models(4)
+        modelflux *= np.linspace(0.5,2.,modelflux.shape[1])**np.arange(4)[:,None]
+        chi2=compute_chi2(wave,flux,ivar,resol_data,modelwave,modelflux)
+        self.assertEqual(chi2.shape,(4,))
+        for i in range(4):
+            self.assertAlmostEqual(chi2[i]/compute_chi2(wave,flux,ivar,resol_data,modelwave,modelflux[i]),1.)
+
     def test_normalize_templates(self):
         """
         Test for normalization to a given magnitude for calibration
@@ -272,6 +291,74 @@ class TestFluxCalibration(unittest.TestCase):
         with self.assertRaises(SystemExit):  #should be ValueError instead?
             apply_flux_calibration(frame,fc)
 
+    def test_compact_fluxcalib(self):
+        """Test that compact flux calibration files give the same calibration
+        """
+        from desispec.io.fluxcalibration import write_flux_calibration, read_flux_calibration
+        frame = get_frame_data()
+        modelwave, modelflux = get_models()
+        frame.fibermap['OBJTYPE'][0:3] = 'STD'
+        fluxcalib = compute_flux_calibration(frame, modelwave, modelflux[0:3])
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fullfile = os.path.join(tmpdir, 'calib-full.fits')
+            compactfile = os.path.join(tmpdir, 'calib-compact.fits')
+            write_flux_calibration(fullfile, fluxcalib)
+            write_flux_calibration(compactfile, fluxcalib, compact=True)
+            full = read_flux_calibration(fullfile)
+            compact = read_flux_calibration(compactfile)
+            self.assertEqual(compact.nspec, frame.nspec)
+            self.assertTrue(np.allclose(compact.mean_ivar, full.ivar[0], rtol=1e-6))
+            with self.assertRaises(AttributeError):
+                compact.calib
+
+            #- the wavelength is stored as float32
+            frame.wave = full.wave
+            frame1 = copy.deepcopy(frame)
+            frame2 = copy.deepcopy(frame)
+            apply_flux_calibration(frame1, full)
+            apply_flux_calibration(frame2, compact)
+            self.assertTrue(np.allclose(frame1.flux, frame2.flux, rtol=1e-5))
+            self.assertTrue(np.allclose(frame1.ivar, frame2.ivar, rtol=1e-5))
+
+            compact.resolution_data = frame.resolution_data
+            self.assertTrue(np.allclose(compact.calib, full.calib, rtol=1e-5))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_stdstar_template_cache(self):
+        """
+        Test that cached star models and mags are those of the template file
+        """
+        from astropy.io import fits
+        from astropy.table import Table
+        tmpdir = tempfile.mkdtemp()
+        try:
+            modelwave,modelflux=get_models(3,nwave=500,wavemin=3000,wavemax=11000)
+            modelflux *= np.arange(1,4)[:,None]
+            params = Table()
+            params['TEMPLATEID'] = np.arange(3)
+            params['TEFF'] = [5000.,6000.,7000.]
+            params['LOGG'] = [4.,4.5,5.]
+            params['FEH'] = [-1.,-1.5,-2.]
+            filename = os.path.join(tmpdir,'templates.fits')
+            fits.HDUList([fits.PrimaryHDU(modelflux),fits.table_to_hdu(params),
+                fits.ImageHDU(modelwave)]).writeto(filename)
+            cache_dir = os.path.join(tmpdir,'cache')
+
+            templates = desispec.io.read_stdstar_templates(filename)
+            nocache = desispec.io.read_stdstar_templates_cached(filename,['SDSS_R','DECAM_G'])
+            for filters in (['SDSS_R'],['SDSS_R','DECAM_G']):
+                cached = desispec.io.read_stdstar_templates_cached(filename,filters,cache_dir)
+                for a,b in zip(templates,cached[:6]):
+                    self.assertTrue(np.all(a == b))
+                self.assertTrue(np.allclose(cached[6],nocache[6][:,:len(filters)]))
+            self.assertEqual(len(os.listdir(cache_dir)),1)
+            #- magnitudes scale with the flux
+            self.assertTrue(np.allclose(nocache[6][0]-nocache[6][1],2.5*np.log10(2)))
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_main(self):
         pass
 
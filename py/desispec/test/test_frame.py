@@ -3,7 +3,7 @@ import unittest
 import numpy as np
 import desispec.io
 from desispec.frame import Frame, Spectrum
-from desispec.resolution import Resolution
+from desispec.resolution import Resolution, ResolutionStack
 
 class TestFrame(unittest.TestCase):
 
@@ -24,6 +24,9 @@ class TestFrame(unittest.TestCase):
         self.assertEqual(frame.nspec, nspec)
         self.assertEqual(frame.nwave, nwave)
         self.assertTrue(isinstance(frame.R[0], Resolution))
+        self.assertTrue(isinstance(frame.R, ResolutionStack))
+        self.assertEqual(len(frame.R), nspec)
+        self.assertTrue(np.allclose(frame.R.dot(wave)[1], frame.R[1].dot(wave)))
         #- check dimensionality mismatches
         self.assertRaises(AssertionError, lambda x: Frame(*x), (wave, wave, ivar, mask, rdata))
         self.assertRaises(AssertionError, lambda x: Frame(*x), (wave, flux[0:2], ivar, mask, rdata))
@@ -163,6 +163,112 @@ class TestIO(unittest.TestCase):
             match = np.all(fibermap[name] == frame.fibermap[name])
             self.assertTrue(match, 'Fibermap column {} mismatch'.format(name))
 
+    def test_write_behind(self):
+        """Test writing files in the background thread."""
+        nspec, nwave, ndiag = 5, 10, 3
+        flux = np.random.uniform(size=(nspec, nwave))
+        ivar = np.random.uniform(size=(nspec, nwave))
+        mask = np.zeros((nspec, nwave), dtype=np.uint32)
+        R = np.random.uniform(size=(nspec, ndiag, nwave))
+        frx = Frame(np.arange(nwave), flux.copy(), ivar, mask, R, meta=dict(FIBERMIN=500))
+        with desispec.io.write_behind():
+            desispec.io.write_frame(self.testfile, frx)
+            #- later changes do not affect the queued file
+            frx.mask[:] = 1
+            frx.flux[:] = 0.
+            desispec.io.flush_writes()
+            frame = desispec.io.read_frame(self.testfile)
+            self.assertTrue(np.all(frame.mask == 0))
+            self.assertTrue(np.all(frame.flux == flux.astype('f4')))
+
+            #- errors are reported when flushing
+            testdir = os.path.dirname(os.path.abspath(self.testfile))
+            desispec.io.write_frame(testdir, frx)
+            with self.assertRaises(IOError):
+                desispec.io.flush_writes()
+            os.remove(testdir+'.tmp')
+
+    def test_frame_read_subset(self):
+        """Test reading a subset of the spectra and HDUs of a frame"""
+        nspec, nwave, ndiag = 6, 10, 3
+        flux = np.random.uniform(size=(nspec, nwave))
+        ivar = np.random.uniform(size=(nspec, nwave))
+        mask = np.random.randint(0, 2, size=(nspec, nwave)).astype(np.uint32)
+        chi2pix = np.random.uniform(size=(nspec, nwave))
+        wave = np.arange(nwave)
+        R = np.random.uniform( size=(nspec, ndiag, nwave) )
+        meta = dict(FIBERMIN=500)
+        frx = Frame(wave, flux, ivar, mask, R, meta=meta, chi2pix=chi2pix)
+        desispec.io.write_frame(self.testfile, frx)
+
+        frame = desispec.io.read_frame(self.testfile)
+        fibers = [4, 1]
+        subset = desispec.io.read_frame(self.testfile, fibers=fibers)
+        self.assertTrue(np.all(subset.flux == frame.flux[fibers]))
+        self.assertTrue(np.all(subset.ivar == frame.ivar[fibers]))
+        self.assertTrue(np.all(subset.mask == frame.mask[fibers]))
+        self.assertTrue(np.all(subset.chi2pix == frame.chi2pix[fibers]))
+        self.assertTrue(np.all(subset.resolution_data == frame.resolution_data[fibers]))
+        self.assertTrue(np.all(subset.fibers == [504, 501]))
+
+        #- nspec reads the first spectra
+        subset = desispec.io.read_frame(self.testfile, nspec=2)
+        self.assertTrue(np.all(subset.flux == frame.flux[0:2]))
+        self.assertTrue(np.all(subset.fibers == [500, 501]))
+        with self.assertRaises(ValueError):
+            desispec.io.read_frame(self.testfile, nspec=2, fibers=fibers)
+
+        #- skip large HDUs and keep float32
+        subset = desispec.io.read_frame(self.testfile, fibers=fibers,
+            skip_hdus=['RESOLUTION', 'CHI2PIX'], keep_float32=True)
+        self.assertEqual(subset.resolution_data, None)
+        self.assertEqual(subset.chi2pix, None)
+        self.assertEqual(subset.flux.dtype, np.float32)
+        self.assertTrue(subset.flux.dtype.isnative)
+        self.assertTrue(np.all(subset.flux == frame.flux[fibers]))
+        with self.assertRaises(ValueError):
+            desispec.io.read_frame(self.testfile, skip_hdus=['FLUX'])
+
+    def test_resolution_encoding(self):
+        """Test frames and bricks with encoded resolution data"""
+        from desispec.io.brick import Brick
+        nspec, nwave, ndiag = 20, 200, 11
+        sigma = 1.0 + 0.5*np.linspace(0, 1, nwave)[None, :] + np.random.uniform(0, 0.1, size=(nspec, 1))
+        offsets = np.arange(ndiag) - ndiag//2
+        R = np.exp(-0.5*(offsets[None, :, None]/sigma[:, None, :])**2)
+        R /= np.sum(R, axis=1)[:, None, :]
+        frx = Frame(np.arange(nwave), np.ones((nspec, nwave)), np.ones((nspec, nwave)),
+            None, R, meta=dict(FIBERMIN=500))
+        desispec.io.write_frame(self.testfile, frx)
+        size = os.path.getsize(self.testfile)
+        max_error = 1e-5
+        desispec.io.write_frame(self.testfile, frx, resolution_max_error=max_error)
+        self.assertLess(os.path.getsize(self.testfile), size)
+        frame = desispec.io.read_frame(self.testfile)
+        self.assertLessEqual(np.max(np.abs(frame.resolution_data - R)), max_error*(1+1e-6))
+        fibers = [7, 3]
+        subset = desispec.io.read_frame(self.testfile, fibers=fibers, keep_float32=True)
+        self.assertEqual(subset.resolution_data.dtype, np.float32)
+        self.assertTrue(np.allclose(subset.resolution_data, frame.resolution_data[fibers], rtol=0, atol=1e-7))
+
+        #- bricks decode encoded HDUs, whether appended or rewritten
+        fibermap = desispec.io.empty_fibermap(nspec)
+        fibermap['TARGETID'] = np.arange(nspec)
+        header = dict(BRICKNAM='0002p000', CHANNEL='b')
+        os.remove(self.testfile)
+        for expid in range(2):
+            brick = Brick(self.testfile, mode='update', header=header, resolution_max_error=max_error)
+            brick.add_objects(frx.flux, frx.ivar, frx.wave, R, fibermap, '20101020', expid)
+            brick.close()
+        self.assertEqual(fits.getheader(self.testfile, ('RESOLUTION', 2))['RESENC'], 'QREF')
+        for compact in (False, True):
+            bx = Brick(self.testfile, mode='update', resolution_max_error=max_error)
+            resolution = bx.hdu_list[3].data
+            self.assertEqual(resolution.shape, (2*nspec, ndiag, nwave))
+            self.assertLessEqual(np.max(np.abs(resolution - np.concatenate([R, R]))), max_error*(1+1e-6))
+            bx.close(compact=compact)
+        self.assertEqual(len(fits.open(self.testfile)), 5)
+
     def test_sky_rw(self):
         nspec, nwave = 5,10
         wave = np.arange(nwave)
@@ -318,9 +424,130 @@ class TestIO(unittest.TestCase):
         self.assertEqual(len(info2), 2)
         self.assertTrue( np.all(flux2[0] == flux[0]) )
         self.assertTrue( np.all(ivar2[0] == ivar[0]) )
+
+        #- unknown targets have no spectra
+        flux2, ivar2, resolution2, info2 = bx.get_target(1)
+        self.assertEqual(flux2.shape, (0,10))
+        self.assertEqual(len(info2), 0)
+
+        #- iterate over all targets in one pass
+        target_ids = list()
+        for target_id, flux2, ivar2, resolution2, info2 in bx.iter_targets():
+            target_ids.append(target_id)
+            self.assertTrue(np.all(info2['TARGETID'] == target_id))
+            self.assertTrue(np.all(info2['EXPID'] == [expid, expid+1]))
+            i = target_id // 3
+            self.assertTrue(np.all(flux2 == flux[i]))
+            self.assertTrue(np.all(resolution2 == resolution[i]))
+        self.assertEqual(target_ids, list(bx.get_target_ids()))
+        self.assertEqual(target_ids, list(fibermap['TARGETID']))
         
         bx.close()
 
+        #- Objects added to an existing brick are appended as new HDUs
+        for i in range(2):
+            bx = Brick(self.testfile, mode='update')
+            bx.add_objects(2*flux, ivar, wave, resolution, fibermap, night, expid+2+i)
+            bx.close()
+        fx = fits.open(self.testfile)
+        self.assertEqual(len(fx), 5+2*4)
+        self.assertEqual(fx['FLUX', 3].data.shape, (nspec, nwave))
+        fx.close()
+
+        bx = Brick(self.testfile)
+        self.assertEqual(bx.get_num_spectra(), 4*nspec)
+        self.assertEqual(bx.get_num_targets(), nspec)
+        self.assertTrue(np.all(bx.hdu_list['FIBERMAP'].data['EXPID'] == np.repeat(expid+np.arange(4), nspec)))
+        #- INDEX is the row of each object in the brick
+        self.assertTrue(np.all(bx.hdu_list['FIBERMAP'].data['INDEX'] == np.arange(4*nspec)))
+        flux2, ivar2, resolution2, info2 = bx.get_target(3)
+        self.assertEqual(flux2.shape, (4,10))
+        self.assertTrue( np.all(flux2[2:] == 2*flux[1]) )
+        self.assertTrue( np.all(resolution2[3] == resolution[1]) )
+        bx.close()
+
+        #- compact rewrites the brick with five HDUs
+        bx = Brick(self.testfile, mode='update')
+        bx.add_objects(flux, ivar, wave, resolution, fibermap, night, expid+4)
+        bx.close(compact=True)
+        fx = fits.open(self.testfile)
+        self.assertEqual(len(fx), 5)
+        self.assertEqual(fx['FLUX'].data.shape, (5*nspec, nwave))
+        self.assertEqual(len(fx['FIBERMAP'].data), 5*nspec)
+        fx.close()
+
+    def test_storage_backends(self):
+        """Test that the FITS and npydir backends give the same frames and bricks"""
+        from desispec.io.brick import Brick
+        from desispec.io.storage import NpyDirBackend, NpyDirFile
+        testdir = os.path.join(self.testDir, 'storage')
+        nspec, nwave, ndiag = 7, 25, 5
+        flux = np.random.uniform(size=(nspec, nwave))
+        ivar = np.random.uniform(size=(nspec, nwave))
+        mask = np.random.randint(0, 4, size=(nspec, nwave)).astype(np.uint32)
+        chi2pix = np.random.uniform(size=(nspec, nwave))
+        wave = np.arange(nwave)
+        R = np.random.uniform(size=(nspec, ndiag, nwave))
+        fibermap = desispec.io.empty_fibermap(nspec)
+        fibermap['OBJTYPE'][::2] = 'SKY'
+        frx = Frame(wave, flux, ivar, mask, R, fibermap=fibermap, meta=dict(BLAT=1),
+            chi2pix=chi2pix)
+        fitsfile = os.path.join(testdir, 'frame.fits')
+        desispec.io.write_frame(fitsfile, frx)
+        for backend in ('npydir', NpyDirBackend(chunks=(3, 10), compress=True)):
+            npydir = os.path.join(testdir, 'frame-npydir')
+            desispec.io.write_frame(npydir, frx, backend=backend)
+            self.assertTrue(os.path.isdir(npydir))
+            for fibers in (None, [5, 0, 3]):
+                frame1 = desispec.io.read_frame(fitsfile, fibers=fibers)
+                frame2 = desispec.io.read_frame(npydir, fibers=fibers)
+                for key in ('wave', 'flux', 'ivar', 'mask', 'resolution_data', 'chi2pix', 'fibers'):
+                    self.assertTrue(np.all(getattr(frame1, key) == getattr(frame2, key)), key)
+                    self.assertEqual(getattr(frame1, key).dtype.newbyteorder('='),
+                        getattr(frame2, key).dtype.newbyteorder('='))
+                for key in fibermap.colnames:
+                    self.assertTrue(np.all(frame1.fibermap[key] == frame2.fibermap[key]), key)
+                self.assertEqual(frame2.meta['BLAT'], 1)
+                rows = slice(None) if fibers is None else fibers
+                self.assertTrue(np.all(frame2.fibermap['OBJTYPE'] == fibermap['OBJTYPE'][rows]))
+
+        #- chunk-aligned rows can be written separately
+        npydir = NpyDirFile(npydir)
+        npydir.create_image('MODEL', (nspec, nwave), 'f8', chunks=(3, 10))
+        npydir.write_rows('MODEL', 3, flux[3:6])
+        npydir.write_rows('MODEL', 0, flux[0:3])
+        npydir.write_rows('MODEL', 6, flux[6:])
+        with self.assertRaises(ValueError):
+            npydir.write_rows('MODEL', 1, flux[1:3])
+        self.assertTrue(np.all(NpyDirFile(npydir.path)['MODEL'].data == flux))
+
+        #- objects added to an npydir brick are appended as new chunks
+        header = dict(BRICKNAM='0002p000', CHANNEL='b')
+        fibermap['TARGETID'] = 3*np.arange(nspec)
+        paths = [os.path.join(testdir, 'brick.fits'), os.path.join(testdir, 'brick-npydir')]
+        for path, backend in zip(paths, ('fits', 'npydir')):
+            for i in range(3):
+                bx = Brick(path, mode='update', header=header, backend=backend)
+                bx.add_objects((i+1)*flux, ivar, wave, R, fibermap, '20101020', 2+i)
+                bx.close()
+        self.assertEqual(len(NpyDirFile(paths[1])), 5)
+        self.assertEqual(len(NpyDirFile(paths[1])['FLUX'].info['row_starts']), 3)
+        bx1, bx2 = Brick(paths[0]), Brick(paths[1])
+        self.assertEqual(bx2.get_num_spectra(), 3*nspec)
+        self.assertTrue(np.all(bx2.hdu_list['FIBERMAP'].data['INDEX'] == np.arange(3*nspec)))
+        #- npydir bricks only read the rows of the targets looked up
+        flux2 = bx2.get_target(3)[0]
+        self.assertTrue(np.all(flux2 == flux[1]*np.arange(1, 4)[:, None]))
+        self.assertTrue(bx2.hdu_list['FLUX']._data is None)
+        for i in range(5):
+            self.assertTrue(np.all(bx1.hdu_list[i].data == bx2.hdu_list[i].data))
+        self.assertTrue(np.all(bx1.get_target(3)[0] == bx2.get_target(3)[0]))
+        self.assertEqual(bx2.brickname, '0002p000')
+        bx1.close()
+        bx2.close()
+        with self.assertRaises(ValueError):
+            Brick(paths[1], mode='update', resolution_max_error=1e-3)
+
     def test_zbest_io(self):
         from desispec.zfind import ZfindBase
         nspec, nflux = 10, 20
@@ -490,6 +717,62 @@ class TestIO(unittest.TestCase):
         x = desispec.io.findfile('fibermap', night='20150101', expid=123, outdir=outdir)
         self.assertEqual(x, os.path.join(outdir, os.path.basename(x)))
 
+    def test_file_index(self):
+        """Test that the file index gives the same files as globbing"""
+        from desispec.io.fileindex import FileIndex, parse_filename
+        #- all findfile types are identified from their path
+        fields = dict(night='20150510', expid=2, camera='r3', spectrograph=3,
+            brickname='0002p000', band='r')
+        for filetype in ('pix', 'fibermap', 'frame', 'stdstars', 'qa_data_exp',
+                         'psf', 'qa_ztruth', 'brick', 'coadd', 'coadd_all'):
+            path = desispec.io.findfile(filetype, rawdata_dir='.', specprod_dir='.', **fields)
+            found, values = parse_filename(os.path.relpath(path, '.'))
+            self.assertEqual(found, filetype)
+            for key in values:
+                if values[key] is not None:
+                    self.assertEqual(values[key], fields[key])
+
+        specprod_dir = os.path.join(self.testDir, 'index')
+        night = '20150510'
+        for expid in (2, 3):
+            for camera in ('b0', 'r0', 'z1'):
+                path = desispec.io.findfile('frame', night, expid, camera, specprod_dir=specprod_dir)
+                desispec.io.util.makepath(path)
+                open(path, 'w').close()
+        os.makedirs(os.path.join(specprod_dir, 'exposures', night, 'notanexposure'))
+        globbed = desispec.io.get_files('frame', night, 2, specprod_dir=specprod_dir)
+        exposures = desispec.io.get_exposures(night, specprod_dir=specprod_dir)
+        self.assertEqual(exposures, [2, 3])
+
+        index = FileIndex(specprod_dir, create=True)
+        self.assertGreater(index.update(), 0)
+        self.assertEqual(index.update(), 0)
+        self.assertEqual(len(index.query('frame', night=night)), 6)
+        self.assertEqual(desispec.io.get_files('frame', night, 2, specprod_dir=specprod_dir), globbed)
+        self.assertEqual(desispec.io.get_exposures(night, specprod_dir=specprod_dir), exposures)
+        with self.assertRaises(RuntimeError):
+            desispec.io.get_exposures('20150511', specprod_dir=specprod_dir)
+
+        #- writers add their files to the index
+        R = np.zeros((2, 3, 10))
+        R[:, 1] = 1.0
+        frame = Frame(np.arange(10.), np.ones((2, 10)), np.ones((2, 10)), None, R, spectrograph=1)
+        path = desispec.io.findfile('frame', night, 2, 'b1', specprod_dir=specprod_dir)
+        desispec.io.write_frame(path, frame)
+        rows = index.query('frame', night=night, expid=2, camera='b1')
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['size'], os.path.getsize(path))
+
+        #- files added or removed without the writers are found by rescans
+        os.remove(desispec.io.findfile('frame', night, 2, 'r0', specprod_dir=specprod_dir))
+        files = desispec.io.get_files('frame', night, 2, specprod_dir=specprod_dir)
+        self.assertEqual(sorted(files.keys()), ['b0', 'b1', 'z1'])
+        rmtree(os.path.join(specprod_dir, 'exposures', night, '00000003'))
+        self.assertEqual(desispec.io.get_exposures(night, specprod_dir=specprod_dir), [2])
+        index.update()
+        self.assertEqual(len(index.query('frame', expid=3)), 0)
+        index.close()
+
     @unittest.skipUnless(os.path.exists(os.path.join(os.environ['HOME'],'.netrc')),"No ~/.netrc file detected.")
     def test_download(self):
         #
@@ -9,6 +9,11 @@ import numpy.random
 from desispec.linalg import cholesky_solve
 from desispec.linalg import cholesky_solve_and_invert
 from desispec.linalg import cholesky_invert
+from desispec.linalg import cholesky_solve_banded
+from desispec.linalg import cholesky_invert_banded
+from desispec.linalg import banded_sandwich_diagonal
+from desispec.linalg import spline_fit, SplineFitter
+from desispec.resolution import Resolution
 
 class TestLinalg(unittest.TestCase):
     
@@ -83,6 +88,91 @@ class TestLinalg(unittest.TestCase):
         
         
                 
+    def test_cholesky_solve_banded(self):
+        # create a random positive definite band matrix A
+        n = 30
+        u = 3
+        A = np.zeros((n,n))
+        for i in range(n) :
+            H = np.zeros(n)
+            H[i:i+u+1] = numpy.random.random(min(u+1,n-i))
+            A += np.outer(H,H.T)
+        A += np.eye(n)
+        # upper banded storage
+        Ab = np.zeros((u+1,n))
+        for j in range(n) :
+            for i in range(max(0,j-u),j+1) :
+                Ab[u+i-j,j] = A[i,j]
+        X = numpy.random.random(n)
+        B = A.dot(X)
+        Xs=cholesky_solve_banded(Ab,B)
+        delta=Xs-X
+        d=np.inner(delta,delta)
+        self.assertAlmostEqual(d,0.)
+        # several right hand sides at once
+        Ai=cholesky_solve_banded(Ab,np.eye(n))
+        self.assertTrue(np.allclose(A.dot(Ai),np.eye(n)))
+
+    def test_cholesky_invert_banded(self):
+        # create a random positive definite band matrix A
+        n = 40
+        u = 4
+        A = np.zeros((n,n))
+        for i in range(n) :
+            H = np.zeros(n)
+            H[i:i+u+1] = numpy.random.random(min(u+1,n-i))
+            A += np.outer(H,H.T)
+        A += np.eye(n)
+        Ab = np.zeros((u+1,n))
+        Al = np.zeros((u+1,n))
+        for j in range(n) :
+            for i in range(max(0,j-u),j+1) :
+                Ab[u+i-j,j] = A[i,j]
+                Al[j-i,i] = A[j,i]
+        Ai = np.linalg.inv(A)
+        Cb = cholesky_invert_banded(Ab)
+        Cl = cholesky_invert_banded(Al,lower=True)
+        for d in range(u+1) :
+            self.assertTrue(np.allclose(Cb[u-d,d:],np.diag(Ai,d)))
+            self.assertTrue(np.allclose(Cl[d,:n-d],np.diag(Ai,-d)))
+        self.assertTrue(np.allclose(cholesky_invert_banded(Ab,diagonal=True),np.diag(Ai)))
+        # diagonal of R.Ai.R^T for a resolution no wider than the band
+        R = Resolution(numpy.random.random((u+1,n)))
+        RAiRt = R.dot(Ai).dot(R.T.toarray())
+        self.assertTrue(np.allclose(banded_sandwich_diagonal(R,Cb),np.diag(RAiRt)))
+        self.assertTrue(np.allclose(banded_sandwich_diagonal(R,Cl,lower=True),np.diag(RAiRt)))
+        # the band is too narrow for a wider resolution
+        with self.assertRaises(ValueError) :
+            banded_sandwich_diagonal(Resolution(numpy.random.random((u+3,n))),Cb)
+
+    def test_spline_fitter(self):
+        # fits of several rows agree with spline_fit
+        x = np.linspace(5000.,6000.,400)
+        nrow = 6
+        y = np.sin(x/40.)[None,:]*numpy.random.uniform(0.5,2.,(nrow,1))+numpy.random.normal(0.,0.1,(nrow,x.size))
+        w = numpy.random.uniform(1.,10.,(nrow,x.size))
+        w[1,:20] = 0
+        w[2,-7:] = 0
+        w[3,200:220] = 0
+        w[4] = 0
+        valid = np.ones(w.shape,dtype=bool)
+        valid[5,:10] = False
+        fitter = SplineFitter(x,100.)
+        for v in (None,valid) :
+            result = fitter.fit(y,w,valid=v)
+            for i in range(nrow) :
+                ok = (w[i]>0) if v is None else v[i]
+                if i == 4 :
+                    self.assertTrue(np.all(result[i] == 0))
+                else :
+                    self.assertTrue(np.allclose(result[i],spline_fit(x,x[ok],y[i,ok],100.,w[i,ok])))
+        # refit after rejecting a few pixels, including the last one
+        w1 = w[1].copy()
+        for bad in ([50,60,70],[-1]) :
+            w1[bad] = 0
+            ok = (w1>0)
+            self.assertTrue(np.allclose(fitter.refit(1,y[1],w1),spline_fit(x,x[ok],y[1,ok],100.,w1[ok])))
+
     def runTest(self):
         pass
                 
@@ -0,0 +1,126 @@
+import unittest, os
+from uuid import uuid1
+from shutil import rmtree
+import numpy as np
+from astropy.table import Table
+
+from desispec.frame import Frame
+import desispec.io
+import desispec.scripts.makebricks as makebricks
+
+class TestMakeBricks(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.testDir = os.path.join(os.environ['HOME'], 'desi_test_makebricks-{}'.format(uuid1()))
+        cls.origEnv = os.environ.get('DESI_SPECTRO_DATA')
+        os.environ['DESI_SPECTRO_DATA'] = os.path.join(cls.testDir, 'data')
+        cls.night = '20150211'
+        cls.nwave = 20
+        cls.wave = np.arange(cls.nwave, dtype=float)
+        cls.expids = [1, 2]
+        for expid in cls.expids:
+            fibermap = desispec.io.empty_fibermap(20)
+            fibermap['FIBER'] = np.concatenate([np.arange(10), 500+np.arange(10)])
+            fibermap['SPECTROID'] = fibermap['FIBER'] // 500
+            fibermap['TARGETID'] = 100*expid + np.arange(20) % 12
+            fibermap['BRICKNAME'] = np.where(np.arange(20) % 3 == 0, '0002p000', '0002p005')
+            desispec.io.write_fibermap(desispec.io.findfile('fibermap', cls.night, expid), fibermap)
+            for camera in ['b0', 'b1', 'r0']:
+                spectrograph = int(camera[1])
+                flux = np.zeros((10, cls.nwave))
+                flux[:] = expid*1000 + 500*spectrograph + np.arange(10)[:, None]
+                ivar = np.ones((10, cls.nwave))
+                R = np.zeros((10, 3, cls.nwave))
+                R[:, 1] = 1.0
+                frame = Frame(cls.wave, flux, ivar, None, R, spectrograph=spectrograph)
+                for specprod in ['serial', 'parallel']:
+                    path = desispec.io.findfile('cframe', cls.night, expid, camera,
+                        specprod_dir=os.path.join(cls.testDir, specprod))
+                    desispec.io.write_frame(path, frame)
+
+    @classmethod
+    def tearDownClass(cls):
+        if os.path.exists(cls.testDir):
+            rmtree(cls.testDir)
+        if cls.origEnv is None:
+            del os.environ['DESI_SPECTRO_DATA']
+        else:
+            os.environ['DESI_SPECTRO_DATA'] = cls.origEnv
+
+    def test_group_fibers(self):
+        """Test grouping fibers by spectrograph and brick"""
+        fibermap = Table()
+        fibermap['SPECTROID'] = [1, 0, 1, 0, 0, 1]
+        fibermap['BRICKNAME'] = ['b', 'a', 'a', 'b', 'a', 'b']
+        groups = makebricks.group_fibers(fibermap)
+        self.assertEqual(sorted(groups.keys()), [0, 1])
+        self.assertEqual([name for name, rows in groups[0]], ['a', 'b'])
+        self.assertTrue(np.all(groups[0][0][1] == [1, 4]))
+        self.assertTrue(np.all(groups[0][1][1] == [3]))
+        self.assertTrue(np.all(groups[1][0][1] == [2]))
+        self.assertTrue(np.all(groups[1][1][1] == [0, 5]))
+
+    def test_brick_writer_flush(self):
+        """Test that an overflowing BrickWriter only appends its largest bricks"""
+        specprod_dir = os.path.join(self.testDir, 'writer')
+        writer = makebricks.BrickWriter(specprod_dir, max_buffered=10)
+        def brick_slice(brick_name, nspec, expid):
+            flux = np.ones((nspec, self.nwave))
+            R = np.zeros((nspec, 3, self.nwave))
+            R[:, 1] = 1.0
+            return (brick_name, 'b', flux, flux.copy(), self.wave, R,
+                desispec.io.empty_fibermap(nspec), self.night, expid)
+        for expid in range(3):
+            writer.add(brick_slice('0002p000', 4, expid))
+            writer.add(brick_slice('0002p005', 1, expid))
+        #- only the largest brick was appended when 14 > 10 spectra were buffered
+        self.assertEqual(list(writer.bricks.keys()), ['b_0002p005'])
+        self.assertEqual(writer.num_buffered, 3)
+        writer.close()
+        self.assertEqual(writer.bricks, { })
+        for brickname, nspec in [('0002p000', 12), ('0002p005', 3)]:
+            path = desispec.io.findfile('brick', brickname=brickname, band='b',
+                specprod_dir=specprod_dir)
+            brick = desispec.io.Brick(path)
+            self.assertEqual(brick.get_num_spectra(), nspec)
+            brick.close()
+
+    def _read_bricks(self, specprod):
+        bricks = { }
+        for band in 'br':
+            for brickname in ['0002p000', '0002p005']:
+                path = desispec.io.findfile('brick', brickname=brickname, band=band,
+                    specprod_dir=specprod)
+                brick = desispec.io.Brick(path)
+                info = brick.hdu_list['FIBERMAP'].data
+                order = np.lexsort((info['FIBER'], info['EXPID']))
+                bricks[band, brickname] = (brick.hdu_list[0].data[order],
+                    info['EXPID'][order], info['FIBER'][order])
+                brick.close()
+        return bricks
+
+    def test_makebricks(self):
+        """Test serial and parallel brick making give the same bricks"""
+        results = { }
+        for specprod, nproc in [('serial', 1), ('parallel', 3)]:
+            specprod_dir = os.path.join(self.testDir, specprod)
+            args = makebricks.parse(['--night', self.night, '--specprod', specprod_dir,
+                '--nproc', str(nproc), '--max-buffered', '5'])
+            makebricks.main(args)
+            results[specprod] = self._read_bricks(specprod_dir)
+
+        for key in results['serial']:
+            flux, expid, fiber = results['serial'][key]
+            brickname = key[1]
+            nfibers = 7 if brickname == '0002p000' else 13
+            if key[0] == 'r':
+                #- only spectrograph 0 has an r camera
+                nfibers = 4 if brickname == '0002p000' else 6
+            self.assertEqual(len(flux), 2*nfibers)
+            self.assertTrue(np.all(flux[:, 0] == 1000*expid + fiber))
+            for a, b in zip(results['serial'][key], results['parallel'][key]):
+                self.assertTrue(np.all(a == b))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -127,6 +127,56 @@ class TestPreProc(unittest.TestCase):
         with self.assertRaises(ValueError):
             image = preproc(self.rawimage, self.header, pixflat=pixflat[0:10, 0:10])
 
+    def test_float32_threads(self):
+        bias = np.random.normal(size=self.rawimage.shape)
+        pixflat = np.random.uniform(0.9, 1.1, size=(2*self.ny, 2*self.nx))
+        ref = preproc(self.rawimage, self.header.copy(), bias=bias, pixflat=pixflat)
+        image = preproc(self.rawimage, self.header.copy(), bias=bias, pixflat=pixflat, nthreads=4)
+        for name in ['pix', 'ivar', 'mask', 'readnoise']:
+            self.assertTrue(np.all(getattr(image, name) == getattr(ref, name)))
+        image = preproc(self.rawimage, self.header.copy(), bias=bias, pixflat=pixflat,
+            dtype=np.float32, nthreads=2)
+        self.assertEqual(image.pix.dtype, np.float32)
+        self.assertEqual(image.ivar.dtype, np.float32)
+        self.assertTrue(np.allclose(image.pix, ref.pix, rtol=1e-5, atol=1e-4))
+        self.assertTrue(np.allclose(image.ivar, ref.ivar, rtol=1e-5))
+        self.assertTrue(np.all(image.mask == ref.mask))
+
+    def test_calib_cache(self):
+        import desispec.preproc
+        bias = np.random.normal(size=self.rawimage.shape)
+        fits.writeto(self.calibfile, bias)
+        image = preproc(self.rawimage, self.header, bias=self.calibfile)
+        ref = preproc(self.rawimage, self.header, bias=bias)
+        self.assertTrue(np.all(image.pix == ref.pix))
+
+        #- same read-only array for the next calls
+        a = desispec.preproc.read_bias(filename=self.calibfile)
+        b = desispec.preproc.read_bias(filename=self.calibfile)
+        self.assertTrue(a is b)
+        self.assertFalse(a.flags.writeable)
+        self.assertTrue(np.all(a == bias))
+        mask = desispec.preproc.read_mask(filename=self.calibfile)
+        self.assertFalse(mask is a)
+
+        #- least recently used images are evicted to fit in the budget
+        cache_bytes = desispec.preproc.calib_cache_bytes
+        try:
+            desispec.preproc.calib_cache_bytes = int(1.5*a.nbytes)
+            desispec.preproc.read_bias(filename=self.calibfile)
+            desispec.preproc.read_pixflat(filename=self.calibfile)
+            self.assertEqual(len(desispec.preproc._calib_cache), 1)
+            self.assertTrue(desispec.preproc.read_bias(filename=self.calibfile) is not a)
+            desispec.preproc.calib_cache_bytes = a.nbytes//2
+            c = desispec.preproc.read_mask(filename=self.calibfile)
+            self.assertTrue(np.all(c == bias))
+            #- an image larger than the budget doesn't evict the cached ones
+            self.assertEqual(len(desispec.preproc._calib_cache), 1)
+            self.assertTrue(desispec.preproc.read_mask(filename=self.calibfile) is not c)
+        finally:
+            desispec.preproc.calib_cache_bytes = cache_bytes
+            desispec.preproc._calib_cache.clear()
+
     def test_mask(self):
         image = preproc(self.rawimage, self.header, mask=False)
         mask = np.random.randint(0, 2, size=image.pix.shape)
@@ -163,6 +213,20 @@ class TestPreProc(unittest.TestCase):
         self.assertEqual(b1.meta['CAMERA'], 'b1')
         self.assertEqual(r1.meta['CAMERA'], 'r1')
         self.assertEqual(z9.meta['CAMERA'], 'z9')
+
+        #- all cameras of the file, or selected ones, decompressed by threads
+        #- with fewer threads than cameras, a few cameras are read ahead
+        for nthreads in (1, 2, 3):
+            raw = dict([(camera, (rawimage, header)) for camera, rawimage, header in
+                io.iter_raw(self.rawfile, nthreads=nthreads)])
+            self.assertEqual(sorted(raw.keys()), ['b0', 'b1', 'r1', 'z9'])
+            for camera in raw:
+                self.assertTrue(np.all(raw[camera][0] == self.rawimage))
+                self.assertEqual(raw[camera][1]['CAMERA'], camera)
+        #- cameras are yielded in the requested order
+        cameras = [camera for camera, rawimage, header in
+            io.iter_raw(self.rawfile, cameras=['z9', 'B0', 'b5'])]
+        self.assertEqual(cameras, ['z9', 'b0'])
         
     def test_32_64(self):
         '''
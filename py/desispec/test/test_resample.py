@@ -6,7 +6,7 @@ import unittest, os
 import numpy as np
 from math import log
 
-from desispec.interpolation import resample_flux, bin_bounds
+from desispec.interpolation import resample_flux, bin_bounds, get_resample_matrix
 
 class TestResample(unittest.TestCase):
     """
@@ -79,6 +79,23 @@ class TestResample(unittest.TestCase):
             ivar_out = np.sum(ivout)
             self.assertAlmostEqual(ivar_in,ivar_out)
 
+    def test_resample_2d(self):
+        """Resampling 2D flux at once agrees with resampling each spectrum"""
+        x = np.sort(np.random.uniform(0, 100, 200))
+        xout = np.linspace(-5, 90, 70)
+        flux = np.random.normal(size=(4, x.size))
+        ivar = np.random.uniform(0.5, 2, size=flux.shape)
+        ivar[:, 10:15] = 0
+        fout, ivout = resample_flux(xout, x, flux, ivar)
+        self.assertEqual(fout.shape, (4, xout.size))
+        for i in range(4):
+            f1, iv1 = resample_flux(xout, x, flux[i], ivar[i])
+            self.assertTrue(np.allclose(fout[i], f1))
+            self.assertTrue(np.allclose(ivout[i], iv1))
+            self.assertTrue(np.allclose(resample_flux(xout, x, flux)[i], resample_flux(xout, x, flux[i])))
+        #- the operator is cached
+        self.assertTrue(get_resample_matrix(xout, x) is get_resample_matrix(xout.copy(), x.copy()))
+
     def test_bin_bounds(self):
         """Super basic test of bin boundaries"""
         x = np.arange(10)
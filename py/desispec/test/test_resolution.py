@@ -6,7 +6,7 @@ import unittest
 import numpy as np
 import scipy.sparse
 
-from desispec.resolution import Resolution
+from desispec.resolution import Resolution, ResolutionStack
 import desispec.resolution
 
 class TestResolution(unittest.TestCase):
@@ -112,6 +112,49 @@ class TestResolution(unittest.TestCase):
                 self.assertTrue(np.all(Rdense.diagonal(-i) == 0.0), \
                     "diagonal {} not 0s".format(-i))
 
+    def test_resolution_stack(self):
+        nspec, ndiag, nwave = 4, 7, 30
+        data = np.random.uniform(size=(nspec, ndiag, nwave))
+        RS = ResolutionStack(data)
+        self.assertEqual(len(RS), nspec)
+        self.assertTrue(isinstance(RS[1], Resolution))
+        self.assertTrue(np.all(RS[1].toarray() == Resolution(data[1]).toarray()))
+        self.assertEqual(len(RS[1:3]), 2)
+        self.assertEqual(len(RS[[0,2,3]]), 3)
+        self.assertEqual(len(list(RS)), nspec)
+
+        #- same vector for all spectra
+        x = np.random.uniform(size=nwave)
+        y = RS.dot(x)
+        z = RS.tdot(x)
+        self.assertEqual(y.shape, (nspec, nwave))
+        for i in range(nspec):
+            R = Resolution(data[i])
+            self.assertTrue(np.allclose(y[i], R.dot(x)))
+            self.assertTrue(np.allclose(z[i], R.T.dot(x)))
+
+        #- one vector per spectrum
+        x = np.random.uniform(size=(nspec, nwave))
+        y = RS.dot(x)
+        z = RS.tdot(x)
+        for i in range(nspec):
+            R = Resolution(data[i])
+            self.assertTrue(np.allclose(y[i], R.dot(x[i])))
+            self.assertTrue(np.allclose(z[i], R.T.dot(x[i])))
+
+        #- sub-stacks
+        sub = RS[[3,1]]
+        self.assertTrue(np.allclose(sub.dot(x[[3,1]]), y[[3,1]]))
+
+        with self.assertRaises(ValueError):
+            RS.dot(np.ones(nwave+1))
+        with self.assertRaises(ValueError):
+            RS.dot(np.ones((nspec+1, nwave)))
+        with self.assertRaises(ValueError):
+            ResolutionStack(data[0])
+        with self.assertRaises(ValueError):
+            ResolutionStack(data[:, 1:, :])
+
     def test_errors(self):
         #- Bad shaped input
         data = np.random.uniform(size=(10,5))
@@ -3,6 +3,9 @@ tests desispec.sky
 """
 
 import unittest
+import os
+import shutil
+import tempfile
 
 import numpy as np
 from desispec.sky import compute_sky, subtract_sky
@@ -75,6 +78,68 @@ class TestSky(unittest.TestCase):
         #- allow some slop in the sky subtraction
         self.assertTrue(np.allclose(spectra.flux, 0, rtol=1e-5, atol=1e-6))
 
+    def test_compact_sky(self):
+        from desispec.io.sky import write_sky, read_sky
+        spectra = self._get_spectra()
+        sky = compute_sky(spectra)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fullfile = os.path.join(tmpdir, 'sky-full.fits')
+            compactfile = os.path.join(tmpdir, 'sky-compact.fits')
+            write_sky(fullfile, sky)
+            write_sky(compactfile, sky, compact=True)
+            full = read_sky(fullfile)
+            compact = read_sky(compactfile)
+            self.assertEqual(compact.nspec, self.nspec)
+            self.assertEqual(compact.nrej, sky.nrej)
+            self.assertEqual(compact.ivar.shape, full.ivar.shape)
+            with self.assertRaises(AttributeError):
+                compact.flux
+
+            frame1 = self._get_spectra()
+            frame2 = self._get_spectra()
+            subtract_sky(frame1, full)
+            subtract_sky(frame2, compact)
+            self.assertTrue(np.allclose(frame1.flux, frame2.flux, atol=1e-4))
+            self.assertTrue(np.allclose(frame1.ivar, frame2.ivar))
+            self.assertTrue(np.all(frame1.mask == frame2.mask))
+
+            compact.resolution_data = frame1.resolution_data
+            self.assertTrue(np.allclose(compact.flux, full.flux, atol=1e-4))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_stdstars_compact_sky(self):
+        """Test the flat division and sky subtraction of desi_fit_stdstars with a compact sky"""
+        from desispec.io.sky import write_sky, read_sky
+        from desispec.fiberflat import FiberFlat
+        from desispec.scripts.stdstars import apply_flats_and_skies
+        spectra = self._get_spectra()
+        sky = compute_sky(spectra)
+        #- a different flat for each fiber, and stars which are not the first fibers
+        flat = 1 + 0.1*np.arange(self.nspec)[:, None]*np.ones((1, self.nwave))
+        fiberflat = FiberFlat(self.wave, flat, np.ones(flat.shape), spectrograph=2)
+        starindices = np.array([1, 5, 7])
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fullfile = os.path.join(tmpdir, 'sky-full.fits')
+            compactfile = os.path.join(tmpdir, 'sky-compact.fits')
+            write_sky(fullfile, sky)
+            write_sky(compactfile, sky, compact=True)
+            results = list()
+            for skyfile in [fullfile, compactfile]:
+                frame = self._get_spectra()[starindices]
+                frame.flux *= flat[starindices]
+                frames = dict(b2=frame, r2=self._get_spectra()[starindices])
+                apply_flats_and_skies(frames, dict(b2=fiberflat), dict(b2=read_sky(skyfile)), starindices)
+                #- the frame of the camera without flat is dropped
+                self.assertEqual(list(frames.keys()), ['b2'])
+                results.append(frames['b2'].flux)
+            self.assertTrue(np.allclose(results[0], results[1], atol=1e-4))
+            self.assertTrue(np.allclose(results[1], 0, atol=1e-4))
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_main(self):
         pass
         
@@ -0,0 +1,135 @@
+import unittest, os
+import threading
+from uuid import uuid1
+from shutil import rmtree
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+import numpy as np
+
+import desispec.io
+import desispec.coaddition
+import desispec.resolution
+import desispec.scripts.updatecoadd as updatecoadd
+
+class _ThreadComm(object):
+    """Minimal stand-in for an MPI communicator whose ranks are threads."""
+
+    def __init__(self, rank, size, queues, values, barrier):
+        self.rank = rank
+        self.size = size
+        self._queues = queues
+        self._values = values
+        self._barrier = barrier
+
+    def send(self, obj, dest, tag=0):
+        self._queues[dest].put(obj)
+
+    def recv(self, buf=None, source=-1, tag=-1):
+        return self._queues[self.rank].get()
+
+    def iprobe(self, source=-1, tag=-1):
+        return not self._queues[self.rank].empty()
+
+    def allreduce(self, value):
+        self._values[self.rank] = value
+        self._barrier.wait()
+        total = sum(self._values)
+        self._barrier.wait()
+        return total
+
+class TestUpdateCoadd(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.testDir = os.path.join(os.environ['HOME'], 'desi_test_updatecoadd-{}'.format(uuid1()))
+        cls.brickname = '0002p000'
+        cls.specprods = ['serial', 'pool', 'mpi']
+        cls.origGrid = desispec.coaddition.global_wavelength_grid
+        ndiag = desispec.resolution.default_ndiag
+        for band, wmin in [('b', 5000.), ('r', 5040.)]:
+            nwave = 60
+            wave = wmin + np.arange(nwave)
+            #- target 3 is only observed in the b band
+            ntarget = 4 if band == 'b' else 3
+            for specprod in cls.specprods:
+                path = desispec.io.findfile('brick', brickname=cls.brickname, band=band,
+                    specprod_dir=os.path.join(cls.testDir, specprod))
+                brick = desispec.io.Brick(path, mode='update',
+                    header=dict(BRICKNAM=cls.brickname, CHANNEL=band))
+                for expid in [1, 2]:
+                    np.random.seed(10*expid + ntarget)
+                    flux = np.random.uniform(1, 2, size=(ntarget, nwave))
+                    ivar = np.random.uniform(50, 100, size=(ntarget, nwave))
+                    R = np.zeros((ntarget, ndiag, nwave))
+                    R[:, ndiag//2-1] = 0.25
+                    R[:, ndiag//2] = 0.5
+                    R[:, ndiag//2+1] = 0.25
+                    fibermap = desispec.io.empty_fibermap(ntarget)
+                    fibermap['TARGETID'] = 100 + np.arange(ntarget)
+                    brick.add_objects(flux, ivar, wave, R, fibermap, '20150211', expid)
+                brick.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        if os.path.exists(cls.testDir):
+            rmtree(cls.testDir)
+
+    def setUp(self):
+        #- a small global grid keeps the global coadds cheap
+        desispec.coaddition.global_wavelength_grid = np.arange(4990., 5110., 1.)
+
+    def tearDown(self):
+        desispec.coaddition.global_wavelength_grid = self.origGrid
+
+    def _args(self, specprod, nproc=1):
+        return updatecoadd.parse(['--brick', self.brickname, '--bands', 'br', '--banded',
+            '--block-size', '50', '--halo', '20', '--nproc', str(nproc),
+            '--specprod', os.path.join(self.testDir, specprod)])
+
+    def _read_coadds(self, specprod):
+        coadds = { }
+        for band in ['b', 'r', None]:
+            filetype = 'coadd_all' if band is None else 'coadd'
+            path = desispec.io.findfile(filetype, brickname=self.brickname, band=band,
+                specprod_dir=os.path.join(self.testDir, specprod))
+            coadd = desispec.io.brick.CoAddedBrick(path)
+            coadds[band] = [np.copy(coadd.hdu_list[i].data) for i in (0, 1, 3)]
+            coadds[band].append(np.copy(coadd.hdu_list[4].data['INDEX']))
+            coadd.close()
+        return coadds
+
+    def test_update_coadds(self):
+        """Test serial, pool and MPI coadds of a brick are the same"""
+        self.assertEqual(updatecoadd.main(self._args('serial')), 0)
+        self.assertEqual(updatecoadd.main(self._args('pool', nproc=2)), 0)
+
+        #- run each MPI rank in a thread
+        size = 3
+        queues = [Queue() for rank in range(size)]
+        values = [0] * size
+        barrier = threading.Barrier(size)
+        status = [None] * size
+        def run(rank):
+            comm = _ThreadComm(rank, size, queues, values, barrier)
+            status[rank] = updatecoadd.main(self._args('mpi'), comm=comm)
+        threads = [threading.Thread(target=run, args=(rank,)) for rank in range(size)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(status, [0] * size)
+
+        serial = self._read_coadds('serial')
+        self.assertEqual(len(serial[None][0]), 4)
+        self.assertEqual(len(serial['b'][0]), 4)
+        for specprod in ['pool', 'mpi']:
+            coadds = self._read_coadds(specprod)
+            for band in serial:
+                for a, b in zip(serial[band], coadds[band]):
+                    self.assertTrue(np.allclose(a, b))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -57,8 +57,7 @@ class RedMonsterZfind(ZfindBase):
         self.flux = np.empty((nspec, nwave))
         self.ivar = np.empty((nspec, nwave))
 
-        for i in range(nspec):
-            self.flux[i], self.ivar[i] = resample_flux(10**loglam, wave, flux[i], ivar[i])
+        self.flux[:], self.ivar[:] = resample_flux(10**loglam, wave, flux, ivar)
 
         self.dloglam = dloglam
         self.loglam = loglam